@@ -34,6 +34,53 @@ public class MirageCrypto {
         Files.write(Paths.get(name + ".salt"), salt);
     }
 
+    // Long-running mode: each request on stdin is an op byte ('e'ncrypt,
+    // 'd'ecrypt or 'g'enshared) followed by two fields, each a 4 byte big-endian
+    // length and that many bytes. The fields are (keyfile, message) for
+    // encrypt/decrypt and (myname, peername) for genshared. Each reply is a
+    // status byte (0 ok, 1 error), a 4 byte length and the result or error text.
+    public static void serve() throws IOException {
+        DataInputStream in = new DataInputStream(new BufferedInputStream(System.in));
+        DataOutputStream out = new DataOutputStream(new BufferedOutputStream(System.out));
+        while (true) {
+            int op;
+            try {
+                op = in.readUnsignedByte();
+            } catch (EOFException e) {
+                return;
+            }
+            String arg = new String(readField(in), StandardCharsets.UTF_8);
+            byte[] data = readField(in);
+            byte[] result;
+            int status = 0;
+            try {
+                if (op == 'e') {
+                    result = CryptoUtilities.encrypt(data, Files.readAllBytes(Paths.get(arg)));
+                } else if (op == 'd') {
+                    result = CryptoUtilities.decrypt(data, Files.readAllBytes(Paths.get(arg)));
+                } else if (op == 'g') {
+                    genshared(arg, new String(data, StandardCharsets.UTF_8));
+                    result = new byte[0];
+                } else {
+                    throw new IOException("unknown op " + op);
+                }
+            } catch (Exception e) {
+                status = 1;
+                result = e.toString().getBytes(StandardCharsets.UTF_8);
+            }
+            out.writeByte(status);
+            out.writeInt(result.length);
+            out.write(result);
+            out.flush();
+        }
+    }
+
+    private static byte[] readField(DataInputStream in) throws IOException {
+        byte[] field = new byte[in.readInt()];
+        in.readFully(field);
+        return field;
+    }
+
     public static void genshared(String me, String peer) throws CryptoUtilities.CryptoException, IOException, ClassNotFoundException {
         FileInputStream kpf = new FileInputStream(me + ".key");
         ObjectInputStream ois = new ObjectInputStream(kpf);
@@ -65,6 +112,8 @@ public class MirageCrypto {
                 encrypt(args[1]);
             } else if (args[0].equals("decrypt")) {
                 decrypt(args[1]);
+            } else if (args[0].equals("serve")) {
+                serve();
             } else {
                 usage();
             }
@@ -79,5 +128,6 @@ public class MirageCrypto {
         System.out.println("java -cp . MirageCrypto genshared <myname> <peername>");
         System.out.println("java -cp . MirageCrypto encrypt <shared_key>");
         System.out.println("java -cp . MirageCrypto decrypt <shared_key>");
+        System.out.println("java -cp . MirageCrypto serve");
     }
 }
@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+
+# End-to-end latency of every API call, through the same functions the CLIs
+# use, against camera_sim.py: every SIMPLE_CMDS request plus get_media and
+# delete_media over HTTP (egarim.py with a CameraClient), and every
+# SIMPLE_CMDS request over Bluetooth (bluestrap.py with a LoopbackTransport,
+# so including the framing and the encryption backend).
+#
+# Each call type is run --count times in a block, after --warmup untimed
+# calls, and reported as p50/p95/p99 latency, calls per second (and MB/s for
+# downloads), and the process RSS at the end of the block. The simulator runs
+# in this process, so RSS includes it. Calls the simulator doesn't support
+# still make the round trip, and are counted by status code.
+#
+#   ./bench/bench_e2e.py --json results.json             # record results
+#   ./bench/bench_e2e.py --compare results.json          # fail on regressions
+#   ./bench/bench_e2e.py --transport ble --mtu 23 --interval 7.5
+#
+# Results only compare meaningfully with others from the same machine.
+
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import resource
+import tempfile
+import contextlib
+import statistics
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..'))
+from mirage_api import *
+import mirage_api
+import mirage_ble
+import mirage_crypto
+from mirage_http import CameraClient
+from camera_sim import CameraSim, parse_size
+import bluestrap
+import egarim
+
+TRANSPORTS = ['http', 'ble']
+MEDIA_CMDS = ['get_media', 'delete_media']
+
+# Per call options, as the argument parsers would give them
+CALL_OPTS = {
+    'config_wifi': {'ssid': 'bench', 'password': 'bench-password'},
+    'config_time': {'timezone': 'Europe/London'},
+    'config_capture': {'mode': 'live', 'width': 1920, 'height': 1080, 'projection': None,
+        'rtmp_endpoint': 'rtmp://127.0.0.1/live', 'stream_name_key': 'bench', 'stereo': False},
+    'start_capture': {'auto_stop': None},
+    'list_media': {'start': None, 'count': 100},
+    'get_debug_logs': {'count': 100},
+    'start_viewfinder': {'sdp': 'v=0\r\n'},
+    'get_media': {'buffer_size': 1024, 'fsync': False},
+}
+
+# Untimed calls before each timed one, to put the camera in the state the
+# call needs.
+SETUP = {
+    'start_capture': 'stop_capture',
+    'stop_capture': 'start_capture',
+}
+
+class Discard:
+    def write(self, s):
+        return len(s)
+
+    def flush(self):
+        pass
+
+def call_opts(name, keyfile):
+    return argparse.Namespace(subcommand=name, skey=keyfile, debug=False, **CALL_OPTS.get(name, {}))
+
+def rss_kb():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize() // 1024
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def summarize(transport, name, times, codes, errors, nbytes):
+    q = statistics.quantiles(times, n=100, method='inclusive') if len(times) > 1 else times * 99
+    total = sum(times)
+    r = {
+        'transport': transport,
+        'call': name,
+        'count': len(times),
+        'errors': errors,
+        'codes': codes,
+        'p50_ms': round(q[49] * 1000, 3),
+        'p95_ms': round(q[94] * 1000, 3),
+        'p99_ms': round(q[98] * 1000, 3),
+        'mean_ms': round(statistics.mean(times) * 1000, 3) if times else None,
+        'max_ms': round(max(times) * 1000, 3) if times else None,
+        'calls_per_s': round(len(times) / total, 1) if total else None,
+        'rss_kb': rss_kb(),
+    }
+    if nbytes:
+        r['mb_per_s'] = round(nbytes / total / 1000000, 2)
+    return r
+
+# Runs one call type; call(name, i) makes one call and returns the
+# CameraApiResponse, or None for media calls. call.prepare(name, n), if set,
+# is called first with the number of calls to come.
+def run_block(transport, name, call, count, warmup):
+    if hasattr(call, 'prepare'):
+        call.prepare(name, warmup + count)
+    times = []
+    codes = {}
+    errors = 0
+    nbytes = 0
+    for i in range(-warmup, count):
+        if name in SETUP:
+            with contextlib.suppress(Exception):
+                call(SETUP[name], i)
+        start = time.perf_counter()
+        try:
+            resp = call(name, i)
+        except Exception as e:
+            elapsed = time.perf_counter() - start
+            code = 'error'
+            if i >= 0:
+                errors += 1
+                if errors == 1:
+                    print('%s %s: %s' % (transport, name, e), file=sys.__stderr__)
+        else:
+            elapsed = time.perf_counter() - start
+            code = CameraApiResponse.ResponseStatus.StatusCode.Name(resp.response_status.status_code) if resp is not None else 'OK'
+        if i < 0:
+            continue
+        times.append(elapsed)
+        codes[code] = codes.get(code, 0) + 1
+        if name == 'get_media' and code == 'OK':
+            nbytes += call.media_size
+    return summarize(transport, name, times, codes, errors, nbytes)
+
+def http_calls(sim, skey, keyfile, tmpdir):
+    client = CameraClient(sim.host, sim.port, skey)
+    keep = sorted(sim.media)[0]
+    doomed = []
+
+    def prepare(name, n):
+        if name == 'delete_media':
+            with sim.lock:
+                doomed[:] = [sim.add_media(int(time.time() * 1000)).filename for i in range(n)]
+
+    def call(name, i):
+        opts = call_opts(name, keyfile)
+        if name == 'get_media':
+            opts.path = keep
+            opts.dest = tmpdir
+            egarim.get_media(client, opts)
+            return None
+        if name == 'delete_media':
+            opts.path = [doomed.pop()]
+            opts.all = False
+            egarim.delete_media(client, opts)
+            return None
+        return egarim.simple_cmd(client, opts, SIMPLE_CMDS[name])
+    call.prepare = prepare
+    call.media_size = sim.media_size
+    return client, call
+
+def ble_calls(sim, keyfile, mtu, interval):
+    transport = mirage_ble.LoopbackTransport(sim, keyfile, mtu=mtu, interval=interval)
+
+    def call(name, i):
+        return bluestrap.simple_cmd(transport, call_opts(name, keyfile), SIMPLE_CMDS[name])
+    call.media_size = 0
+    return transport, call
+
+# A regression is growth by more than tolerance and by more than min_delta
+# ms, so that the noise in sub-millisecond calls doesn't count.
+def compare(results, baseline, tolerance, min_delta):
+    base = {(r['transport'], r['call']): r for r in baseline['results']}
+    regressions = []
+    for r in results:
+        b = base.get((r['transport'], r['call']))
+        if b is None:
+            continue
+        for key in ('p50_ms', 'p95_ms'):
+            if b[key] and r[key] > b[key] * (1 + tolerance) and r[key] - b[key] > min_delta:
+                regressions.append('%s %s %s %.2f ms, baseline %.2f ms' % (r['transport'], r['call'], key, r[key], b[key]))
+        if r['errors'] > b['errors']:
+            regressions.append('%s %s %d errors, baseline %d' % (r['transport'], r['call'], r['errors'], b['errors']))
+    return regressions
+
+def main(opts):
+    if opts.crypto == 'python' and not mirage_crypto.available():
+        print('the python crypto backend needs the cryptography package; use --crypto worker')
+        sys.exit(1)
+    mirage_api.CRYPTO = opts.crypto
+    calls = opts.calls or list(SIMPLE_CMDS) + MEDIA_CMDS
+    skey = os.urandom(32)
+    results = []
+    with tempfile.TemporaryDirectory() as tmpdir, \
+            CameraSim(skey, opts.media, parse_size(opts.media_size), opts.latency / 1000,
+                opts.bandwidth * 1000000 / 8 if opts.bandwidth else None) as sim:
+        keyfile = os.path.join(tmpdir, 'bench.skey')
+        with open(keyfile, 'wb') as f:
+            f.write(skey)
+        print('%-5s %-18s %6s %9s %9s %9s %9s %9s %8s' % ('', 'call', 'count', 'p50 ms', 'p95 ms', 'p99 ms', 'calls/s', 'MB/s', 'rss MB'))
+        for transport in opts.transport:
+            if transport == 'http':
+                conn, call = http_calls(sim, skey, keyfile, tmpdir)
+            else:
+                conn, call = ble_calls(sim, keyfile, opts.mtu, opts.interval / 1000)
+            for name in calls:
+                if transport == 'ble' and name in MEDIA_CMDS:
+                    continue
+                # the CLI functions print their responses
+                with contextlib.redirect_stdout(Discard()):
+                    r = run_block(transport, name, call, opts.count, opts.warmup)
+                results.append(r)
+                print('%-5s %-18s %6d %9.2f %9.2f %9.2f %9.1f %9s %8.1f%s' % (transport, name, r['count'], r['p50_ms'],
+                    r['p95_ms'], r['p99_ms'], r['calls_per_s'] or 0, r.get('mb_per_s', '-'), r['rss_kb'] / 1024,
+                    '' if list(r['codes']) == ['OK'] else '  ' + json.dumps(r['codes'])))
+            if transport == 'http':
+                conn.close()
+            else:
+                print('ble link', conn.stats)
+
+    out = {
+        'meta': {
+            'time': int(time.time()),
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'crypto': mirage_api.crypto_backend(),
+            'count': opts.count,
+            'media_size': parse_size(opts.media_size),
+            'latency_ms': opts.latency,
+            'bandwidth_mbit': opts.bandwidth,
+            'mtu': opts.mtu,
+            'interval_ms': opts.interval,
+        },
+        'results': results,
+    }
+    if opts.json:
+        with open(opts.json, 'w') as f:
+            json.dump(out, f, indent=2)
+            f.write('\n')
+        print('results written to', opts.json)
+    if opts.compare:
+        with open(opts.compare) as f:
+            regressions = compare(results, json.load(f), opts.tolerance, opts.min_delta)
+        for line in regressions:
+            print('REGRESSION:', line)
+        if regressions:
+            sys.exit(1)
+        print('ok: within %d%% of %s' % (opts.tolerance * 100, opts.compare))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--count', help='timed calls per call type', type=int, default=100)
+    parser.add_argument('--warmup', help='untimed calls before each block', type=int, default=5)
+    parser.add_argument('--transport', help='transports to run', nargs='+', choices=TRANSPORTS, default=TRANSPORTS)
+    parser.add_argument('--calls', help='call types to run (default: all)', nargs='+', choices=list(SIMPLE_CMDS) + MEDIA_CMDS)
+    parser.add_argument('--crypto', help='message encryption backend for Bluetooth', choices=CRYPTO_BACKENDS, default=crypto_backend())
+    parser.add_argument('--media', help='media files on the simulated camera', type=int, default=20)
+    parser.add_argument('--media_size', help='size of each media file, e.g. 8M', default='8M')
+    parser.add_argument('--latency', help='simulated camera response delay, in ms', type=float, default=0)
+    parser.add_argument('--bandwidth', help='simulated camera send rate, in Mbit/s', type=float, default=0)
+    parser.add_argument('--mtu', help='Bluetooth ATT MTU', type=int, default=mirage_ble.DEFAULT_MTU)
+    parser.add_argument('--interval', help='Bluetooth connection interval, in ms', type=float, default=0)
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--compare', help='results file to compare with; exits with status 1 on regressions')
+    parser.add_argument('--tolerance', help='allowed growth in p50 and p95 over --compare', type=float, default=0.5)
+    parser.add_argument('--min_delta', help='growth in ms below which a call never counts as a regression', type=float, default=1.0)
+    main(parser.parse_args())
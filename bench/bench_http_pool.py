@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+
+# Commands per second for the camera HTTP API, with a fresh urllib connection
+# per command (the old egarim.py behaviour) and with a pooled CameraClient.
+# Runs against camera_sim.py, so needs the openssl CLI to make a throwaway
+# certificate.
+#
+#   ./bench/bench_http_pool.py [--count 200]
+
+import os
+import sys
+import time
+import argparse
+import urllib.request
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from mirage_api import *
+from mirage_http import CameraClient, http_signature, ctx
+from camera_sim import CameraSim
+
+def urllib_status(host, port, skey):
+    data = status_request(None).SerializeToString()
+    req = urllib.request.Request('https://%s:%s/daydreamcamera' % (host, port), data=data,
+        headers={'Content-Type': 'application/octet-stream'}, method='POST')
+    req.add_header('Authorization', 'daydreamcamera ' + http_signature(skey, req.method, req.selector, req.data))
+    with urllib.request.urlopen(req, context=ctx) as f:
+        return parse_response(f.read())
+
+def run(name, func, count):
+    start = time.perf_counter()
+    for i in range(count):
+        func()
+    elapsed = time.perf_counter() - start
+    print('%-20s %8.1f commands/s  %6.2f ms/command' % (name, count / elapsed, elapsed * 1000 / count))
+
+def main(opts):
+    skey = os.urandom(32)
+    with CameraSim(skey, media=0) as sim:
+        run('urllib per command', lambda: urllib_status(sim.host, sim.port, skey), opts.count)
+        with CameraClient(sim.host, sim.port, skey) as client:
+            run('CameraClient', lambda: client.call(status_request(None)), opts.count)
+            print('client stats', client.stats)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--count', help='commands per client', type=int, default=200)
+    main(parser.parse_args())
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+
+# Micro-benchmark of the Bluetooth \x00\x00 EOM framing codec: the original
+# byte-at-a-time implementation against the current one in mirage_api.
+#
+#   ./bench/bench_mm_codec.py [--old_max 100000]
+#
+# The old codec is quadratic, so by default it is skipped for messages larger
+# than --old_max bytes.
+
+import os
+import sys
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from mirage_api import mm_encode, mm_decode, MMDecoder
+
+SIZES = [100, 1000, 10000, 100000, 1000000]
+
+def old_mm_encode(msg):
+    out = b''
+    for i in range(len(msg)):
+        if i > 0 and msg[i - 1] == 0 and (msg[i] == 0 or msg[i] == 1):
+            out += b'\x01'
+        out += msg[i:i+1]
+    out += b'\x00\x00'
+    return out
+
+def old_mm_decode(msg):
+    if len(msg) < 2 or msg[-1] != 0 or msg[-2] != 0:
+        raise Exception('no EOM marker found')
+    out = b''
+    for i in range(len(msg) - 2):
+        if i > 0 and msg[i - 1] == 0 and msg[i] == 1:
+            continue
+        out += msg[i:i+1]
+    return out
+
+# Protobuf-like payload: mostly random bytes with plenty of zeros (unset
+# varints, small ints) so the escaping paths are exercised.
+def sample(size):
+    r = random.Random(size)
+    return bytes(r.choice((0, 0, 1, r.randrange(256))) for _ in range(size))
+
+def timeit(func, arg, min_time=0.2):
+    n = 0
+    start = time.perf_counter()
+    while True:
+        func(arg)
+        n += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            return elapsed / n
+
+def feed_chunks(encoded, mtu=20):
+    d = MMDecoder()
+    for i in range(0, len(encoded), mtu):
+        d.feed(encoded[i:i + mtu])
+    d.flush()
+
+def main(opts):
+    print('%10s %14s %14s %14s %14s %14s' % ('size', 'old encode', 'new encode', 'old decode', 'new decode', 'incremental'))
+    for size in opts.sizes:
+        msg = sample(size)
+        encoded = mm_encode(msg)
+        assert mm_decode(encoded) == msg
+        row = [size]
+        if size <= opts.old_max:
+            assert old_mm_encode(msg) == encoded
+            row += [timeit(old_mm_encode, msg), timeit(mm_encode, msg), timeit(old_mm_decode, encoded)]
+        else:
+            row += [None, timeit(mm_encode, msg), None]
+        row += [timeit(mm_decode, encoded), timeit(feed_chunks, encoded)]
+        print('%10d' % row[0] + ''.join('%14s' % ('-' if t is None else '%.3f ms' % (t * 1000)) for t in row[1:]))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--old_max', help='largest message size to run the old codec on', type=int, default=100000)
+    parser.add_argument('--sizes', help='message sizes in bytes', type=int, nargs='+', default=SIZES)
+    main(parser.parse_args())
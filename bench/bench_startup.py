@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+
+# Cold-start regression check for "egarim.py status": runs the CLI as a fresh
+# process against camera_sim.py and compares the best wall time, relative
+# to a bare "python -c pass", with the ratio in startup_baseline.json.
+# Exits with status 1 if it grew by more than --tolerance, or if status
+# imported any of the modules only other subcommands need.
+#
+#   ./bench/bench_startup.py              # check against the baseline
+#   ./bench/bench_startup.py --save       # record a new baseline
+#   ./bench/bench_startup.py --profile    # show the slowest imports
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+TOP_DIR = os.path.join(BENCH_DIR, '..')
+BASELINE = os.path.join(BENCH_DIR, 'startup_baseline.json')
+# imported by the handlers of the subcommands that use them
+LAZY_MODULES = ['mirage_discover', 'mirage_fleet', 'mirage_governor', 'mirage_media', 'mirage_monitor', 'mirage_thumbs']
+sys.path.insert(0, TOP_DIR)
+from camera_sim import CameraSim
+
+# Best-of-n wall time for each command. Runs are interleaved so that both
+# commands see the same background load.
+def best_ms(commands, runs):
+    best = [None] * len(commands)
+    for i in range(runs):
+        for j, args in enumerate(commands):
+            start = time.perf_counter()
+            subprocess.run([sys.executable] + args, cwd=TOP_DIR, check=True, stdout=subprocess.DEVNULL)
+            elapsed = (time.perf_counter() - start) * 1000
+            best[j] = elapsed if best[j] is None else min(best[j], elapsed)
+    return best
+
+# (cumulative us, self us, module) for each module args imports
+def import_times(args):
+    out = subprocess.run([sys.executable, '-X', 'importtime'] + args, cwd=TOP_DIR,
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True).stderr
+    rows = []
+    for line in out.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        rows.append((int(cumulative_us), int(self_us), name.rstrip()))
+    return rows
+
+def profile(rows, top=15):
+    print('%10s %10s  module' % ('cumul ms', 'self ms'))
+    for cumulative_us, self_us, name in sorted(rows, reverse=True)[:top]:
+        print('%10.1f %10.1f  %s' % (cumulative_us / 1000, self_us / 1000, name))
+
+def main(opts):
+    with tempfile.TemporaryDirectory() as tmpdir, CameraSim(os.urandom(32), media=0) as sim:
+        skey = os.path.join(tmpdir, 'bench.skey')
+        with open(skey, 'wb') as f:
+            f.write(sim.skey)
+        cmd = ['egarim.py', '--host', sim.host, '--port', str(sim.port), '--skey', skey, 'status']
+        rows = import_times(cmd)
+        if opts.profile:
+            profile(rows)
+        python_ms, status_ms = best_ms([['-c', 'pass'], cmd], opts.runs)
+
+    eager = sorted(set(name.strip() for _, _, name in rows) & set(LAZY_MODULES))
+    if eager:
+        print('FAIL: egarim.py status imported %s' % (', '.join(eager),))
+        sys.exit(1)
+    ratio = status_ms / python_ms
+    print('python startup %.1f ms, egarim.py status %.1f ms, ratio %.2f' % (python_ms, status_ms, ratio))
+    if opts.save:
+        with open(BASELINE, 'w') as f:
+            json.dump({'ratio': round(ratio, 2), 'status_ms': round(status_ms, 1), 'python_ms': round(python_ms, 1)}, f, indent=2)
+            f.write('\n')
+        print('baseline saved to', BASELINE)
+        return
+    if not os.path.exists(BASELINE):
+        print('no baseline; run with --save to record one')
+        return
+    with open(BASELINE) as f:
+        baseline = json.load(f)
+    limit = baseline['ratio'] * (1 + opts.tolerance)
+    if ratio > limit:
+        print('FAIL: cold start ratio %.2f exceeds baseline %.2f + %d%%' % (ratio, baseline['ratio'], opts.tolerance * 100))
+        sys.exit(1)
+    print('ok: within %d%% of baseline ratio %.2f' % (opts.tolerance * 100, baseline['ratio']))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=25)
+    parser.add_argument('--tolerance', help='allowed growth over the baseline ratio', type=float, default=0.3)
+    parser.add_argument('--save', help='record the current ratio as the baseline', action='store_true')
+    parser.add_argument('--profile', help='print the slowest imports first', action='store_true')
+    main(parser.parse_args())
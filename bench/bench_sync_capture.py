@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+
+# Start skew of a camera rig with and without latency compensation, using
+# simulated cameras with different network latencies and clock offsets.
+# Compares Fleet.call(sync=True), which releases every request at once, with
+# Fleet.call_at(), and prints both the true skew (from the simulator) and the
+# skew the fleet reports from recording_start_time. Exits with status 1 unless
+# compensation at least halves the median true skew.
+
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+import threading
+import statistics
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..'))
+from mirage_api import *
+import mirage_fleet
+
+# Stands in for CameraClient. Each request takes `latency` seconds each way,
+# plus up to `jitter`, and the camera clock runs `offset` seconds ahead.
+class SimulatedCamera:
+    def __init__(self, latency, offset, jitter):
+        self.latency = latency
+        self.offset = offset
+        self.jitter = jitter
+        self.started = None
+        self.lock = threading.Lock()
+
+    def delay(self):
+        time.sleep(self.latency + random.uniform(0, self.jitter))
+
+    def call(self, req):
+        self.delay()
+        now = time.time()
+        resp = CameraApiResponse()
+        resp.request_id = req.header.request_id
+        resp.response_status.status_code = CameraApiResponse.ResponseStatus.OK
+        with self.lock:
+            if req.type == CameraApiRequest.START_CAPTURE and self.started is not None:
+                resp.response_status.status_code = CameraApiResponse.ResponseStatus.INVALID_REQUEST
+            elif req.type == CameraApiRequest.START_CAPTURE:
+                self.started = now
+            elif req.type == CameraApiRequest.STATUS:
+                resp.camera_status.device_timestamp = int((now + self.offset) * 1000)
+                rs = resp.camera_status.recording_status
+                if self.started is None:
+                    rs.recording_state = CameraStatus.RecordingStatus.IDLE
+                else:
+                    rs.recording_state = CameraStatus.RecordingStatus.RECORDING
+                    rs.recording_start_time = int((self.started + self.offset) * 1000)
+        self.delay()
+        return resp
+
+    def warm(self):
+        pass
+
+    def close(self):
+        pass
+
+def run(opts, skey, compensate):
+    sims = {}
+    cameras = []
+    for i, latency in enumerate(opts.latency):
+        cameras.append(mirage_fleet.Camera('cam%d' % (i,), 'sim', i, skey))
+        sims[i] = SimulatedCamera(latency / 1000, random.uniform(-5, 5), opts.jitter / 1000)
+
+    with mirage_fleet.Fleet(cameras, lambda host, port, key: sims[port]) as f:
+        requests = {cam.id: start_capture_request(argparse.Namespace(auto_stop=None)) for cam in cameras}
+        if compensate:
+            results = f.call_at(requests, opts.samples)
+        else:
+            results = f.call(requests, sync=True)
+        f.recording_starts(results, opts.samples)
+    started = [sim.started for sim in sims.values()]
+    return max(started) - min(started), mirage_fleet.start_skew(results)
+
+# Median true and reported skew over opts.runs runs, in ms.
+def measure(opts, skey, compensate):
+    true_skews = []
+    reported = []
+    for i in range(opts.runs):
+        true_skew, reported_skew = run(opts, skey, compensate)
+        true_skews.append(true_skew * 1000)
+        reported.append(reported_skew * 1000)
+    return statistics.median(true_skews), max(true_skews), statistics.median(reported)
+
+def main(opts):
+    with tempfile.NamedTemporaryFile() as skey:
+        print('one way latencies %s ms, jitter %g ms, %d runs' % (', '.join('%g' % l for l in opts.latency), opts.jitter, opts.runs))
+        medians = {}
+        for name, compensate in (('released together', False), ('latency compensated', True)):
+            median, worst, reported = measure(opts, skey.name, compensate)
+            medians[compensate] = median
+            print('%-20s  true skew median %6.2f ms, max %6.2f ms   reported median %6.2f ms' % (name, median, worst, reported))
+    if medians[True] > medians[False] / 2:
+        print('FAIL: latency compensation did not halve the skew')
+        sys.exit(1)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--latency', help='one way latency of each camera in ms', type=float, nargs='+', default=[2, 10, 25, 40])
+    parser.add_argument('--jitter', help='extra random latency per direction in ms', type=float, default=1)
+    parser.add_argument('--samples', help='clock samples per camera', type=int, default=mirage_fleet.CLOCK_SAMPLES)
+    parser.add_argument('--runs', type=int, default=10)
+    main(parser.parse_args())
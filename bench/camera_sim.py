@@ -0,0 +1,458 @@
+#!/usr/bin/env python3
+
+# Simulated camera, for benchmarks and end-to-end runs without hardware.
+#
+# Serves the camera HTTP API over HTTPS: CameraApiRequests POSTed to
+# /daydreamcamera, and GET (with Range) and DELETE on /media/<path>. The
+# Authorization header of every request is checked against the HMAC of
+# mirage_http.http_signature, and requests that don't match get a 403.
+#
+# The camera is synthetic but consistent: STATUS follows config_capture,
+# start_capture and stop_capture, GET_CAPABILITIES lists a ladder of live
+# modes, and the media files have pseudo-random content generated from a
+# seed, so their SHA1s and thumbnails are the same from run to run. Media is
+# generated as it is sent, so files can be much larger than memory. Stopping
+# a video capture adds a file.
+#
+# latency delays every response; bandwidth caps the bytes per second sent on
+# each connection.
+#
+#   ./bench/camera_sim.py --skey me_cam.skey --port 8443 --media 20 --media_size 200M --latency 20 --bandwidth 80
+#   ./egarim.py --host 127.0.0.1 --port 8443 list_media
+#
+# Needs the openssl CLI to make a throwaway certificate.
+
+import os
+import re
+import ssl
+import sys
+import hmac
+import time
+import zlib
+import random
+import hashlib
+import argparse
+import tempfile
+import threading
+import subprocess
+import http.server
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from mirage_api import *
+from mirage_http import API_PATH, http_signature
+from mirage_discover import certificate_signature
+
+# media content repeats with this period
+BLOCK_SIZE = 64 * 1024
+WRITE_SIZE = 64 * 1024
+THUMB_SIZE = 16 * 1024
+LIVE_SIZES = [(1280, 720), (1920, 1080), (2560, 1440), (3840, 2160)]
+LIVE_BITRATE = 12000000
+
+OK = CameraApiResponse.ResponseStatus.OK
+
+# SHA1 of the media with each (seed, filename, size), shared by simulators in
+# one process, as the content only depends on those
+DIGESTS = {}
+
+class SimMedia:
+    def __init__(self, filename, size, timestamp, duration, seed):
+        self.filename = filename
+        self.size = size
+        self.timestamp = timestamp
+        self.duration = duration
+        rnd = random.Random('%s/%s' % (seed, filename))
+        block = rnd.randbytes(BLOCK_SIZE)
+        # twice over, so any BLOCK_SIZE bytes from any offset are one slice
+        self.block = memoryview(block + block)
+        self.thumb = b'\xff\xd8\xff\xe0' + rnd.randbytes(THUMB_SIZE - 4)
+        self.key = (seed, filename, size)
+        self.lock = threading.Lock()
+
+    # Yields the bytes from start up to end, in pieces of at most WRITE_SIZE.
+    def chunks(self, start=0, end=None):
+        end = self.size if end is None else end
+        while start < end:
+            i = start % BLOCK_SIZE
+            n = min(end - start, BLOCK_SIZE, WRITE_SIZE)
+            yield self.block[i:i + n]
+            start += n
+
+    # Computed on first use, since it means generating the whole file.
+    # CameraSim.hash_media calls it before taking the simulator's lock.
+    def sha1(self):
+        with self.lock:
+            digest = DIGESTS.get(self.key)
+            if digest is None:
+                h = hashlib.sha1()
+                for chunk in self.chunks():
+                    h.update(chunk)
+                digest = DIGESTS[self.key] = h.digest()
+        return digest
+
+class SimHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        self.server.sim.count('connections')
+
+    def log_message(self, *args):
+        pass
+
+    def authorized(self, body):
+        sig = self.headers.get('Authorization', '')
+        expected = 'daydreamcamera ' + http_signature(self.server.sim.skey, self.command, self.path, body)
+        if hmac.compare_digest(sig.encode('latin-1'), expected.encode('latin-1')):
+            return True
+        self.server.sim.count('unauthorized')
+        self.reply(403, [])
+        return False
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else None
+
+    # Sends the response after the simulated latency, with the body (an
+    # iterable of bytes-like pieces) paced to the simulated bandwidth.
+    def reply(self, code, chunks, length=0, headers=()):
+        sim = self.server.sim
+        if sim.latency:
+            time.sleep(sim.latency)
+        self.send_response(code)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(length))
+        self.end_headers()
+        start = time.monotonic()
+        sent = 0
+        for chunk in chunks:
+            self.wfile.write(chunk)
+            sent += len(chunk)
+            if sim.bandwidth:
+                delay = sent / sim.bandwidth - (time.monotonic() - start)
+                if delay > 0:
+                    time.sleep(delay)
+        sim.count('bytes_sent', sent)
+
+    def do_POST(self):
+        body = self.read_body()
+        if not self.authorized(body):
+            return
+        if self.path != API_PATH:
+            self.reply(404, [])
+            return
+        req = CameraApiRequest()
+        req.ParseFromString(body or b'')
+        data = self.server.sim.handle(req).SerializeToString()
+        self.reply(200, [data], len(data), [('Content-Type', 'application/octet-stream')])
+
+    def media(self):
+        if not self.path.startswith('/media/'):
+            return None
+        return self.server.sim.media.get(self.path[len('/media/'):])
+
+    def do_GET(self):
+        if not self.authorized(self.read_body()):
+            return
+        self.server.sim.count('requests')
+        m = self.media()
+        if m is None:
+            self.reply(404, [])
+            return
+        r = re.match(r'bytes=(\d+)-(\d*)$', self.headers.get('Range', ''))
+        if r and int(r.group(1)) < m.size:
+            start = int(r.group(1))
+            end = min(int(r.group(2)) + 1, m.size) if r.group(2) else m.size
+            self.reply(206, m.chunks(start, end), end - start,
+                [('Content-Range', 'bytes %d-%d/%d' % (start, end - 1, m.size))])
+        else:
+            self.reply(200, m.chunks(), m.size)
+
+    def do_DELETE(self):
+        if not self.authorized(self.read_body()):
+            return
+        self.server.sim.count('requests')
+        m = self.media()
+        if m is None:
+            self.reply(404, [])
+            return
+        self.server.sim.remove(m.filename)
+        self.reply(200, [])
+
+class CameraSim:
+    def __init__(self, skey, media=10, media_size=8 * 1024 * 1024, latency=0, bandwidth=None,
+            seed=0, host='127.0.0.1', port=0):
+        self.skey = skey
+        self.seed = seed
+        # seconds per response, bytes per second per connection
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.host = host
+        self.port = port
+        self.media_size = media_size
+        self.lock = threading.Lock()
+        self.stats = {'connections': 0, 'requests': 0, 'unauthorized': 0, 'bytes_sent': 0}
+        self.server = None
+        self.signature = b''
+
+        self.media = {}
+        self.clip = 0
+        self.modified = int(time.time() * 1000)
+        for i in range(media):
+            self.add_media(self.modified - (media - i) * 60000)
+
+        self.recording_start = None
+        self.auto_stop = None
+        self.dropped_frames = 0
+        self.capture_mode = CaptureMode()
+        self.capture_mode.active_capture_type = CaptureMode.VIDEO
+        fs = self.capture_mode.configured_live_mode.video_mode.frame_size
+        fs.frame_width, fs.frame_height = LIVE_SIZES[-1]
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.stats[name] += n
+
+    def add_media(self, timestamp, duration=60000):
+        self.clip += 1
+        m = SimMedia('DCIM/SIM%05d.mp4' % (self.clip,), self.media_size, timestamp, duration, self.seed)
+        self.media[m.filename] = m
+        self.modified = int(time.time() * 1000)
+        return m
+
+    def remove(self, filename):
+        with self.lock:
+            self.media.pop(filename, None)
+            self.modified = int(time.time() * 1000)
+
+    def start(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cert = os.path.join(tmpdir, 'cert.pem')
+            subprocess.check_call(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+                '-subj', '/CN=camera-sim', '-keyout', cert, '-out', cert], stderr=subprocess.DEVNULL)
+            sctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            sctx.load_cert_chain(cert)
+            with open(cert) as f:
+                pem = f.read()
+        der = ssl.PEM_cert_to_DER_cert(pem[pem.index('-----BEGIN CERTIFICATE-----'):])
+        self.signature = certificate_signature(der)
+        self.server = http.server.ThreadingHTTPServer((self.host, self.port), SimHandler)
+        self.server.daemon_threads = True
+        self.server.socket = sctx.wrap_socket(self.server.socket, server_side=True)
+        self.server.sim = self
+        self.host, self.port = self.server.server_address[:2]
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def handle(self, req):
+        self.count('requests')
+        resp = CameraApiResponse()
+        resp.request_id = req.header.request_id
+        handler = {
+            CameraApiRequest.STATUS: self.status,
+            CameraApiRequest.GET_CAPABILITIES: self.capabilities,
+            CameraApiRequest.CONFIGURE: self.configure,
+            CameraApiRequest.START_CAPTURE: self.start_capture,
+            CameraApiRequest.STOP_CAPTURE: self.stop_capture,
+            CameraApiRequest.LIST_MEDIA: self.list_media,
+            CameraApiRequest.DELETE_MEDIA: self.delete_media,
+            CameraApiRequest.GET_THUMBNAIL: self.thumbnails,
+            CameraApiRequest.GET_DEBUG_LOGS: lambda req, resp: OK,
+            CameraApiRequest.KEY_EXCHANGE_INITIATE: self.key_exchange,
+            CameraApiRequest.KEY_EXCHANGE_FINALIZE: lambda req, resp: OK,
+        }.get(req.type)
+        self.hash_media(req)
+        with self.lock:
+            code = handler(req, resp) if handler else CameraApiResponse.ResponseStatus.NOT_SUPPORTED
+        resp.response_status.status_code = code
+        return resp
+
+    # Hashes the media a LIST_MEDIA or DELETE_MEDIA request needs the SHA1 of,
+    # outside the lock, so that other requests aren't held up meanwhile.
+    def hash_media(self, req):
+        with self.lock:
+            if req.type == CameraApiRequest.LIST_MEDIA:
+                media = self.page(req)
+            elif req.type == CameraApiRequest.DELETE_MEDIA:
+                media = [self.media[d.filename] for d in req.delete_media_request if d.filename in self.media]
+            else:
+                return
+        for m in media:
+            m.sha1()
+
+    def page(self, req):
+        names = sorted(self.media)
+        start = req.list_media_request.start_index
+        count = req.list_media_request.media_count or len(names)
+        return [self.media[name] for name in names[start:start + count]]
+
+    def check_auto_stop(self, now):
+        if self.auto_stop is not None and now >= self.auto_stop:
+            self.end_capture()
+
+    # Pairing over mirage_ble.LoopbackTransport; the key material is random,
+    # so it is only good for exercising the protocol.
+    def key_exchange(self, req, resp):
+        resp.key_exchange_response.public_key = os.urandom(65)
+        resp.key_exchange_response.salt = os.urandom(16)
+        return OK
+
+    def status(self, req, resp):
+        now = int(time.time() * 1000)
+        self.check_auto_stop(now)
+        s = resp.camera_status
+        s.device_timestamp = now
+        rs = s.recording_status
+        if self.recording_start is None:
+            rs.recording_state = CameraStatus.RecordingStatus.IDLE
+        else:
+            rs.recording_state = CameraStatus.RecordingStatus.RECORDING
+            rs.recording_start_time = self.recording_start
+            if self.capture_mode.active_capture_type == CaptureMode.LIVE:
+                live = rs.live_stream_status
+                live.target_bitrate = LIVE_BITRATE
+                live.source_bitrate = LIVE_BITRATE
+                live.upload_bitrate = LIVE_BITRATE
+                live.dropped_frames = self.dropped_frames
+        s.battery_status.battery_percentage = 87
+        s.battery_status.charging_state = CameraStatus.BatteryStatus.BATTERY_STATUS_DISCHARGING
+        used = sum(m.size for m in self.media.values())
+        s.storage_status.total_space = 128 * 1024 ** 3
+        s.storage_status.free_space = max(s.storage_status.total_space - used, 0)
+        s.active_capture_mode.CopyFrom(self.capture_mode)
+        hs = s.http_server_status
+        hs.camera_hostname.append(self.host)
+        hs.camera_port = self.port
+        hs.camera_certificate_signature = self.signature
+        return OK
+
+    def capabilities(self, req, resp):
+        c = resp.capabilities
+        c.protocol_version = 0
+        c.manufacturer_name = 'egarim'
+        c.model_name = 'camera_sim'
+        for width, height in LIVE_SIZES:
+            for modes in (c.supported_live_modes, c.supported_video_modes):
+                mode = modes.add()
+                mode.frame_size.frame_width = width
+                mode.frame_size.frame_height = height
+                mode.frames_per_second = 30.0
+        c.supports_auto_stop_duration_ms = True
+        return OK
+
+    def configure(self, req, resp):
+        cr = req.configuration_request
+        if cr.HasField('capture_mode'):
+            if self.recording_start is not None:
+                return CameraApiResponse.ResponseStatus.INVALID_REQUEST
+            self.capture_mode.MergeFrom(cr.capture_mode)
+        return OK
+
+    def start_capture(self, req, resp):
+        now = int(time.time() * 1000)
+        self.check_auto_stop(now)
+        if self.recording_start is not None:
+            return CameraApiResponse.ResponseStatus.INVALID_REQUEST
+        self.recording_start = now
+        self.dropped_frames = 0
+        ms = req.start_capture_request.auto_stop_duration_ms
+        self.auto_stop = now + ms if ms else None
+        return OK
+
+    def end_capture(self):
+        if self.capture_mode.active_capture_type == CaptureMode.VIDEO:
+            self.add_media(self.recording_start, int(time.time() * 1000) - self.recording_start)
+        self.recording_start = None
+        self.auto_stop = None
+
+    def stop_capture(self, req, resp):
+        self.check_auto_stop(int(time.time() * 1000))
+        if self.recording_start is None:
+            return CameraApiResponse.ResponseStatus.INVALID_REQUEST
+        self.end_capture()
+        return OK
+
+    def list_media(self, req, resp):
+        resp.media.total_count = len(self.media)
+        resp.media.last_modified_time = self.modified
+        for m in self.page(req):
+            item = resp.media.media.add()
+            item.filename = m.filename
+            item.size = m.size
+            item.timestamp = m.timestamp
+            item.duration = m.duration
+            item.width, item.height = LIVE_SIZES[-1]
+            c = item.checksum.add()
+            c.checksum_type = FileChecksum.SHA1
+            c.checksum = m.sha1()
+        return OK
+
+    def delete_media(self, req, resp):
+        for d in req.delete_media_request:
+            status = resp.delete_media_status.add()
+            m = self.media.get(d.filename)
+            if m is None or d.HasField('checksum') and d.checksum.checksum != m.sha1():
+                status.status_code = CameraApiResponse.ResponseStatus.INVALID_REQUEST
+                continue
+            del self.media[d.filename]
+            self.modified = int(time.time() * 1000)
+            status.status_code = OK
+        return OK
+
+    def thumbnails(self, req, resp):
+        for t in req.thumbnail_request:
+            m = self.media.get(t.filename)
+            if m is None:
+                return CameraApiResponse.ResponseStatus.INVALID_REQUEST
+            r = resp.thumbnail.add()
+            r.total_size = len(m.thumb)
+            r.checksum = zlib.crc32(m.thumb)
+            r.data = m.thumb[t.start_index:t.start_index + t.length] if t.length else m.thumb[t.start_index:]
+        return OK
+
+# 200M, 64K, 1G or a plain number of bytes
+def parse_size(s):
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    if s[-1:].upper() in units:
+        return int(float(s[:-1]) * units[s[-1].upper()])
+    return int(s)
+
+def main(opts):
+    with open(opts.skey, 'rb') as f:
+        skey = f.read()
+    sim = CameraSim(skey, opts.media, parse_size(opts.media_size), opts.latency / 1000,
+        opts.bandwidth * 1000000 / 8 if opts.bandwidth else None, opts.seed, opts.host, opts.port)
+    with sim:
+        print('camera_sim listening on %s:%d' % (sim.host, sim.port))
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            pass
+    print('stats', sim.stats)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--skey', help='shared encryption key file', default='me_cam.skey')
+    parser.add_argument('--host', help='address to listen on', default='127.0.0.1')
+    parser.add_argument('--port', help='port to listen on', type=int, default=8443)
+    parser.add_argument('--media', help='number of media files', type=int, default=10)
+    parser.add_argument('--media_size', help='size of each media file, e.g. 200M', default='8M')
+    parser.add_argument('--latency', help='delay before each response, in ms', type=float, default=0)
+    parser.add_argument('--bandwidth', help='send rate per connection, in Mbit/s', type=float, default=0)
+    parser.add_argument('--seed', help='seed for the media content', default='0')
+    main(parser.parse_args())
@@ -2,12 +2,17 @@
 
 # Lenovo Mirage camera API client for pairing and control over Bluetooth on Linux.
 
-import dbus
-import dbus.mainloop.glib
+# dbus and GObject are only needed to talk to a camera through BlueZ; the
+# command functions also work over mirage_ble.LoopbackTransport without them.
 try:
-  from gi.repository import GObject
+  import dbus
+  import dbus.mainloop.glib
+  try:
+    from gi.repository import GObject
+  except ImportError:
+    import gobject as GObject
 except ImportError:
-  import gobject as GObject
+  dbus = None
 import uuid
 import time
 import sys
@@ -15,8 +20,13 @@ import functools
 import queue
 import threading
 import argparse
+import shlex
 import os
-import google.protobuf.json_format
+import mirage_api
+import mirage_ble
+import mirage_cache
+import mirage_crypto
+import mirage_trace
 from mirage_api import *
 
 SERVICE_NAME = 'org.bluez'
@@ -34,18 +44,25 @@ CAMERA_API_RESPONSE_CHARACTERISTIC_UUID = '9f14e1da-4add-4ec7-aa34-6106669e2c12'
 CAMERA_API_STATUS_CHARACTERISTIC_UUID = 'a03fedd3-0923-4398-854e-e2806d159a7f'
 
 state = {
-    'responseq': queue.Queue(),
     'main_loop': None,
     'exitval': 0,
     'adapter': None,
-    'devpath': None
+    'devpath': None,
+    'objects': None
 }
 
-# Threads, blah. We use polling most of the time to keep it simple, except for
-# notifications, which are pushed into a queue by the callback and retrieved
-# from the main thread.
+# Threads, blah. The BlueZ object tree is mirrored by an ObjectCache, kept
+# current by signals delivered on the main loop thread; the user thread waits
+# on it for devices, services and property changes. Notifications are pushed
+# into the GattTransport's queue by the callback and retrieved from the user
+# thread.
 
 def main(opts):
+    if dbus is None:
+        print('bluestrap.py needs the dbus-python and PyGObject packages')
+        sys.exit(1)
+    if opts.trace:
+        mirage_trace.enable(opts.trace)
     GObject.threads_init()
     dbus.mainloop.glib.threads_init()
     dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
@@ -71,8 +88,8 @@ def main(opts):
 # (e.g. adapters have start/stop discovery methods)
 #
 # Lookup operations give us the pathname of the entity and a snapshot of
-# its properties. We poll for property changes by looking up entities at
-# intervals, instead of subscribing to changes.
+# its properties, taken from the ObjectCache. Waiting for an entity or a
+# property value returns as soon as the signal announcing it arrives.
 
 def bzz(opts):
     main_loop = state['main_loop']
@@ -82,6 +99,8 @@ def bzz(opts):
         time.sleep(0)
 
     bus = dbus.SystemBus()
+    state['started'] = time.time()
+    state['objects'] = ObjectCache(bus)
 
     service_uuid = CAMERA_PAIRING_UUID if opts.subcommand == 'pair' else CAMERA_SERVICE_UUID
     try:
@@ -89,48 +108,51 @@ def bzz(opts):
         clear_cache(adapter)
         scan_filter = {'UUIDs': [service_uuid]}
 
-        adapter.SetDiscoveryFilter(scan_filter)
-        adapter.StartDiscovery()
-        dev = find_dev_by_uuid(service_uuid)
-        adapter.StopDiscovery()
+        with mirage_trace.span('scan'):
+            adapter.SetDiscoveryFilter(scan_filter)
+            adapter.StartDiscovery()
+            dev = find_dev_by_uuid(service_uuid)
+            adapter.StopDiscovery()
         if dev is None:
             print('sadface')
             raise Exception('camera not found')
 
         print('found camera')
         state['devpath'] = devpath = dev[0]
-        connect(devpath)
-        service_path, x = find_service(devpath, service_uuid)
-        request_path, x = find_characteristic(service_path, CAMERA_API_REQUEST_CHARACTERISTIC_UUID)
-        response_path, x = find_characteristic(service_path, CAMERA_API_RESPONSE_CHARACTERISTIC_UUID)
-        req = get_obj(request_path, CHARACTERISTIC_INTERFACE)
-        setup_response_queue(response_path)
-
-        if opts.subcommand == 'pair':
-            pair(req, opts)
-        elif opts.subcommand == 'status':
-            status(req, opts)
-        elif opts.subcommand in SIMPLE_CMDS:
-            simple_cmd(req, opts, SIMPLE_CMDS[opts.subcommand])
-        else:
-            print('wtf, unknown subcommand')
-
-        disconnect(devpath)
+        with mirage_trace.span('connect'):
+            connect(devpath)
+        with mirage_trace.span('resolve_services'):
+            service_path, x = find_service(devpath, service_uuid)
+            request_path, x = find_characteristic(service_path, CAMERA_API_REQUEST_CHARACTERISTIC_UUID)
+            response_path, x = find_characteristic(service_path, CAMERA_API_RESPONSE_CHARACTERISTIC_UUID)
+            transport = GattTransport(request_path, response_path)
+
+        with mirage_trace.span(opts.subcommand):
+            if opts.subcommand == 'pair':
+                pair(transport, opts)
+            elif opts.subcommand == 'session':
+                session(transport, opts)
+            else:
+                run_cmd(transport, opts)
+
+        with mirage_trace.span('disconnect'):
+            disconnect(devpath)
     except Exception as e:
         print(e)
         state['exitval'] = 1
 
+    if opts.crypto_stats:
+        print_crypto_stats()
     main_loop.quit()
 
 
-def pair(req, opts):
-    respq = state['responseq']
+def pair(transport, opts):
     key = opts.key
     camkey = opts.camkey
     key_init_request = key_init(key)
     print('key init request', key_init_request)
-    req.WriteValue(mm_encode(key_init_request.SerializeToString()), {})
-    response = parse_response(mm_decode(respq.get()))
+    transport.send(key_init_request.SerializeToString())
+    response = parse_response(transport.receive())
     print('key response', response)
     if key_response(response, camkey) == False:
         print('error received while pairing')
@@ -140,8 +162,8 @@ def pair(req, opts):
     time.sleep(5)
     key_finalize_request = key_finalize(key)
     print('key finalize request', key_finalize_request)
-    req.WriteValue(mm_encode(key_finalize_request.SerializeToString()), {})
-    response = parse_response(mm_decode(respq.get()))
+    transport.send(key_finalize_request.SerializeToString())
+    response = parse_response(transport.receive())
     print('key finalize response', response)
     if finalize_response(response):
         genshared(opts.key, opts.camkey)
@@ -149,35 +171,146 @@ def pair(req, opts):
     else:
         print('Pairing failed!')
 
-def status(req, opts):
-    resp = simple_cmd(req, opts, SIMPLE_CMDS['status'])
-    with open(os.path.join(os.path.expanduser('~'), '.egarim-status'), 'w') as f:
-        f.write(google.protobuf.json_format.MessageToJson(resp))
-
-def simple_cmd(req, opts, request):
-    respq = state['responseq']
+def status(transport, opts):
+    resp = simple_cmd(transport, opts, SIMPLE_CMDS['status'])
+    with open(opts.skey, 'rb') as f:
+        path = mirage_cache.save(f.read(), resp)
+    print('status cached in', path)
+    return resp
+
+def run_cmd(transport, opts):
+    if opts.subcommand == 'status':
+        return status(transport, opts)
+    elif opts.subcommand in SIMPLE_CMDS:
+        return simple_cmd(transport, opts, SIMPLE_CMDS[opts.subcommand])
+    else:
+        print('wtf, unknown subcommand')
+
+# Runs commands from a script (or stdin) over the one connection, one per
+# line, as they would be given to bluestrap.py, e.g.
+#   config_time --timezone Europe/London
+#   config_wifi --ssid home --password hunter2
+#   sleep 10
+#   status
+# and reports how long each took.
+def session(transport, opts):
+    parser = argparse.ArgumentParser(prog='', add_help=False)
+    subparsers = parser.add_subparsers(dest='subcommand')
+    add_commands(subparsers)
+    sleep = subparsers.add_parser('sleep')
+    sleep.add_argument('seconds', type=float)
+
+    script = sys.stdin if opts.script == '-' else open(opts.script, 'r')
+    interactive = script.isatty()
+    failed = 0
+    print('connected in %.1f s' % (time.time() - state['started'],))
+    try:
+        while True:
+            if interactive:
+                print('> ', end='', flush=True)
+            line = script.readline()
+            if not line:
+                break
+            args = shlex.split(line, comments=True)
+            if not args:
+                continue
+            try:
+                cmd = parser.parse_args(args)
+            except SystemExit:
+                failed += 1
+                continue
+            if cmd.subcommand is None:
+                continue
+            if cmd.subcommand == 'sleep':
+                time.sleep(cmd.seconds)
+                continue
+            cmd_opts = argparse.Namespace(**dict(vars(opts), **vars(cmd)))
+            start = time.time()
+            try:
+                resp = run_cmd(transport, cmd_opts)
+                code = CameraApiResponse.ResponseStatus.StatusCode.Name(resp.response_status.status_code)
+            except Exception as e:
+                code = 'error: %s' % (e,)
+            if code != 'OK':
+                failed += 1
+            print('%s %s %.0f ms' % (cmd.subcommand, code, (time.time() - start) * 1000))
+            if failed and opts.stop_on_error:
+                break
+    finally:
+        if script is not sys.stdin:
+            script.close()
+    if failed:
+        state['exitval'] = 1
 
-    r = request(opts)
+def simple_cmd(transport, opts, request):
+    with mirage_trace.span('build_request'):
+        r = request(opts)
     print('request', r)
-    rbytes = mm_encode(encrypt(r.SerializeToString(), opts.skey))
-    req.WriteValue(rbytes, {})
-    response = parse_response(decrypt(mm_decode(respq.get()), opts.skey))
+    with mirage_trace.span('serialize'):
+        data = r.SerializeToString()
+    transport.send(encrypt(data, opts.skey))
+    response = parse_response(decrypt(transport.receive(), opts.skey))
     print(response)
     return response
 
-def setup_response_queue(path):
-
-    def change_received(interface, changed_props, invalidated_props):
-        data = changed_props.get('Value', None)
-        if interface != CHARACTERISTIC_INTERFACE or data is None:
-            return
-        response = b''.join([bytes([x]) for x in data])
-        state['responseq'].put(response)
-
-    resp = get_obj(path, CHARACTERISTIC_INTERFACE)
-    resp_prop = get_obj(path, PROPERTIES_INTERFACE)
-    resp_prop.connect_to_signal('PropertiesChanged', change_received)
-    resp.StartNotify()
+# The camera's API characteristics, as a mirage_ble transport.
+class GattTransport:
+    def __init__(self, request_path, response_path):
+        self.req = get_obj(request_path, CHARACTERISTIC_INTERFACE)
+        self.responses = queue.Queue()
+
+        # Large responses are split across several notifications; only
+        # complete, decoded messages are put on the queue. A message whose EOM
+        # ends a full size notification is held by the decoder until the next
+        # notification, or a pause, settles it.
+        decoder = MMDecoder()
+        self.notifications = 0
+
+        def settle(n):
+            if n == self.notifications:
+                for response in decoder.flush():
+                    self.responses.put(response)
+            return False
+
+        def change_received(interface, changed_props, invalidated_props):
+            data = changed_props.get('Value', None)
+            if interface != CHARACTERISTIC_INTERFACE or data is None:
+                return
+            with mirage_trace.span('notification', bytes=len(data)):
+                self.notifications += 1
+                for response in decoder.feed(bytes(data)):
+                    self.responses.put(response)
+                if not decoder.pending():
+                    return
+                if len(data) < self.payload:
+                    settle(self.notifications)
+                else:
+                    self.payload = max(self.payload, len(data))
+                    GObject.timeout_add(int(mirage_ble.SETTLE_DELAY * 1000), settle, self.notifications)
+
+        resp = get_obj(response_path, CHARACTERISTIC_INTERFACE)
+        resp_prop = get_obj(response_path, PROPERTIES_INTERFACE)
+        # The notification payload size, from the ATT MTU where BlueZ reports
+        # it, otherwise the largest notification seen so far
+        try:
+            self.payload = int(resp_prop.Get(CHARACTERISTIC_INTERFACE, 'MTU')) - mirage_ble.NOTIFY_OVERHEAD
+        except dbus.exceptions.DBusException:
+            self.payload = 0
+        resp_prop.connect_to_signal('PropertiesChanged', change_received)
+        resp.StartNotify()
+
+    def send(self, msg):
+        with mirage_trace.span('mm_encode'):
+            data = mm_encode(msg)
+        with mirage_trace.span('write', bytes=len(data)):
+            self.req.WriteValue(data, {})
+
+    def receive(self, timeout=None):
+        try:
+            with mirage_trace.span('wait_response'):
+                return self.responses.get(timeout=timeout)
+        except queue.Empty:
+            raise Exception('no response from camera')
 
 def cleanup(adapter, devpath):
     print('cleaning up..')
@@ -189,10 +322,16 @@ def cleanup(adapter, devpath):
     except:
         pass
 
+# Retries func until it returns something other than notfound, for up to
+# repeat * interval seconds. With the ObjectCache, it is retried whenever
+# the cache changes rather than every interval.
 def poll(repeat=30, interval=1, notfound=None, msg='waitingggg..'):
     def decorator_poll(func):
         @functools.wraps(func)
         def wrap_poll(*args, **kwargs):
+            objects = state['objects']
+            if objects is not None:
+                return objects.wait(lambda: func(*args, **kwargs), notfound, repeat * interval, msg)
             iters = 1
             while iters <= repeat:
                 value = func(*args, **kwargs)
@@ -206,6 +345,71 @@ def poll(repeat=30, interval=1, notfound=None, msg='waitingggg..'):
         return wrap_poll
     return decorator_poll
 
+# Copy of BlueZ's managed objects, {path: {interface: {property: value}}},
+# taken once and then updated from the InterfacesAdded, InterfacesRemoved and
+# PropertiesChanged signals. Every update notifies cond, so waiters re-check.
+class ObjectCache:
+    def __init__(self, bus):
+        self.cond = threading.Condition()
+        self.objects = {}
+        # subscribe before the snapshot, so no change falls in between
+        bus.add_signal_receiver(self.interfaces_added, signal_name='InterfacesAdded',
+            dbus_interface='org.freedesktop.DBus.ObjectManager', bus_name=SERVICE_NAME)
+        bus.add_signal_receiver(self.interfaces_removed, signal_name='InterfacesRemoved',
+            dbus_interface='org.freedesktop.DBus.ObjectManager', bus_name=SERVICE_NAME)
+        bus.add_signal_receiver(self.properties_changed, signal_name='PropertiesChanged',
+            dbus_interface=PROPERTIES_INTERFACE, bus_name=SERVICE_NAME, path_keyword='path')
+        manager = dbus.Interface(bus.get_object(SERVICE_NAME, '/'), 'org.freedesktop.DBus.ObjectManager')
+        snapshot = manager.GetManagedObjects()
+        with self.cond:
+            for path, interfaces in snapshot.items():
+                self.objects[str(path)] = {str(i): dict(props) for i, props in interfaces.items()}
+            self.cond.notify_all()
+
+    def interfaces_added(self, path, interfaces):
+        with self.cond:
+            obj = self.objects.setdefault(str(path), {})
+            for i, props in interfaces.items():
+                obj[str(i)] = dict(props)
+            self.cond.notify_all()
+
+    def interfaces_removed(self, path, interfaces):
+        with self.cond:
+            obj = self.objects.get(str(path), {})
+            for i in interfaces:
+                obj.pop(str(i), None)
+            if not obj:
+                self.objects.pop(str(path), None)
+            self.cond.notify_all()
+
+    def properties_changed(self, interface, changed, invalidated, path=None):
+        with self.cond:
+            props = self.objects.get(str(path), {}).get(str(interface))
+            if props is None:
+                return
+            props.update(changed)
+            for name in invalidated:
+                props.pop(name, None)
+            self.cond.notify_all()
+
+    def managed_objects(self):
+        with self.cond:
+            return {path: dict(interfaces) for path, interfaces in self.objects.items()}
+
+    def wait(self, func, notfound, timeout, msg=None):
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            while True:
+                value = func()
+                if value != notfound:
+                    return value
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return notfound
+                if msg:
+                    print(msg)
+                    msg = None
+                self.cond.wait(remaining)
 
 def connect(path):
     device = get_obj(path, DEVICE_INTERFACE)
@@ -268,37 +472,70 @@ def get_obj(path, interface=DEVICE_INTERFACE):
     return dbus.Interface(obj, interface)
 
 def get_managed_objects():
+    if state['objects'] is not None:
+        return state['objects'].managed_objects()
     bus = dbus.SystemBus()
     manager = dbus.Interface(bus.get_object(SERVICE_NAME, '/'), 'org.freedesktop.DBus.ObjectManager')
     return manager.GetManagedObjects()
 
+# The commands that need the shared key, for the command line and sessions.
+def add_commands(subparsers):
+    parser_status = subparsers.add_parser('status')
+
+    parser_time = subparsers.add_parser('config_time')
+    parser_time.add_argument('--timezone', help='e.g. Europe/London')
+
+    parser_wifi = subparsers.add_parser('config_wifi')
+    parser_wifi.add_argument('--ssid', help='SSID to be used', required=True)
+    parser_wifi.add_argument('--password', help='WPA2/PSK password', required=True)
+
+    parser_capture = subparsers.add_parser('config_capture')
+    parser_capture.add_argument('--mode', help='capture mode (video/photo/live) or viewfinder', choices=['video', 'photo', 'live', 'viewfinder'])
+    parser_capture.add_argument('--rtmp_endpoint')
+    parser_capture.add_argument('--stream_name_key')
+    parser_capture.add_argument('--projection', choices=['fisheye', 'equirect'])
+    parser_capture.add_argument('--width', type=int)
+    parser_capture.add_argument('--height', type=int)
+    parser_capture.add_argument('--stereo', help='set stereo mode for viewfinder', action='store_true')
+
+    parser_start = subparsers.add_parser('start_capture')
+    parser_start.add_argument('--auto_stop', help='auto stop after x milliseconds', type=int)
+
+    parser_stop = subparsers.add_parser('stop_capture')
+    parser_capabilities = subparsers.add_parser('get_capabilities')
+    parser_reset = subparsers.add_parser('factory_reset')
+
+    return [parser_status, parser_time, parser_wifi, parser_capture, parser_start, parser_stop, parser_capabilities, parser_reset]
+
 def process_args():
     parser = argparse.ArgumentParser()
+    parser.add_argument('--crypto', help='message encryption backend', choices=CRYPTO_BACKENDS, default=crypto_backend())
+    parser.add_argument('--crypto_stats', help='print per-call crypto latency on exit', action='store_true')
+    parser.add_argument('--trace', help='write timing spans to this file (Chrome trace JSON, or JSON lines if it ends in .jsonl)', default=os.environ.get(mirage_trace.TRACE_ENV))
     subparsers = parser.add_subparsers(dest='subcommand')
 
     parser_pair = subparsers.add_parser('pair')
     parser_pair.add_argument('--key', help='the file key.pub corresponds to our public key', default='me')
     parser_pair.add_argument('--camkey', help='output file for the  camera\'s public key', default='cam')
 
-    parser_status = subparsers.add_parser('status')
-    parser_status.add_argument('--skey', help='shared encryption key file', default='me_cam.skey')
+    for p in add_commands(subparsers):
+        p.add_argument('--skey', help='shared encryption key file', default='me_cam.skey')
 
-    parser_time = subparsers.add_parser('config_time')
-    parser_time.add_argument('--skey', help='shared encryption key file', default='me_cam.skey')
+    parser_session = subparsers.add_parser('session', help='connect once and run commands from a script or stdin')
+    parser_session.add_argument('--skey', help='shared encryption key file', default='me_cam.skey')
+    parser_session.add_argument('--stop_on_error', help='stop at the first command that fails', action='store_true')
+    parser_session.add_argument('script', help='file of commands, one per line, or - for stdin', nargs='?', default='-')
 
-    parser_wifi = subparsers.add_parser('config_wifi')
-    parser_wifi.add_argument('--skey', help='shared encryption key file', default='me_cam.skey')
-    parser_wifi.add_argument('--ssid', help='SSID to be used', required=True)
-    parser_wifi.add_argument('--password', help='WPA2/PSK password', required=True)
-
-    parser_reset = subparsers.add_parser('factory_reset')
-    parser_reset.add_argument('--skey', help='shared encryption key file', default='me_cam.skey')
-    
     opts = parser.parse_args()
     if opts.subcommand is None:
         print(parser.print_help())
         sys.exit(1)
 
+    if opts.crypto == 'python' and not mirage_crypto.available():
+        print('the python crypto backend needs the cryptography package; use --crypto worker')
+        sys.exit(1)
+    mirage_api.CRYPTO = opts.crypto
+
     if hasattr(opts, 'key') and (not os.path.exists(opts.key + '.pub') or not os.path.exists(opts.key + '.salt')):
         print('Generating key...')
         genkey(opts.key)
@@ -307,6 +544,10 @@ def process_args():
         print("%s doesn't exist, pair first?" % (opts.skey,))
         sys.exit(1)
 
+    if opts.subcommand == 'session' and opts.script != '-' and not os.path.exists(opts.script):
+        print("%s doesn't exist" % (opts.script,))
+        sys.exit(1)
+
     return opts
 
 if __name__ == '__main__':
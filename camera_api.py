@@ -0,0 +1,35 @@
+# Message classes for camera_api.proto.
+#
+# Rather than executing the 4800 line camera_api_pb2.py, which constructs
+# every descriptor in Python, the classes are built from the serialized file
+# descriptor in camera_api.desc (generated from camera_api_pb2 by "make").
+# This is noticeably faster to import, and also works with protobuf versions
+# that no longer accept old-style generated modules. If the descriptor or
+# protobuf's builder module is missing, camera_api_pb2 is used instead.
+
+import os
+import sys
+
+DESC_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'camera_api.desc')
+
+def load():
+    try:
+        from google.protobuf import descriptor_pool
+        from google.protobuf.internal import builder
+        with open(DESC_FILE, 'rb') as f:
+            serialized = f.read()
+    except (ImportError, FileNotFoundError):
+        builder = None
+    # the classes must not be built twice in one process
+    if builder is None or 'camera_api_pb2' in sys.modules:
+        import camera_api_pb2
+        return {k: v for k, v in vars(camera_api_pb2).items() if not k.startswith('_')}
+    names = {'DESCRIPTOR': descriptor_pool.Default().AddSerializedFile(serialized)}
+    builder.BuildMessageAndEnumDescriptors(names['DESCRIPTOR'], names)
+    builder.BuildTopDescriptorsAndMessages(names['DESCRIPTOR'], 'camera_api_pb2', names)
+    # a later "import camera_api_pb2" would otherwise create a second,
+    # incompatible set of classes for the same messages
+    sys.modules['camera_api_pb2'] = sys.modules[__name__]
+    return {k: v for k, v in names.items() if not k.startswith('_')}
+
+globals().update(load())
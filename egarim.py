@@ -4,94 +4,281 @@
 # Before using this tool, you need to have generated the shared encryption key 
 # using bluestrap.py
 
-from mirage_api import *
-import urllib.request
 import sys
 import os
+import mirage_daemon
+
+# The global options that take a value, so that the subcommand can be told
+# apart from option values before the argument parser is built. Keep in step
+# with process_args().
+VALUE_OPTIONS = ['--host', '--port', '--skey', '--status_ttl', '--trace']
+# Subcommands never handed to the daemon: the daemon itself, and those that
+# can run for minutes or forever, since the daemon runs one command at a time.
+LOCAL_COMMANDS = ['daemon', 'get_media', 'sync_media', 'monitor', 'governor']
+
+# If "egarim.py daemon" is running, hand it the command before paying for
+# the imports below.
+if __name__ == '__main__':
+    status = mirage_daemon.forward(sys.argv[1:], VALUE_OPTIONS, LOCAL_COMMANDS)
+    if status is not None:
+        sys.exit(status)
+
+from mirage_api import *
+from mirage_http import CameraClient, http_signature
+import mirage_cache
+import mirage_trace
 import argparse
-import ssl
-import base64
-import hmac
-import shutil
-import datetime
 import json
 
-ctx = ssl.create_default_context()
-ctx.check_hostname = False
-ctx.verify_mode = ssl.CERT_NONE
+# The modules behind the other subcommands (mirage_media, mirage_fleet...) are
+# imported by their handlers, and by the functions adding their arguments, so
+# that "egarim.py status" only loads what it uses.
 
 def main(opts):
+    if opts.trace:
+        mirage_trace.enable(opts.trace)
+    if opts.subcommand == 'daemon':
+        daemon(opts)
+        return
+    if opts.subcommand == 'fleet':
+        fleet(opts)
+        return
+    if opts.subcommand == 'discover':
+        discover(opts)
+        return
+
     with open(opts.skey, 'rb') as f:
         skey = f.read()
 
+    with mirage_trace.span(opts.subcommand), CameraClient(opts.host, opts.port, skey, pool_size=getattr(opts, 'jobs', 4)) as client:
+        run(client, opts)
+
+def run(client, opts):
     if opts.subcommand == 'list_media':
-        list_media(skey, opts)
+        list_media(client, opts)
     elif opts.subcommand == 'get_media':
-        get_media(skey, opts)
+        get_media(client, opts)
     elif opts.subcommand == 'delete_media':
-        delete_media(skey, opts)
+        delete_media(client, opts)
+    elif opts.subcommand == 'sync_media':
+        sync_media(client, opts)
+    elif opts.subcommand == 'get_thumbnails':
+        get_thumbnails(client, opts)
+    elif opts.subcommand == 'monitor':
+        monitor(client, opts)
+    elif opts.subcommand == 'governor':
+        governor(client, opts)
     elif opts.subcommand == 'start_viewfinder':
-        start_viewfinder(skey, opts)
+        start_viewfinder(client, opts)
     elif opts.subcommand == 'stop_viewfinder':
-        stop_viewfinder(skey, opts)
+        stop_viewfinder(client, opts)
     elif opts.subcommand in SIMPLE_CMDS:
-        resp = simple_cmd(skey, opts, SIMPLE_CMDS[opts.subcommand])
+        resp = simple_cmd(client, opts, SIMPLE_CMDS[opts.subcommand])
         print(resp)
     else:
         print('subcommand not implemented:', opts.subcommand)
         sys.exit(1)
 
+# Serves forwarded commands, keeping a connection pool per camera and key
+# for the life of the process.
+def daemon(opts):
+    clients = {}
+
+    def connect(host, port, skey):
+        key = (host, int(port), skey)
+        client = clients.get(key)
+        if client is None:
+            client = clients[key] = CameraClient(host, port, skey)
+        return client
+
+    def command(argv):
+        o = process_args(argv)
+        if o.subcommand == 'daemon':
+            sys.exit('already running as the daemon')
+        if o.subcommand == 'fleet':
+            fleet(o, connect)
+            return
+        if o.subcommand == 'discover':
+            discover(o)
+            return
+        with open(o.skey, 'rb') as f:
+            client = connect(o.host, o.port, f.read())
+        client.pool_size = max(client.pool_size, getattr(o, 'jobs', 4))
+        # the trace covers just this command, and is written in the caller's directory
+        if o.trace:
+            mirage_trace.enable(o.trace)
+        try:
+            with mirage_trace.span(o.subcommand):
+                run(client, o)
+        finally:
+            if o.trace:
+                mirage_trace.finish()
+
+    try:
+        mirage_daemon.serve(command, opts.socket)
+    finally:
+        for client in clients.values():
+            client.close()
+
+def discover(opts):
+    import mirage_discover
+    with open(opts.skey, 'rb') as f:
+        skey = f.read()
+    found = mirage_discover.discover(skey, opts.subnet, opts.camera_port, opts.timeout, log=print if opts.debug else None)
+    if found is None:
+        print('camera not found')
+        sys.exit(1)
+    print('found camera at %s:%d' % found)
+
+# Runs one command on every camera in the inventory at once.
+def fleet(opts, connect=None):
+    import mirage_fleet
+    cameras = mirage_fleet.load_inventory(opts.inventory)
+    if opts.cameras:
+        wanted = opts.cameras.split(',')
+        cameras = [cam for cam in cameras if cam.id in wanted]
+    if not cameras:
+        sys.exit('no cameras selected')
+    # each camera's command line is parsed as if egarim.py were run for it alone
+    requests = {}
+    for cam in cameras:
+        o = process_args(['--host', cam.host, '--port', str(cam.port), '--skey', cam.skey] + opts.command)
+        if o.subcommand not in mirage_fleet.FLEET_CMDS:
+            sys.exit('fleet supports %s' % (', '.join(mirage_fleet.FLEET_CMDS),))
+        requests[cam.id] = SIMPLE_CMDS[o.subcommand](o)
+    sync = o.subcommand in mirage_fleet.SYNC_CMDS
+
+    with mirage_fleet.Fleet(cameras, connect) as f:
+        if sync and opts.clock_samples > 0:
+            results = f.call_at(requests, opts.clock_samples)
+        else:
+            results = f.call(requests, sync=sync)
+        if o.subcommand == 'start_capture':
+            f.recording_starts(results, max(opts.clock_samples, 1))
+    first = min([r.started for r in results.values() if r.started is not None], default=None)
+    for cam in cameras:
+        r = results[cam.id]
+        if r.error is not None:
+            print('%s error: %s' % (cam.id, r.error))
+            continue
+        line = '%s %s %.1f ms' % (cam.id, CameraApiResponse.ResponseStatus.StatusCode.Name(r.response.response_status.status_code), r.latency * 1000)
+        if r.clock is not None:
+            line += ', clock offset %+.1f ms, rtt %.1f ms' % (r.clock.offset * 1000, r.clock.rtt * 1000)
+        if r.started is not None:
+            line += ', started +%.1f ms' % ((r.started - first) * 1000,)
+        print(line)
+        if opts.debug or not sync and o.subcommand != 'config_capture':
+            print(r.response)
+    if sync:
+        print('dispatch spread %.2f ms' % (mirage_fleet.dispatch_spread(results) * 1000,))
+    skew = mirage_fleet.start_skew(results)
+    if skew is not None:
+        print('start skew %.1f ms' % (skew * 1000,))
+    if not all(r.ok() for r in results.values()):
+        sys.exit(1)
+
+# req is a urllib.request.Request
 def sign(req, skey):
-    h = hmac.new(skey, digestmod='sha256')
-    h.update(req.method.encode('utf-8'))
-    h.update(req.selector.encode('utf-8'))
-    if req.data:
-        h.update(req.data)
-    auth = base64.urlsafe_b64encode(h.digest()).decode('ascii')
-    return auth
-    
-def simple_cmd(skey, opts, request):
-    headers = {
-        'Content-Type': 'application/octet-stream'
-    }
-    r = request(opts)
+    return http_signature(skey, req.method, req.selector, req.data)
+
+def simple_cmd(client, opts, request):
+    with mirage_trace.span('build_request'):
+        r = request(opts)
     if opts.debug:
         print('request', r)
-    data = r.SerializeToString()
-    req = urllib.request.Request('https://%s:%s/daydreamcamera' % (opts.host, opts.port), data=data, headers=headers, method='POST')
-    signature = sign(req, skey)
-    req.add_header('Authorization', 'daydreamcamera ' + signature)
-    with urllib.request.urlopen(req, context=ctx) as f:
-        data = f.read()
-        return parse_response(data)
-
-def list_media(skey, opts):
-    resp = simple_cmd(skey, opts, SIMPLE_CMDS[opts.subcommand])
+    return client.call(r)
+
+def list_media(client, opts):
+    resp = simple_cmd(client, opts, SIMPLE_CMDS[opts.subcommand])
     if opts.debug:
         print(resp)
     for item in resp.media.media:
         print('%s %d %d %d %d' % (item.filename, item.size, item.duration, item.width, item.height))
 
-def get_media(skey, opts):
-    req = urllib.request.Request('https://%s:%s/media/%s' % (opts.host, opts.port, opts.path), method='GET')
-    signature = sign(req, skey)
-    req.add_header('Authorization', 'daydreamcamera ' + signature)
+def get_media(client, opts):
+    import mirage_media
     outfile = os.path.join(opts.dest, os.path.basename(opts.path))
     print('copying ', opts.path)
-    with urllib.request.urlopen(req, context=ctx) as f, open(outfile, 'wb') as out:
-        shutil.copyfileobj(f, out)
-        
-def delete_media(skey, opts):
-    req = urllib.request.Request('https://%s:%s/media/%s' % (opts.host, opts.port, opts.path), method='DELETE')
-    signature = sign(req, skey)
-    req.add_header('Authorization', 'daydreamcamera ' + signature)
-    print('deleting ', opts.path)
-    with urllib.request.urlopen(req, context=ctx) as f:
-        data = f.read()
-
-def start_viewfinder(skey, opts):
+    stats = mirage_media.TransferStats()
+    with client.open_media(opts.path) as f, open(outfile, 'wb') as out:
+        mirage_media.copy_body(f, out, bufsize=opts.buffer_size * 1024, fsync=opts.fsync, stats=stats)
+    print(stats.summary())
+
+def delete_media(client, opts):
+    import mirage_media
+    if len(opts.path) == 1 and not opts.all:
+        print('deleting ', opts.path[0])
+        client.delete_media(opts.path[0])
+        return
+    # several files go in batched DELETE_MEDIA requests; with --all, the
+    # checksums from the listing make sure only what was listed is deleted
+    if opts.all:
+        items = [(m.filename, mirage_media.media_sha1(m)) for m in mirage_media.list_all_media(client)]
+    else:
+        items = [(path, None) for path in opts.path]
+    statuses = mirage_media.delete_batch(client, items, opts.batch_size)
+    for name, code in statuses.items():
+        print(name, code)
+    if any(code != 'OK' for code in statuses.values()):
+        sys.exit(1)
+
+def sync_media(client, opts):
+    import mirage_media
+    stats = mirage_media.TransferStats()
+    results = mirage_media.sync_media(client, opts.dest, jobs=opts.jobs, page_size=opts.page_size,
+        delete=opts.delete, batch_size=opts.batch_size, bufsize=opts.buffer_size * 1024, fsync=opts.fsync, stats=stats)
+    failed = [name for name, result in results.items() if isinstance(result, Exception)]
+    done = [result for result in results.values() if not isinstance(result, Exception)]
+    print('%d files, %d copied, %d deleted, %d failed' % (len(results), sum(r.startswith('copied') for r in done),
+        sum(r.endswith('/deleted') for r in done), len(failed)))
+    print(stats.summary())
+    if failed:
+        sys.exit(1)
+
+def get_thumbnails(client, opts):
+    import mirage_media
+    import mirage_thumbs
+    medias = list(mirage_media.list_all_media(client))
+    if opts.path:
+        wanted = set(opts.path)
+        medias = [m for m in medias if m.filename in wanted]
+    cache = mirage_thumbs.ThumbnailCache(opts.cache, opts.cache_size * 1024 * 1024)
+    results = mirage_thumbs.fetch_thumbnails(client, medias, cache, opts.width, opts.height, opts.quality, batch=opts.batch_size)
+    os.makedirs(opts.dest, exist_ok=True)
+    failed = 0
+    for name, data in results.items():
+        if isinstance(data, Exception):
+            print(name, data)
+            failed += 1
+            continue
+        outfile = os.path.join(opts.dest, os.path.basename(name) + mirage_thumbs.thumbnail_extension(data))
+        with open(outfile, 'wb') as f:
+            f.write(data)
+        print(name, outfile)
+    if failed:
+        sys.exit(1)
+
+def monitor(client, opts):
+    import mirage_monitor
+    try:
+        mirage_monitor.monitor(client, opts.interval, opts.count, opts.ignore,
+            out=None if opts.quiet else sys.stdout, prometheus=opts.prometheus)
+    except KeyboardInterrupt:
+        pass
+
+def governor(client, opts):
+    import mirage_governor
+    try:
+        mirage_governor.govern(client, opts, opts.interval, opts.count, opts.restart,
+            min_height=opts.min_height, max_height=opts.max_height,
+            down_polls=opts.down_polls, up_polls=opts.up_polls,
+            down_cooldown=opts.down_cooldown, up_cooldown=opts.up_cooldown)
+    except KeyboardInterrupt:
+        pass
+
+def start_viewfinder(client, opts):
     opts.sdp = sys.stdin.read()
-    resp = simple_cmd(skey, opts, SIMPLE_CMDS[opts.subcommand])
+    resp = simple_cmd(client, opts, SIMPLE_CMDS[opts.subcommand])
     out = {}
     if resp.response_status.status_code != CameraApiResponse.ResponseStatus.OK:
         out['error'] = 'Camera API error'
@@ -101,8 +288,8 @@ def start_viewfinder(skey, opts):
         out['ice'] = ice
     print(json.dumps(out))
 
-def stop_viewfinder(skey, opts):
-    resp = simple_cmd(skey, opts, SIMPLE_CMDS[opts.subcommand])
+def stop_viewfinder(client, opts):
+    resp = simple_cmd(client, opts, SIMPLE_CMDS[opts.subcommand])
     out = {}
     if resp.response_status.status_code != CameraApiResponse.ResponseStatus.OK:
         out['error'] = 'Camera API error'
@@ -110,23 +297,7 @@ def stop_viewfinder(skey, opts):
         out['response'] = str(resp)
     print(json.dumps(out))
 
-def process_args():
-    parser = argparse.ArgumentParser()
-    parser.add_argument('--host', help='camera hostname/IP')
-    parser.add_argument('--port', help='camera https port', default=8443)
-    parser.add_argument('--debug', help='verbose debugging', action='store_true')
-    parser.add_argument('--skey', help='shared encryption key file', default='me_cam.skey')
-
-    subparsers = parser.add_subparsers(dest='subcommand', title='Subcommands')
-
-    subparsers.add_parser('status')
-    subparsers.add_parser('get_capabilities')
-    subparsers.add_parser('factory_reset')
-    subparsers.add_parser('get_st3dbox')
-    subparsers.add_parser('get_sv3dbox')
-
-    
-    capture = subparsers.add_parser('config_capture')
+def config_capture_args(capture):
     capture.add_argument('--mode', help='capture mode (video/photo/live) or viewfinder', choices=['video', 'photo', 'live', 'viewfinder'])
     capture.add_argument('--rtmp_endpoint')
     capture.add_argument('--stream_name_key')
@@ -135,47 +306,193 @@ def process_args():
     capture.add_argument('--height', type=int)
     capture.add_argument('--stereo', help='set stereo mode for viewfinder', action='store_true')
 
-
-    start_capture = subparsers.add_parser('start_capture')
+def start_capture_args(start_capture):
     start_capture.add_argument('--auto_stop', help='auto stop after x milliseconds', type=int)
 
-    subparsers.add_parser('stop_capture')
-
-    subparsers.add_parser('start_viewfinder')
-    subparsers.add_parser('stop_viewfinder')
-
-    get_debug_logs = subparsers.add_parser('get_debug_logs')
+def get_debug_logs_args(get_debug_logs):
     get_debug_logs.add_argument('--count', type=int, default=100)
 
-    list_media = subparsers.add_parser('list_media')
+def list_media_args(list_media):
     list_media.add_argument('--start', type=int)
     list_media.add_argument('--count', type=int, default=100)
 
-    get_media = subparsers.add_parser('get_media')
+def get_media_args(get_media):
+    import mirage_media
     get_media.add_argument('--dest', default='.')
+    get_media.add_argument('--buffer_size', help='read buffer size in KB', type=int, default=mirage_media.COPY_BUFSIZE // 1024)
+    get_media.add_argument('--fsync', help='flush the file to disk before returning', action='store_true')
     get_media.add_argument('path')
 
-    delete_media = subparsers.add_parser('delete_media')
-    delete_media.add_argument('path')
+def get_thumbnails_args(get_thumbnails):
+    import mirage_thumbs
+    get_thumbnails.add_argument('--dest', default='.')
+    get_thumbnails.add_argument('--width', type=int)
+    get_thumbnails.add_argument('--height', type=int)
+    get_thumbnails.add_argument('--quality', help='encoder quality level', type=int)
+    get_thumbnails.add_argument('--batch_size', help='thumbnails per request', type=int, default=mirage_thumbs.THUMB_BATCH)
+    get_thumbnails.add_argument('--cache', help='thumbnail cache directory', default=mirage_thumbs.CACHE_DIR)
+    get_thumbnails.add_argument('--cache_size', help='thumbnail cache size in MB', type=int, default=mirage_thumbs.CACHE_BYTES // (1024 * 1024))
+    get_thumbnails.add_argument('path', nargs='*')
+
+def delete_media_args(delete_media):
+    import mirage_media
+    delete_media.add_argument('--all', help='delete all media on the camera', action='store_true')
+    delete_media.add_argument('--batch_size', help='files per delete request', type=int, default=mirage_media.DELETE_BATCH)
+    delete_media.add_argument('path', nargs='*')
+
+def sync_media_args(sync_media):
+    import mirage_media
+    sync_media.add_argument('--dest', default='.')
+    sync_media.add_argument('--jobs', help='concurrent downloads', type=int, default=4)
+    sync_media.add_argument('--page_size', help='media items per list_media request', type=int, default=100)
+    sync_media.add_argument('--delete', help='delete each file from the camera once its download is verified', action='store_true')
+    sync_media.add_argument('--batch_size', help='files per delete request', type=int, default=mirage_media.DELETE_BATCH)
+    sync_media.add_argument('--buffer_size', help='read buffer size in KB, per download', type=int, default=mirage_media.COPY_BUFSIZE // 1024)
+    sync_media.add_argument('--fsync', help='flush each file to disk before it is marked done (and deleted, with --delete)', action='store_true')
+
+def monitor_args(monitor):
+    import mirage_monitor
+    monitor.add_argument('--interval', help='seconds between polls', type=float, default=1.0)
+    monitor.add_argument('--count', help='stop after this many polls (0 for no limit)', type=int, default=0)
+    monitor.add_argument('--ignore', help='status fields to leave out (and their subfields)', nargs='*', default=mirage_monitor.DEFAULT_IGNORE)
+    monitor.add_argument('--prometheus', help='write the latest status to this Prometheus text file after each poll')
+    monitor.add_argument('--quiet', help='don\'t print JSON lines', action='store_true')
+
+def governor_args(governor):
+    import mirage_governor
+    governor.add_argument('--interval', help='seconds between status polls', type=float, default=2.0)
+    governor.add_argument('--count', help='stop after this many polls (0 for no limit)', type=int, default=0)
+    governor.add_argument('--min_height', help='smallest frame height to step down to', type=int)
+    governor.add_argument('--max_height', help='largest frame height to step up to', type=int)
+    governor.add_argument('--down_polls', help='bad polls in a row before stepping down', type=int, default=mirage_governor.DOWN_POLLS)
+    governor.add_argument('--up_polls', help='good polls in a row before stepping up', type=int, default=mirage_governor.UP_POLLS)
+    governor.add_argument('--down_cooldown', help='seconds after a change before stepping down', type=float, default=mirage_governor.DOWN_COOLDOWN)
+    governor.add_argument('--up_cooldown', help='seconds after a change before stepping up', type=float, default=mirage_governor.UP_COOLDOWN)
+    governor.add_argument('--restart', help='stop and restart the stream around each change', action='store_true')
+    governor.add_argument('--rtmp_endpoint', help='sent again with each change')
+    governor.add_argument('--stream_name_key', help='sent again with each change')
+    governor.add_argument('--projection', choices=['fisheye', 'equirect'])
+
+def discover_args(discover):
+    import mirage_discover
+    discover.add_argument('--subnet', help='networks to search (default: the local /24)', nargs='*')
+    discover.add_argument('--camera_port', help='camera https port (default: the cached one, or 8443)', type=int)
+    discover.add_argument('--timeout', help='seconds to wait for connections', type=float, default=mirage_discover.PROBE_TIMEOUT)
 
-    opts = parser.parse_args()
+def fleet_args(fleet):
+    import mirage_fleet
+    fleet.add_argument('--inventory', help='JSON file listing camera ids, hosts and key files', default='fleet.json')
+    fleet.add_argument('--cameras', help='comma separated camera ids to use instead of all')
+    fleet.add_argument('--clock_samples', help='status requests per camera to estimate clock offset and latency before start/stop (0 to just release them together)',
+        type=int, default=mirage_fleet.CLOCK_SAMPLES)
+    fleet.add_argument('command', help=', '.join(mirage_fleet.FLEET_CMDS) + ' and their arguments', nargs=argparse.REMAINDER)
+
+def daemon_args(daemon):
+    daemon.add_argument('--socket', help='unix socket to listen on', default=mirage_daemon.SOCKET_PATH)
+
+# Subcommand -> (help, function adding its arguments). Only the subcommand
+# being run gets its arguments.
+SUBCOMMANDS = {
+    'status': (None, None),
+    'get_capabilities': (None, None),
+    'factory_reset': (None, None),
+    'get_st3dbox': (None, None),
+    'get_sv3dbox': (None, None),
+    'config_capture': (None, config_capture_args),
+    'start_capture': (None, start_capture_args),
+    'stop_capture': (None, None),
+    'start_viewfinder': (None, None),
+    'stop_viewfinder': (None, None),
+    'get_debug_logs': (None, get_debug_logs_args),
+    'list_media': (None, list_media_args),
+    'get_media': (None, get_media_args),
+    'get_thumbnails': ('fetch thumbnails of all (or the given) media', get_thumbnails_args),
+    'delete_media': (None, delete_media_args),
+    'sync_media': ('download all media not already in dest', sync_media_args),
+    'monitor': ('poll status and print changed fields as JSON lines', monitor_args),
+    'governor': ('adapt the live stream frame size to the upload bandwidth', governor_args),
+    'discover': ('find the camera on the local network and update the cached address', discover_args),
+    'fleet': ('run a command on every camera in an inventory file', fleet_args),
+    'daemon': ('keep keys and connections open and serve other egarim.py commands', daemon_args),
+}
+
+def process_args(argv=None):
+    # options that take a value also go in VALUE_OPTIONS
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', help='camera hostname/IP')
+    parser.add_argument('--port', help='camera https port', default=8443)
+    parser.add_argument('--debug', help='verbose debugging', action='store_true')
+    parser.add_argument('--skey', help='shared encryption key file', default='me_cam.skey')
+    parser.add_argument('--status_ttl', help='refuse a cached camera address older than this many seconds (0 for no limit)', type=int, default=0)
+    parser.add_argument('--discover', help='if the cached camera address doesn\'t answer, search the local network for the camera', action='store_true')
+    parser.add_argument('--no_daemon', help='run the command here even if "egarim.py daemon" is running', action='store_true')
+    parser.add_argument('--trace', help='write timing spans to this file (Chrome trace JSON, or JSON lines if it ends in .jsonl)', default=os.environ.get(mirage_trace.TRACE_ENV))
+
+    subparsers = parser.add_subparsers(dest='subcommand', title='Subcommands')
+    for name, (help, add_args) in SUBCOMMANDS.items():
+        if help is None:
+            subparsers.add_parser(name, add_help=False)
+        else:
+            subparsers.add_parser(name, help=help, add_help=False)
+
+    # find the subcommand first, then set up its arguments (and -h) alone
+    # and parse again
+    first, rest = parser.parse_known_args(argv)
+    if first.subcommand is not None:
+        sub = subparsers.choices[first.subcommand]
+        sub.add_argument('-h', '--help', action='help', help='show this help message and exit')
+        add_args = SUBCOMMANDS[first.subcommand][1]
+        if add_args:
+            add_args(sub)
+
+    opts = parser.parse_args(argv)
     if opts.subcommand is None:
         print(parser.print_help())
         sys.exit(1)
 
+    if opts.subcommand == 'delete_media' and not opts.path and not opts.all:
+        subparsers.choices['delete_media'].error('no files to delete; give paths or --all')
+
+    if opts.subcommand == 'fleet' and not opts.command:
+        subparsers.choices['fleet'].error('no command given')
+
+    if opts.subcommand in ('daemon', 'fleet'):
+        return opts
+
     if not os.path.exists(opts.skey):
         print('%s doesn\'t exist; pair using btmirage.py to generate the shared encryption key' % (opts.skey,))
         sys.exit(1)
 
+    if opts.subcommand == 'discover':
+        return opts
+
     if not opts.host:
-        status_file = os.path.join(os.path.expanduser('~'), '.egarim-status')
-        if not os.path.exists(status_file):
-            print('no host specified and no status file; run "python bluestrap.py status" to retrieve camera IP')
-            sys.exit(1)
-        with open(status_file, 'r') as f:
-            status = json.loads(f.read())
-            opts.host = status['cameraStatus']['httpServerStatus']['cameraHostname'][0]
-            opts.port = status['cameraStatus']['httpServerStatus']['cameraPort']
+        with open(opts.skey, 'rb') as f:
+            skey = f.read()
+        cached = mirage_cache.read(skey)
+        if opts.discover:
+            import mirage_discover
+        if cached is not None and cached.host and opts.discover and not mirage_discover.probe([cached.host], cached.port):
+            if not mirage_discover.discover(skey):
+                print('camera not at %s and not found on the local network' % (cached.host,))
+                sys.exit(1)
+            cached = mirage_cache.read(skey)
+        if cached is not None and cached.host:
+            if not cached.fresh(opts.status_ttl):
+                print('cached status for this camera is %d s old (--status_ttl %d); run "python bluestrap.py status" to refresh it' % (cached.age(), opts.status_ttl))
+                sys.exit(1)
+            opts.host = cached.host
+            opts.port = cached.port
+        else:
+            # written by older versions of bluestrap.py
+            status_file = os.path.join(os.path.expanduser('~'), '.egarim-status')
+            if not os.path.exists(status_file):
+                print('no host specified and no cached status; run "python bluestrap.py status" to retrieve camera IP')
+                sys.exit(1)
+            with open(status_file, 'r') as f:
+                status = json.loads(f.read())
+                opts.host = status['cameraStatus']['httpServerStatus']['cameraHostname'][0]
+                opts.port = status['cameraStatus']['httpServerStatus']['cameraPort']
 
     return opts
 
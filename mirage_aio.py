@@ -0,0 +1,230 @@
+# asyncio client for the camera HTTP API, for services that control the
+# camera from an event loop and can't block in CameraClient.
+#
+# Requests are signed exactly as by CameraClient, and take the same request
+# messages (mirage_api.SIMPLE_CMDS and friends). Each request in flight gets
+# its own keep-alive connection from a small pool, so requests can run
+# concurrently. Every call takes a timeout, a deadline for the whole request
+# and response, and a cancelled or timed out request closes its connection
+# rather than returning it to the pool.
+#
+#   client = AsyncCameraClient('192.168.1.44', 8443, skey)
+#   resp = await client.call(status_request(None), timeout=5)
+#   async for chunk in client.media_chunks(path):
+#       ...
+#   await client.close()
+#
+# Only the parts of HTTP/1.1 the camera uses are implemented: Content-Length
+# and chunked bodies, or a body running to the end of the connection.
+
+import asyncio
+import contextlib
+from mirage_api import parse_response
+from mirage_http import API_PATH, ctx, http_signature, media_selector
+
+CHUNK_SIZE = 64 * 1024
+MAX_HEADER_LINES = 100
+
+# The connection was gone before the request could be sent, or closed without
+# a byte of response: the camera can't have acted on the request, so it is
+# safe to send again on another connection.
+class StaleConnection(ConnectionResetError):
+    pass
+
+class AsyncResponse:
+    def __init__(self, conn, status, reason, headers):
+        self.conn = conn
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.keep_alive = headers.get('connection', '').lower() != 'close'
+        self.chunked = 'chunked' in headers.get('transfer-encoding', '').lower()
+        length = headers.get('content-length')
+        self.remaining = int(length) if length is not None and not self.chunked else None
+        # bytes left in the current chunk of a chunked body
+        self.chunk_left = 0
+        self.done = self.remaining == 0
+
+    # Returns up to size bytes of body, or b'' at the end.
+    async def read_chunk(self, size=CHUNK_SIZE):
+        if self.done:
+            return b''
+        reader = self.conn.reader
+        if self.chunked:
+            if self.chunk_left == 0:
+                line = await reader.readline()
+                self.chunk_left = int(line.split(b';')[0], 16)
+                if self.chunk_left == 0:
+                    # trailers, up to the blank line
+                    while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                        pass
+                    self.done = True
+                    return b''
+            data = await reader.readexactly(min(size, self.chunk_left))
+            self.chunk_left -= len(data)
+            if self.chunk_left == 0:
+                await reader.readexactly(2)
+            return data
+        if self.remaining is None:
+            data = await reader.read(size)
+            if not data:
+                self.done = True
+                self.keep_alive = False
+            return data
+        data = await reader.readexactly(min(size, self.remaining))
+        self.remaining -= len(data)
+        self.done = self.remaining == 0
+        return data
+
+    async def read(self):
+        parts = []
+        while True:
+            data = await self.read_chunk()
+            if not data:
+                return b''.join(parts)
+            parts.append(data)
+
+class AsyncConnection:
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+
+    def close(self):
+        self.writer.close()
+
+class AsyncCameraClient:
+    def __init__(self, host, port, skey, pool_size=4, timeout=30):
+        self.host = host
+        self.port = int(port)
+        self.skey = skey
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.idle = []
+        self.stats = {'requests': 0, 'connects': 0, 'reused': 0, 'retries': 0}
+
+    async def connect(self):
+        reader, writer = await asyncio.open_connection(self.host, self.port, ssl=ctx, server_hostname=self.host)
+        self.stats['connects'] += 1
+        return AsyncConnection(reader, writer)
+
+    def release(self, conn):
+        if len(self.idle) < self.pool_size:
+            self.idle.append(conn)
+        else:
+            conn.close()
+
+    async def close(self):
+        idle, self.idle = self.idle, []
+        for conn in idle:
+            conn.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def exchange(self, conn, method, selector, body, headers):
+        lines = ['%s %s HTTP/1.1' % (method, selector), 'Host: %s:%d' % (self.host, self.port)]
+        lines += ['%s: %s' % item for item in headers.items()]
+        lines.append('Content-Length: %d' % (len(body) if body else 0,))
+        try:
+            conn.writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + (body or b''))
+            await conn.writer.drain()
+        except ConnectionError as e:
+            raise StaleConnection('camera closed the connection: %s' % (e,))
+
+        status_line = await conn.reader.readline()
+        if not status_line:
+            raise StaleConnection('camera closed the connection')
+        version, status, reason = (status_line.decode('latin-1').rstrip('\r\n').split(' ', 2) + [''])[:3]
+        if not version.startswith('HTTP/'):
+            raise Exception('bad HTTP status line: %r' % (status_line,))
+        resp_headers = {}
+        for i in range(MAX_HEADER_LINES):
+            line = await conn.reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                resp = AsyncResponse(conn, int(status), reason, resp_headers)
+                if method == 'HEAD' or resp.status in (204, 304):
+                    resp.done = True
+                return resp
+            name, _, value = line.decode('latin-1').partition(':')
+            resp_headers[name.strip().lower()] = value.strip()
+        raise Exception('too many HTTP headers')
+
+    async def send(self, method, selector, body=None, headers=None):
+        headers = dict(headers or {})
+        headers['Authorization'] = 'daydreamcamera ' + http_signature(self.skey, method, selector, body)
+        self.stats['requests'] += 1
+        while True:
+            reused = bool(self.idle)
+            conn = self.idle.pop() if reused else await self.connect()
+            try:
+                resp = await self.exchange(conn, method, selector, body, headers)
+            except StaleConnection:
+                conn.close()
+                if not reused:
+                    raise
+                # the camera closed an idle keep-alive connection; anything
+                # else may come after the camera ran the command, so it isn't
+                # sent twice
+                self.stats['retries'] += 1
+                continue
+            except BaseException:
+                conn.close()
+                raise
+            if reused:
+                self.stats['reused'] += 1
+            return resp
+
+    # Async context manager yielding the AsyncResponse. The connection is
+    # returned to the pool if the body was read to the end, and closed
+    # otherwise, including on timeout or cancellation.
+    @contextlib.asynccontextmanager
+    async def open(self, method, selector, body=None, headers=None, timeout=None):
+        resp = await asyncio.wait_for(self.send(method, selector, body, headers), timeout or self.timeout)
+        try:
+            if resp.status // 100 != 2:
+                await asyncio.wait_for(resp.read(), timeout or self.timeout)
+                raise Exception('HTTP error %d %s: %s %s' % (resp.status, resp.reason, method, selector))
+            yield resp
+        finally:
+            if resp.done and resp.keep_alive:
+                self.release(resp.conn)
+            else:
+                resp.conn.close()
+
+    # Sends a request and returns the whole response body, with no timeout of
+    # its own: callers put one deadline around all of it.
+    async def request(self, method, selector, body=None, headers=None):
+        resp = await self.send(method, selector, body, headers)
+        try:
+            data = await resp.read()
+        finally:
+            if resp.done and resp.keep_alive:
+                self.release(resp.conn)
+            else:
+                resp.conn.close()
+        if resp.status // 100 != 2:
+            raise Exception('HTTP error %d %s: %s %s' % (resp.status, resp.reason, method, selector))
+        return data
+
+    async def call(self, req, timeout=None):
+        data = req.SerializeToString()
+        data = await asyncio.wait_for(self.request('POST', API_PATH, data, {'Content-Type': 'application/octet-stream'}),
+            timeout or self.timeout)
+        return parse_response(data)
+
+    # Yields the media file in chunks of up to chunk_size bytes; timeout
+    # applies to the request and to each chunk. If the loop stops early, the
+    # connection is closed when the generator is (see contextlib.aclosing).
+    async def media_chunks(self, path, chunk_size=CHUNK_SIZE, headers=None, timeout=None):
+        async with self.open('GET', media_selector(path), headers=headers, timeout=timeout) as resp:
+            while True:
+                data = await asyncio.wait_for(resp.read_chunk(chunk_size), timeout or self.timeout)
+                if not data:
+                    return
+                yield data
+
+    async def delete_media(self, path, timeout=None):
+        return await asyncio.wait_for(self.request('DELETE', media_selector(path)), timeout or self.timeout)
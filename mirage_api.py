@@ -1,50 +1,236 @@
 import datetime
-from camera_api_pb2 import *
+from camera_api import *
 import subprocess
 import io
+import os
 import json
+import struct
+import threading
+import functools
+import atexit
+import time
+import mirage_crypto
+import mirage_trace
 
 JMIRAGE = "java -cp . MirageCrypto "
+# Backend for Bluetooth message encryption: 'python' (in-process AES-GCM, needs
+# the cryptography package), 'worker' (one long-lived MirageCrypto JVM) or
+# 'java' (one MirageCrypto JVM per message). Defaults to 'python' if available,
+# decided on first use so that HTTP-only callers don't pay for the check.
+CRYPTO = os.environ.get('EGARIM_CRYPTO')
+CRYPTO_BACKENDS = ['python', 'worker', 'java']
 counter = 2000
 
+# Per-call crypto latencies in seconds, keyed by (backend, operation)
+crypto_stats = {}
+
 # The camera uses \x00\x00 as an end-of-message marker for Bluetooth messages.
 # These need to be escaped and encoded/decoded before applying encryption/decryption.
 
+# A \x01 is inserted after any \x00 that is followed by \x00 or \x01, so \x00\x00
+# never appears inside an encoded message. bytes.replace() doesn't handle
+# overlapping matches, so runs of zeros take a second pass.
+EOM = b'\x00\x00'
+
 def mm_encode(msg):
-    out = b''
-    for i in range(len(msg)):
-        if i > 0 and msg[i - 1] == 0 and (msg[i] == 0 or msg[i] == 1):
-            out += b'\x01'
-        out += msg[i:i+1]
-    out += b'\x00\x00'
-    return out
+    out = bytes(msg).replace(b'\x00\x01', b'\x00\x01\x01')
+    while EOM in out:
+        out = out.replace(b'\x00\x00', b'\x00\x01\x00')
+    return out + EOM
 
 def mm_decode(msg):
     if len(msg) < 2 or msg[-1] != 0 or msg[-2] != 0:
         raise Exception('no EOM marker found')
-    out = b''
-    for i in range(len(msg) - 2):
-        if i > 0 and msg[i - 1] == 0 and msg[i] == 1:
-            continue
-        out += msg[i:i+1]
-    return out
+    return bytes(msg[:-2]).replace(b'\x00\x01', b'\x00')
+
+# Incremental decoder for messages arriving in pieces (e.g. one BLE notification
+# at a time). feed() returns the list of messages completed by the chunk.
+# Fragments are collected in a preallocated buffer which only grows (doubling)
+# for messages larger than it, and the EOM search resumes where it left off.
+#
+# A message ending in \x00 is encoded as ...\x00\x00\x00, so a chunk ending in
+# \x00\x00 may be a complete message, or one whose last \x00 is still to come.
+# Such a message is held back until the next chunk decides it; flush() gives
+# it up as complete, for when the sender is known to have finished (e.g. the
+# chunk was shorter than a full notification). As with mm_decode on a whole
+# stream, messages are assumed never to be empty or start with \x00, which
+# protobufs and encrypted frames don't.
+
+class MMDecoder:
+    def __init__(self, size=4096):
+        self.buf = bytearray(size)
+        self.len = 0
+        self.scan = 0
+        # end of the EOM of a message held back, or None
+        self.held = None
+
+    def feed(self, chunk):
+        n = len(chunk)
+        if self.len + n > len(self.buf):
+            size = len(self.buf) or 1
+            while size < self.len + n:
+                size *= 2
+            self.buf.extend(bytes(size - len(self.buf)))
+        self.buf[self.len:self.len + n] = chunk
+        self.len += n
+        msgs = []
+        if self.held is not None and n:
+            end, self.held = self.held, None
+            if self.buf[end] == 0:
+                end += 1
+            msgs.append(self.take(end))
+        while True:
+            end = self.buf.find(EOM, self.scan, self.len)
+            if end < 0:
+                self.scan = max(self.len - 1, 0)
+                return msgs
+            end += 2
+            if end == self.len:
+                self.held = end
+                return msgs
+            if self.buf[end] == 0:
+                end += 1
+            msgs.append(self.take(end))
+
+    def pending(self):
+        return self.held is not None
+
+    # Returns the message held back, if any, taking its EOM as complete.
+    def flush(self):
+        if self.held is None:
+            return []
+        end, self.held = self.held, None
+        return [self.take(end)]
+
+    # Decodes the first end bytes and drops them, moving the remainder to the
+    # start of the buffer
+    def take(self, end):
+        with memoryview(self.buf) as view:
+            msg = mm_decode(view[:end])
+        rest = self.len - end
+        self.buf[:rest] = self.buf[end:self.len]
+        self.len = rest
+        self.scan = 0
+        return msg
+
+# A single MirageCrypto JVM running in "serve" mode, so that JVM startup and
+# class loading are paid once per process instead of once per message. Calls
+# are serialised over the worker's stdin/stdout; if the worker dies it is
+# restarted and the call retried once.
+
+class CryptoWorker:
+    def __init__(self, cmd=JMIRAGE + "serve"):
+        self.cmd = cmd
+        self.proc = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        self.proc = subprocess.Popen(self.cmd, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    def stop(self):
+        if self.proc is None:
+            return
+        try:
+            self.proc.stdin.close()
+            self.proc.wait(timeout=5)
+        except Exception:
+            self.proc.kill()
+        self.proc = None
+
+    def call(self, op, arg, data=b''):
+        with self.lock:
+            for attempt in range(2):
+                if self.proc is None or self.proc.poll() is not None:
+                    self.start()
+                try:
+                    status, result = self.roundtrip(op, arg.encode('utf-8'), data)
+                    break
+                except (BrokenPipeError, EOFError):
+                    self.stop()
+                    if attempt:
+                        raise Exception('crypto worker died')
+        if status != 0:
+            raise Exception('crypto worker error: ' + result.decode('utf-8', 'replace'))
+        return result
+
+    def roundtrip(self, op, arg, data):
+        stdin, stdout = self.proc.stdin, self.proc.stdout
+        stdin.write(op + struct.pack('>I', len(arg)) + arg + struct.pack('>I', len(data)))
+        stdin.write(data)
+        stdin.flush()
+        header = stdout.read(5)
+        if len(header) < 5:
+            raise EOFError()
+        status, length = struct.unpack('>BI', header)
+        result = stdout.read(length)
+        if len(result) < length:
+            raise EOFError()
+        return status, result
+
+worker = None
+
+def get_worker():
+    global worker
+    if worker is None:
+        worker = CryptoWorker()
+        atexit.register(worker.stop)
+    return worker
+
+def crypto_backend():
+    global CRYPTO
+    if CRYPTO is None:
+        CRYPTO = 'python' if mirage_crypto.available() else 'worker'
+    return CRYPTO
+
+def timed(op):
+    def decorator_timed(func):
+        @functools.wraps(func)
+        def wrap_timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                crypto_stats.setdefault((crypto_backend(), op), []).append(time.perf_counter() - start)
+        return wrap_timed
+    return decorator_timed
+
+def print_crypto_stats():
+    for (backend, op), times in sorted(crypto_stats.items()):
+        print('crypto %s %s: %d calls, mean %.1f ms, min %.1f ms, max %.1f ms' % (backend, op, len(times),
+            sum(times) * 1000 / len(times), min(times) * 1000, max(times) * 1000))
 
 # Bluetooth messages (other than key initiate/finalize) are encrypted by the shared key
 
+@mirage_trace.traced('encrypt')
+@timed('encrypt')
 def encrypt(msg, key):
+    if crypto_backend() == 'python':
+        return mirage_crypto.encrypt(msg, key)
+    if crypto_backend() == 'worker':
+        return get_worker().call(b'e', key, msg)
     return subprocess.check_output(JMIRAGE + " encrypt " + key, input=msg, shell=True)
 
+@mirage_trace.traced('decrypt')
+@timed('decrypt')
 def decrypt(msg, key):
+    if crypto_backend() == 'python':
+        return mirage_crypto.decrypt(msg, key)
+    if crypto_backend() == 'worker':
+        return get_worker().call(b'd', key, msg)
     return subprocess.check_output(JMIRAGE + " decrypt " + key, input=msg, shell=True)
 
 # Generate shared key from the ECDH public key of the camera + our key
+@timed('genshared')
 def genshared(me, cam):
+    if crypto_backend() == 'worker':
+        return get_worker().call(b'g', me, cam.encode('utf-8'))
     return subprocess.check_output(JMIRAGE + " genshared %s %s " % (me, cam), shell=True)
 
 # Generate our ECDH key
 def genkey(me):
     return subprocess.check_output(JMIRAGE + " genkey %s" % (me,), shell=True)
 
+@mirage_trace.traced('new_request')
 def new_request():
     global counter
     counter = counter + 1
@@ -179,6 +365,40 @@ def stop_viewfinder_request(opts):
     req.webrtc_request.session_name = "foo"
     return req
 
+# Delete media items through the API (rather than HTTP DELETE) so that a
+# checksum can be given: the camera only deletes a file if it matches.
+# items are (filename, sha1 digest or None) pairs.
+def delete_media_request(items):
+    req = new_request()
+    req.type = CameraApiRequest.DELETE_MEDIA
+    for filename, sha1 in items:
+        d = req.delete_media_request.add()
+        d.filename = filename
+        if sha1 is not None:
+            d.checksum.checksum_type = FileChecksum.SHA1
+            d.checksum.checksum = sha1
+    return req
+
+# Thumbnails for several media items in one request. items are (filename,
+# start_index, length) tuples, to fetch large thumbnails in chunks.
+def thumbnail_request(items, width=None, height=None, quality=None):
+    req = new_request()
+    req.type = CameraApiRequest.GET_THUMBNAIL
+    for filename, start, length in items:
+        t = req.thumbnail_request.add()
+        t.filename = filename
+        if width:
+            t.width = width
+        if height:
+            t.height = height
+        if quality:
+            t.quality = quality
+        if start:
+            t.start_index = start
+        if length:
+            t.length = length
+    return req
+
 def get_debug_logs_request(opts):
     req = new_request()
     req.type = CameraApiRequest.GET_DEBUG_LOGS
@@ -213,6 +433,7 @@ def key_response(resp, peer_name):
 def finalize_response(resp):
     return resp.response_status.status_code == CameraApiResponse.ResponseStatus.OK
 
+@mirage_trace.traced('parse_response')
 def parse_response(data):
     resp = CameraApiResponse()
     resp.ParseFromString(data)
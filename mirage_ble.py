@@ -0,0 +1,109 @@
+# Transports for camera API messages over Bluetooth LE.
+#
+# A transport carries whole messages (serialized, and for the camera service,
+# encrypted) between bluestrap's command functions and the camera:
+#
+#   transport.send(msg)        # one request
+#   msg = transport.receive()  # the next complete response
+#
+# Messages are framed with mm_encode. Requests are written to the request
+# characteristic, and responses come back as notifications on the response
+# characteristic, split into pieces of at most one ATT payload, which are put
+# back together by an MMDecoder. A notification shorter than a full payload
+# is the last of its message, which settles whether an EOM at its end is
+# complete (see MMDecoder).
+#
+# bluestrap.GattTransport talks to the camera through BlueZ. LoopbackTransport
+# talks to a simulated camera in-process (e.g. bench/camera_sim.py's
+# CameraSim), going through the same framing, fragmentation and encryption,
+# so the BLE code paths can be run and timed without a camera or BlueZ.
+
+import time
+import queue
+from mirage_api import *
+import mirage_crypto
+import mirage_trace
+
+# BlueZ negotiates up to 517; 23 is the minimum every device supports.
+DEFAULT_MTU = 185
+# ATT header bytes in a notification and in a (prepared) write
+NOTIFY_OVERHEAD = 3
+WRITE_OVERHEAD = 5
+# seconds without a notification after which a message held back by the
+# decoder is taken as complete; a few connection intervals
+SETTLE_DELAY = 0.2
+
+# Splits data into pieces of at most size bytes.
+def fragments(data, size):
+    view = memoryview(data)
+    return [view[i:i + size] for i in range(0, len(view), size)] or [view[:0]]
+
+class LoopbackTransport:
+    # camera has handle(CameraApiRequest) -> CameraApiResponse. With keyfile,
+    # messages are encrypted with the shared key in it, as on the camera
+    # service; without, they are plain, as on the pairing service.
+    #
+    # interval is the connection interval in seconds, in which the camera
+    # sends up to notifications_per_interval notifications; a write takes an
+    # interval per fragment, since each is acknowledged.
+    def __init__(self, camera, keyfile=None, mtu=DEFAULT_MTU, interval=0, notifications_per_interval=4):
+        self.camera = camera
+        self.keyfile = keyfile
+        self.mtu = mtu
+        self.interval = interval
+        self.notifications_per_interval = notifications_per_interval
+        self.requests = MMDecoder()
+        self.responses = MMDecoder()
+        self.received = queue.Queue()
+        self.stats = {'writes': 0, 'notifications': 0, 'bytes_written': 0, 'bytes_notified': 0}
+
+    def send(self, msg):
+        with mirage_trace.span('mm_encode'):
+            data = mm_encode(msg)
+        # a write longer than one payload is sent as a series of prepared writes
+        size = self.mtu - NOTIFY_OVERHEAD if len(data) <= self.mtu - NOTIFY_OVERHEAD else self.mtu - WRITE_OVERHEAD
+        for chunk in fragments(data, size):
+            if self.interval:
+                time.sleep(self.interval)
+            self.stats['writes'] += 1
+            self.stats['bytes_written'] += len(chunk)
+            for request in self.requests.feed(chunk):
+                with mirage_trace.span('camera'):
+                    self.respond(request)
+        # the camera sees the write complete
+        for request in self.requests.flush():
+            with mirage_trace.span('camera'):
+                self.respond(request)
+
+    # The camera's side: decode, answer, and notify the response in pieces.
+    def respond(self, data):
+        if self.keyfile:
+            data = mirage_crypto.decrypt(data, self.keyfile)
+        req = CameraApiRequest()
+        req.ParseFromString(data)
+        data = self.camera.handle(req).SerializeToString()
+        if self.keyfile:
+            data = mirage_crypto.encrypt(data, self.keyfile)
+        payload = self.mtu - NOTIFY_OVERHEAD
+        for i, chunk in enumerate(fragments(mm_encode(data), payload)):
+            if self.interval and i % self.notifications_per_interval == 0:
+                time.sleep(self.interval)
+            self.stats['notifications'] += 1
+            self.stats['bytes_notified'] += len(chunk)
+            for response in self.responses.feed(bytes(chunk)):
+                self.received.put(response)
+            if len(chunk) < payload:
+                for response in self.responses.flush():
+                    self.received.put(response)
+        # a message filling its last notification is only settled by the next
+        # one; the camera has nothing more to send, so settle it now, as
+        # GattTransport does after a pause
+        for response in self.responses.flush():
+            self.received.put(response)
+
+    def receive(self, timeout=None):
+        try:
+            with mirage_trace.span('wait_response'):
+                return self.received.get(timeout=timeout)
+        except queue.Empty:
+            raise Exception('no response from camera')
@@ -0,0 +1,94 @@
+# Per-camera cache of the last STATUS response, written by "bluestrap.py
+# status" and read by egarim.py to find the camera on the network.
+#
+# Cameras are told apart by their shared key: each file is named after a
+# hash of the key, so every paired camera has its own entry however the key
+# file is named. A file holds a fixed header with the fields egarim.py needs
+# on every run, followed by the serialized CameraApiResponse:
+#
+#   magic 'EGST', version (1 byte), port (2), written at (8, ms since epoch),
+#   host length (1), certificate signature length (2), response length (4),
+#   then host, certificate signature and response.
+#
+# read() only unpacks the header, so the protobuf is parsed only when the
+# full status is asked for. Files are replaced atomically, so a concurrent
+# reader sees either the old entry or the new one.
+
+import os
+import time
+import struct
+import hashlib
+
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.egarim', 'status')
+MAGIC = b'EGST'
+VERSION = 1
+HEADER = struct.Struct('>4sBHqBHI')
+
+class CachedStatus:
+    def __init__(self, host, port, signature, written_at, data):
+        self.host = host
+        self.port = port
+        self.signature = signature
+        # seconds since the epoch
+        self.written_at = written_at
+        self.data = data
+
+    def age(self):
+        return time.time() - self.written_at
+
+    def fresh(self, ttl):
+        return not ttl or self.age() <= ttl
+
+    def response(self):
+        from mirage_api import CameraApiResponse
+        resp = CameraApiResponse()
+        resp.ParseFromString(self.data)
+        return resp
+
+def camera_id(skey):
+    return hashlib.sha256(skey).hexdigest()[:16]
+
+def cache_path(skey, cache_dir=CACHE_DIR):
+    return os.path.join(cache_dir, camera_id(skey) + '.status')
+
+# host and port override the address the camera reports, e.g. where
+# discovery found it.
+def save(skey, resp, cache_dir=CACHE_DIR, host=None, port=None):
+    hs = resp.camera_status.http_server_status
+    if host is None:
+        host = hs.camera_hostname[0] if hs.camera_hostname else ''
+    host = host.encode('utf-8')
+    signature = hs.camera_certificate_signature
+    data = resp.SerializeToString()
+    header = HEADER.pack(MAGIC, VERSION, port or hs.camera_port, int(time.time() * 1000), len(host), len(signature), len(data))
+
+    path = cache_path(skey, cache_dir)
+    os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(header + host + signature + data)
+    os.replace(tmp, path)
+    return path
+
+# Returns the CachedStatus for the camera paired with skey, or None if
+# nothing is cached or the entry is unreadable or from another version.
+def read(skey, cache_dir=CACHE_DIR):
+    try:
+        with open(cache_path(skey, cache_dir), 'rb') as f:
+            raw = f.read()
+    except FileNotFoundError:
+        return None
+    if len(raw) < HEADER.size:
+        return None
+    magic, version, port, written_ms, host_len, sig_len, data_len = HEADER.unpack_from(raw)
+    if magic != MAGIC or version != VERSION or len(raw) != HEADER.size + host_len + sig_len + data_len:
+        return None
+    offset = HEADER.size
+    try:
+        host = raw[offset:offset + host_len].decode('utf-8')
+    except UnicodeDecodeError:
+        return None
+    offset += host_len
+    signature = raw[offset:offset + sig_len]
+    offset += sig_len
+    return CachedStatus(host, port, signature, written_ms / 1000, raw[offset:])
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+
+# In-process replacement for "java MirageCrypto encrypt/decrypt".
+# Produces and consumes the same frames as CryptoUtilities.encrypt/decrypt:
+# a version byte (1), a random 12 byte IV, then the AES-GCM ciphertext with
+# the 128 bit authentication tag appended.
+#
+# Can also be run as a filter, mirroring the Java CLI, to cross-check the two:
+#   java -cp . MirageCrypto encrypt me_cam.skey < msg | ./mirage_crypto.py decrypt me_cam.skey
+
+import os
+import sys
+
+# cryptography is imported on first use, as it is slow to import and only
+# Bluetooth messages need it.
+AESGCM = None
+InvalidTag = None
+
+VERSION = 1
+IV_BYTES = 12
+TAG_BYTES = 16
+
+# Key files are read once; the cache key includes the mtime so re-pairing in a
+# long-running process picks up the new key.
+_ciphers = {}
+
+def available():
+    import importlib.util
+    return importlib.util.find_spec('cryptography') is not None
+
+def get_cipher(keyfile):
+    global AESGCM, InvalidTag
+    if AESGCM is None:
+        from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+        from cryptography.exceptions import InvalidTag
+    st = os.stat(keyfile)
+    ckey = (keyfile, st.st_mtime_ns, st.st_size)
+    c = _ciphers.get(ckey)
+    if c is None:
+        with open(keyfile, 'rb') as f:
+            c = AESGCM(f.read())
+        _ciphers[ckey] = c
+    return c
+
+def encrypt(msg, keyfile, iv=None):
+    if iv is None:
+        iv = os.urandom(IV_BYTES)
+    return bytes([VERSION]) + iv + get_cipher(keyfile).encrypt(iv, bytes(msg), None)
+
+def decrypt(msg, keyfile):
+    if len(msg) == 0:
+        raise Exception('Cipher text is empty.')
+    if msg[0] != VERSION:
+        raise Exception('Version numbers do not match. %d!=%d' % (msg[0], VERSION))
+    if len(msg) < 1 + IV_BYTES + TAG_BYTES:
+        raise Exception('Cipher text is too short.')
+    iv = bytes(msg[1:1 + IV_BYTES])
+    try:
+        return get_cipher(keyfile).decrypt(iv, bytes(msg[1 + IV_BYTES:]), None)
+    except InvalidTag:
+        raise Exception('Failed to decrypt.')
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3 or sys.argv[1] not in ('encrypt', 'decrypt'):
+        print('Usage:')
+        print('mirage_crypto.py encrypt <shared_key>')
+        print('mirage_crypto.py decrypt <shared_key>')
+        sys.exit(1)
+    if not available():
+        print('the cryptography package is not installed')
+        sys.exit(1)
+    op = encrypt if sys.argv[1] == 'encrypt' else decrypt
+    sys.stdout.buffer.write(op(sys.stdin.buffer.read(), sys.argv[2]))
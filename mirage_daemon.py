@@ -0,0 +1,245 @@
+# Local RPC for "egarim.py daemon".
+#
+# The daemon keeps the shared keys and warm HTTPS pools in one long-running
+# process and listens on a Unix domain socket. When the socket exists, an
+# egarim.py command forwards its arguments, working directory and the
+# environment variables in FORWARD_ENV to the daemon instead of running them
+# itself, and relays the output. This skips interpreter imports, key reading
+# and the TLS handshake on every command.
+#
+# Both directions use frames of a type byte, a 4 byte big endian length and
+# the payload:
+#   client -> daemon  v  NAME=value for each FORWARD_ENV variable set,
+#                        NUL separated; sent before each c
+#                     c  cwd, then argv, NUL separated
+#                     i  stdin contents, in reply to an i request
+#   daemon -> client  o  stdout data
+#                     e  stderr data
+#                     i  request for the client's stdin
+#                     x  exit status (4 bytes, signed)
+# A connection can carry several commands in turn. Commands run one at a
+# time, as they share the daemon's stdout, stderr, working directory and
+# environment, so commands that run for long (downloads, monitor, governor)
+# are never forwarded: the client runs them itself.
+
+import os
+import sys
+import struct
+
+SOCKET_PATH = os.environ.get('EGARIM_SOCKET') or os.path.join(os.path.expanduser('~'), '.egarim', 'daemon.sock')
+
+# variables egarim.py reads while running a command
+FORWARD_ENV = ['EGARIM_TRACE']
+
+ENV = b'v'
+CMD = b'c'
+STDIN = b'i'
+STDOUT = b'o'
+STDERR = b'e'
+EXIT = b'x'
+
+def send_frame(sock, kind, data=b''):
+    sock.sendall(kind + struct.pack('>I', len(data)) + data)
+
+def recv_frame(f):
+    header = f.read(5)
+    if len(header) < 5:
+        raise EOFError('daemon connection closed')
+    n, = struct.unpack('>I', header[1:])
+    data = f.read(n)
+    if len(data) < n:
+        raise EOFError('daemon connection closed')
+    return header[:1], data
+
+# Splits an egarim.py command line into the global options and the rest,
+# starting with the subcommand, without building the argument parser.
+# value_options are the global options that take a value.
+def split_command(argv, value_options):
+    i = 0
+    while i < len(argv):
+        arg = argv[i]
+        if arg == '--':
+            return argv[:i], argv[i + 1:]
+        if not arg.startswith('-'):
+            return argv[:i], argv[i:]
+        i += 2 if arg in value_options else 1
+    return argv, []
+
+# Runs argv in the daemon, copying its output to ours. Returns the exit
+# status, or None if no daemon is listening, in which case the caller should
+# run the command itself, as it should for the subcommands in local_commands
+# or with --no_daemon.
+def forward(argv, value_options, local_commands, path=SOCKET_PATH):
+    options, command = split_command(argv, value_options)
+    if command[:1] and command[0] in local_commands or '--no_daemon' in options or not os.path.exists(path):
+        return None
+    import socket
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError:
+        # a socket left behind by a daemon that is no longer running
+        sock.close()
+        return None
+    with sock, sock.makefile('rb') as f:
+        env = ['%s=%s' % (name, os.environ[name]) for name in FORWARD_ENV if name in os.environ]
+        send_frame(sock, ENV, '\0'.join(env).encode('utf-8'))
+        send_frame(sock, CMD, '\0'.join([os.getcwd()] + argv).encode('utf-8'))
+        while True:
+            kind, data = recv_frame(f)
+            if kind == STDOUT:
+                sys.stdout.buffer.write(data)
+                sys.stdout.buffer.flush()
+            elif kind == STDERR:
+                sys.stderr.buffer.write(data)
+                sys.stderr.buffer.flush()
+            elif kind == STDIN:
+                send_frame(sock, STDIN, sys.stdin.buffer.read())
+            elif kind == EXIT:
+                return struct.unpack('>i', data)[0]
+            else:
+                raise Exception('unexpected daemon frame %r' % (kind,))
+
+# Sets or (for None) removes environment variables.
+def set_env(env):
+    for name, value in env.items():
+        if value is None:
+            os.environ.pop(name, None)
+        else:
+            os.environ[name] = value
+
+# Stands in for sys.stdout/sys.stderr while a command runs, sending whole
+# lines to the client.
+class FrameWriter:
+    def __init__(self, sock, kind):
+        self.sock = sock
+        self.kind = kind
+        self.buf = []
+
+    def write(self, s):
+        self.buf.append(s)
+        if '\n' in s:
+            self.flush()
+        return len(s)
+
+    def flush(self):
+        if self.buf:
+            data, self.buf = ''.join(self.buf), []
+            send_frame(self.sock, self.kind, data.encode('utf-8'))
+
+    def isatty(self):
+        return False
+
+class FrameReader:
+    def __init__(self, sock, f):
+        self.sock = sock
+        self.f = f
+
+    def read(self, size=-1):
+        send_frame(self.sock, STDIN)
+        kind, data = recv_frame(self.f)
+        if kind != STDIN:
+            raise Exception('expected stdin from client, got %r' % (kind,))
+        return data.decode('utf-8')
+
+# Creates the listening server; command(argv) runs one egarim.py command
+# line and may raise SystemExit.
+def make_server(command, path=SOCKET_PATH):
+    import socket
+    import socketserver
+    import threading
+    import traceback
+
+    lock = threading.Lock()
+    home = os.getcwd()
+
+    def execute(sock, f, cwd, argv, env):
+        out = FrameWriter(sock, STDOUT)
+        err = FrameWriter(sock, STDERR)
+        with lock:
+            saved = sys.stdin, sys.stdout, sys.stderr
+            saved_env = {name: os.environ.get(name) for name in FORWARD_ENV}
+            sys.stdin, sys.stdout, sys.stderr = FrameReader(sock, f), out, err
+            try:
+                set_env(env)
+                os.chdir(cwd)
+                command(argv)
+                status = 0
+            except SystemExit as e:
+                if e.code is None or isinstance(e.code, int):
+                    status = e.code or 0
+                else:
+                    print(e.code, file=sys.stderr)
+                    status = 1
+            except (BrokenPipeError, ConnectionResetError):
+                # the client went away
+                return None
+            except Exception:
+                traceback.print_exc()
+                status = 1
+            finally:
+                sys.stdin, sys.stdout, sys.stderr = saved
+                set_env(saved_env)
+                os.chdir(home)
+        try:
+            out.flush()
+            err.flush()
+        except OSError:
+            return None
+        return status
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            env = {}
+            while True:
+                try:
+                    kind, data = recv_frame(self.rfile)
+                except EOFError:
+                    return
+                if kind == ENV:
+                    env = dict(item.split('=', 1) for item in data.decode('utf-8').split('\0') if item)
+                    continue
+                if kind != CMD:
+                    print('unexpected frame %r from client' % (kind,), file=sys.stderr)
+                    return
+                cwd, *argv = data.decode('utf-8').split('\0')
+                status = execute(self.connection, self.rfile, cwd, argv, {name: env.get(name) for name in FORWARD_ENV})
+                env = {}
+                if status is None:
+                    return
+                send_frame(self.connection, EXIT, struct.pack('>i', status))
+
+    class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+
+    os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+    if os.path.exists(path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+            raise Exception('a daemon is already listening on %s' % (path,))
+        except OSError:
+            os.unlink(path)
+        finally:
+            probe.close()
+    # the socket gives full control of the camera, so keep it to ourselves
+    old_umask = os.umask(0o077)
+    try:
+        server = Server(path, Handler)
+    finally:
+        os.umask(old_umask)
+    return server
+
+def serve(command, path=SOCKET_PATH):
+    import signal
+    server = make_server(command, path)
+    print('listening on', path)
+    # exit through the finally below, so the socket is removed
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(path)
@@ -0,0 +1,159 @@
+# Finding the camera on the LAN after its address has changed, without the
+# round trip through bluetooth.
+#
+# Every address in the local /24 (or the given subnets) is probed on the
+# camera's HTTPS port at once, with non-blocking connects. Each host that
+# accepts is then checked in two steps:
+#  - the signature of its TLS certificate must match the
+#    camera_certificate_signature cached from the last status over bluetooth,
+#    when there is one, so another device can't pass itself off as the camera;
+#  - a STATUS request signed with the shared key must succeed.
+# The first host to pass is written to the status cache. The cached address
+# is tried first, so when nothing has changed this is a single request.
+
+import time
+import errno
+import socket
+import selectors
+import ipaddress
+import mirage_cache
+from mirage_api import *
+from mirage_http import CameraClient, ctx
+
+PORT = 8443
+PROBE_TIMEOUT = 0.5
+# sockets open at once while probing
+MAX_PROBES = 512
+
+# The /24 networks of the interfaces used to reach the given hosts, or the
+# default route.
+def local_subnets(hosts=()):
+    subnets = []
+    for host in list(hosts) + ['192.0.2.1']:
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            # no packet is sent; this only picks the outgoing interface
+            s.connect((host, PORT))
+            addr = s.getsockname()[0]
+        except OSError:
+            continue
+        finally:
+            s.close()
+        net = ipaddress.ip_network(addr + '/24', strict=False)
+        if net not in subnets and not net.is_loopback:
+            subnets.append(net)
+    return subnets
+
+# Returns the hosts accepting TCP connections on port, in the order given.
+def probe(hosts, port=PORT, timeout=PROBE_TIMEOUT):
+    open_hosts = set()
+    hosts = list(hosts)
+    for i in range(0, len(hosts), MAX_PROBES):
+        sel = selectors.DefaultSelector()
+        try:
+            for host in hosts[i:i + MAX_PROBES]:
+                s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                s.setblocking(False)
+                if s.connect_ex((host, port)) in (0, errno.EINPROGRESS):
+                    sel.register(s, selectors.EVENT_WRITE, host)
+                else:
+                    s.close()
+            deadline = time.monotonic() + timeout
+            while sel.get_map():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                for key, events in sel.select(remaining):
+                    s = key.fileobj
+                    if s.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) == 0:
+                        open_hosts.add(key.data)
+                    sel.unregister(s)
+                    s.close()
+        finally:
+            for key in list(sel.get_map().values()):
+                key.fileobj.close()
+            sel.close()
+    return [host for host in hosts if host in open_hosts]
+
+# The signature value of a DER encoded X.509 certificate. A certificate is a
+# SEQUENCE of exactly three elements: the signed part (a SEQUENCE), the
+# signature algorithm (a SEQUENCE) and the signature, a BIT STRING whose first
+# byte counts unused bits. Anything else is rejected.
+def certificate_signature(der):
+    der = bytes(der)
+
+    def header(pos, end):
+        if pos + 2 > end:
+            raise Exception('certificate is truncated')
+        tag = der[pos]
+        length = der[pos + 1]
+        pos += 2
+        if length & 0x80:
+            n = length & 0x7f
+            if n == 0 or n > 4 or pos + n > end:
+                raise Exception('certificate has a bad DER length')
+            length = int.from_bytes(der[pos:pos + n], 'big')
+            pos += n
+        if pos + length > end:
+            raise Exception('certificate is truncated')
+        return tag, pos, length
+
+    tag, pos, length = header(0, len(der))
+    if tag != 0x30 or pos + length != len(der):
+        raise Exception('certificate is not a single DER SEQUENCE')
+    end = pos + length
+    elements = []
+    while pos < end:
+        elements.append(header(pos, end))
+        pos = elements[-1][1] + elements[-1][2]
+    if [e[0] for e in elements] != [0x30, 0x30, 0x03]:
+        raise Exception('certificate is not a signed part, algorithm and signature')
+    tag, start, length = elements[2]
+    if length < 1 or der[start] != 0:
+        raise Exception('certificate signature is not a whole number of bytes')
+    return der[start + 1:start + length]
+
+def peer_certificate(host, port, timeout=PROBE_TIMEOUT * 4):
+    with socket.create_connection((host, port), timeout) as sock:
+        with ctx.wrap_socket(sock, server_hostname=host) as tls:
+            return tls.getpeercert(binary_form=True)
+
+# Checks that host is the camera paired with skey; returns its STATUS
+# response, or raises.
+def verify(host, port, skey, signature=None):
+    if signature:
+        if certificate_signature(peer_certificate(host, port)) != signature:
+            raise Exception('%s: certificate does not match the cached camera certificate' % (host,))
+    with CameraClient(host, port, skey, timeout=PROBE_TIMEOUT * 4) as client:
+        resp = client.call(status_request(None))
+    if resp.response_status.status_code != CameraApiResponse.ResponseStatus.OK:
+        raise Exception('%s: status failed' % (host,))
+    return resp
+
+# Looks for the camera paired with skey, and updates the status cache with
+# where it was found. Returns (host, port), or None. log gets one line per
+# rejected candidate.
+def discover(skey, subnets=None, port=None, timeout=PROBE_TIMEOUT, log=None, cache_dir=mirage_cache.CACHE_DIR):
+    cached = mirage_cache.read(skey, cache_dir)
+    signature = cached.signature if cached else None
+    port = port or (cached.port if cached and cached.port else PORT)
+    first = [cached.host] if cached and cached.host else []
+    if not subnets:
+        subnets = local_subnets(first)
+    candidates = first + [str(h) for net in subnets for h in ipaddress.ip_network(net, strict=False).hosts() if str(h) not in first]
+
+    # the cached address on its own first, as it's the likely answer
+    for group in (first, candidates[len(first):]):
+        for host in probe(group, port, timeout):
+            try:
+                resp = verify(host, port, skey, signature)
+            except Exception as e:
+                if log:
+                    log(str(e))
+                continue
+            hs = resp.camera_status.http_server_status
+            if signature and not hs.camera_certificate_signature:
+                hs.camera_certificate_signature = signature
+            mirage_cache.save(skey, resp, cache_dir, host=host, port=port)
+            return host, port
+    return None
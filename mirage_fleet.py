@@ -0,0 +1,249 @@
+# Sending the same camera API command to a rig of cameras.
+#
+# The cameras are listed in a JSON inventory file:
+#   {"cameras": [
+#     {"id": "left", "host": "192.168.1.44", "skey": "left.skey"},
+#     {"id": "right", "host": "192.168.1.45", "port": 8443, "skey": "right.skey"}
+#   ]}
+# Key file paths are relative to the inventory file. Without a host, the
+# address cached by "bluestrap.py status" for that key is used.
+#
+# Each camera gets a thread and its own keep-alive connection. For commands
+# that have to line up across the rig (start_capture, stop_capture), every
+# connection is opened first and the threads then wait at a barrier, so the
+# requests go out within a fraction of a millisecond of each other instead of
+# a TLS handshake apart.
+#
+# Barrier release still leaves each camera's network latency as skew. For
+# those commands, call_at() first estimates each camera's clock offset and
+# round trip time from STATUS requests (device_timestamp), keeping the
+# fastest of several samples as NTP does. It then sends each request half a
+# round trip ahead of a common target time, so the requests arrive together.
+# Afterwards recording_starts() maps each camera's recording_start_time back
+# to our clock to report the skew actually achieved.
+
+import os
+import json
+import time
+import threading
+import mirage_cache
+from mirage_api import *
+from mirage_http import CameraClient
+
+FLEET_CMDS = ['status', 'get_capabilities', 'config_capture', 'start_capture', 'stop_capture',
+    'get_debug_logs', 'get_st3dbox', 'get_sv3dbox']
+SYNC_CMDS = ['start_capture', 'stop_capture']
+
+# how long a camera waits at the barrier for the others to connect
+SYNC_TIMEOUT = 30
+CLOCK_SAMPLES = 8
+# time between measuring the clocks and the synchronized send, on top of the
+# slowest round trip
+SYNC_LEAD = 0.25
+
+class Camera:
+    def __init__(self, id, host, port, skey):
+        self.id = id
+        self.host = host
+        self.port = port
+        self.skey = skey
+
+def load_inventory(path):
+    with open(path, 'r') as f:
+        inventory = json.load(f)
+    entries = inventory['cameras'] if isinstance(inventory, dict) else inventory
+    base = os.path.dirname(os.path.abspath(path))
+    cameras = []
+    for entry in entries:
+        skey = os.path.join(base, os.path.expanduser(entry.get('skey', 'me_cam.skey')))
+        host, port = entry.get('host'), entry.get('port', 8443)
+        if not host:
+            # the address "bluestrap.py status" found for this camera
+            with open(skey, 'rb') as f:
+                cached = mirage_cache.read(f.read())
+            if cached is None or not cached.host:
+                raise Exception('%s: no host given for camera %s and no cached status' % (path, entry['id']))
+            host, port = cached.host, entry.get('port', cached.port)
+        cameras.append(Camera(str(entry['id']), host, int(port), skey))
+    ids = [cam.id for cam in cameras]
+    if len(set(ids)) != len(ids):
+        raise Exception('%s: duplicate camera ids' % (path,))
+    return cameras
+
+# A camera's clock relative to ours: offset is device time minus local time,
+# both in seconds.
+class Clock:
+    def __init__(self, offset, rtt):
+        self.offset = offset
+        self.rtt = rtt
+
+    def to_local(self, device_ms):
+        return device_ms / 1000 - self.offset
+
+def measure_clock(client, samples=CLOCK_SAMPLES):
+    best = None
+    for i in range(samples):
+        t0 = time.time()
+        resp = client.call(status_request(None))
+        t1 = time.time()
+        if resp.response_status.status_code != CameraApiResponse.ResponseStatus.OK:
+            raise Exception('status failed: %s' % (resp.response_status,))
+        if not resp.camera_status.HasField('device_timestamp'):
+            raise Exception('camera does not report device_timestamp')
+        # the camera clock has millisecond resolution, so assume it was read
+        # half way through the millisecond
+        if best is None or t1 - t0 < best.rtt:
+            best = Clock((resp.camera_status.device_timestamp + 0.5) / 1000 - (t0 + t1) / 2, t1 - t0)
+    return best
+
+# time.sleep() can overshoot by a scheduler tick, so the last couple of ms
+# are spent yielding in a loop.
+def sleep_until(t):
+    while True:
+        remaining = t - time.time()
+        if remaining <= 0:
+            return
+        time.sleep(remaining - 0.002 if remaining > 0.003 else 0)
+
+# Outcome of a command on one camera. sent is the time.time() the request
+# went out, latency the seconds until the response was parsed. clock and
+# started (local time the recording started) are set by call_at() and
+# recording_starts().
+class Result:
+    def __init__(self, camera):
+        self.camera = camera
+        self.response = None
+        self.error = None
+        self.sent = None
+        self.latency = None
+        self.clock = None
+        self.started = None
+
+    def ok(self):
+        return self.error is None and self.response.response_status.status_code == CameraApiResponse.ResponseStatus.OK
+
+class Fleet:
+    # connect(host, port, skey) returns a CameraClient; clients it hands out
+    # belong to the caller and are not closed by the fleet.
+    def __init__(self, cameras, connect=None):
+        self.cameras = cameras
+        self.owned = connect is None
+        connect = connect or CameraClient
+        self.clients = {}
+        for cam in cameras:
+            with open(cam.skey, 'rb') as f:
+                self.clients[cam.id] = connect(cam.host, cam.port, f.read())
+
+    def close(self):
+        if self.owned:
+            for client in self.clients.values():
+                client.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # Runs fn(camera, client) for each camera in its own thread, and returns a
+    # dict of camera id -> return value or exception.
+    def each(self, fn, cameras=None):
+        out = {}
+
+        def worker(cam):
+            try:
+                out[cam.id] = fn(cam, self.clients[cam.id])
+            except Exception as e:
+                out[cam.id] = e
+
+        threads = [threading.Thread(target=worker, args=(cam,)) for cam in cameras or self.cameras]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return out
+
+    def send(self, result, client, request):
+        result.sent = time.time()
+        result.response = client.call(request)
+        result.latency = time.time() - result.sent
+
+    # Sends requests[camera id] to each camera concurrently and returns a dict
+    # of camera id -> Result. With sync, the requests are released together
+    # once every camera is connected; a camera that fails to connect is
+    # reported and doesn't hold up the rest.
+    def call(self, requests, sync=False):
+        cameras = [cam for cam in self.cameras if cam.id in requests]
+        results = {cam.id: Result(cam) for cam in cameras}
+        barrier = threading.Barrier(len(cameras)) if sync else None
+
+        def worker(cam, client):
+            if barrier:
+                try:
+                    client.warm()
+                finally:
+                    barrier.wait(SYNC_TIMEOUT)
+            self.send(results[cam.id], client, requests[cam.id])
+
+        for id, e in self.each(worker, cameras).items():
+            results[id].error = e
+        return results
+
+    def clocks(self, samples=CLOCK_SAMPLES, cameras=None):
+        return self.each(lambda cam, client: measure_clock(client, samples), cameras)
+
+    # Like call(sync=True), but times each request to arrive at the same
+    # moment, compensating for each camera's round trip time. Cameras whose
+    # clock can't be measured are reported as failed and not sent anything.
+    def call_at(self, requests, samples=CLOCK_SAMPLES):
+        cameras = [cam for cam in self.cameras if cam.id in requests]
+        results = {cam.id: Result(cam) for cam in cameras}
+        for id, clock in self.clocks(samples, cameras).items():
+            if isinstance(clock, Exception):
+                results[id].error = clock
+            else:
+                results[id].clock = clock
+        ready = [cam for cam in cameras if results[cam.id].error is None]
+        if not ready:
+            return results
+        target = time.time() + SYNC_LEAD + max(results[cam.id].clock.rtt for cam in ready)
+
+        def worker(cam, client):
+            result = results[cam.id]
+            sleep_until(target - result.clock.rtt / 2)
+            self.send(result, client, requests[cam.id])
+
+        for id, e in self.each(worker, ready).items():
+            results[id].error = e
+        return results
+
+    # Fills in Result.started from each camera's recording_start_time, for
+    # results of a start_capture. Cameras that refused the start (e.g. as
+    # they were already recording) are left out. Cameras without a clock
+    # measured by call_at() are measured now.
+    def recording_starts(self, results, samples=CLOCK_SAMPLES):
+        ok = [r.camera for r in results.values() if r.ok()]
+
+        def worker(cam, client):
+            result = results[cam.id]
+            if result.clock is None:
+                result.clock = measure_clock(client, samples)
+            resp = client.call(status_request(None))
+            rs = resp.camera_status.recording_status
+            if rs.recording_state == CameraStatus.RecordingStatus.RECORDING and rs.recording_start_time:
+                result.started = result.clock.to_local(rs.recording_start_time)
+
+        for id, e in self.each(worker, ok).items():
+            if isinstance(e, Exception):
+                results[id].error = e
+
+# Spread between the first and last request sent, in seconds.
+def dispatch_spread(results):
+    sent = [r.sent for r in results.values() if r.sent is not None]
+    return max(sent) - min(sent) if sent else 0
+
+# Spread between the first and last recording start, in seconds, or None if
+# fewer than two cameras reported one.
+def start_skew(results):
+    started = [r.started for r in results.values() if r.started is not None]
+    return max(started) - min(started) if len(started) > 1 else None
@@ -0,0 +1,180 @@
+# Live stream resolution governor.
+#
+# Watches LiveStreamStatus while streaming and steps the live mode frame size
+# down when the uplink can't keep up, and back up once it has recovered. The
+# steps are the frame sizes in CameraCapabilities.supported_live_modes.
+#
+# A poll is "bad" if frames were dropped since the last poll, or the upload
+# bitrate is below DOWN_RATIO of the target; "good" if nothing was dropped
+# and the upload is at least UP_RATIO of the target. Stepping down takes
+# down_polls bad polls in a row, stepping up the (larger) up_polls good ones,
+# and after any change the governor waits out a cooldown, longer before
+# stepping up than down, so a marginal link doesn't flip back and forth.
+#
+# A decision only takes effect once the camera has accepted the new size, so
+# the governor's step always matches what the camera is configured with. A
+# failed poll or reconfiguration is logged and the governor carries on, as it
+# is meant to run unattended on exactly the links that drop requests.
+
+import json
+import time
+import argparse
+from mirage_api import *
+
+DOWN_RATIO = 0.8
+UP_RATIO = 0.95
+DOWN_POLLS = 3
+UP_POLLS = 15
+DOWN_COOLDOWN = 10
+UP_COOLDOWN = 60
+
+# The distinct live frame sizes, smallest first, as (width, height).
+def live_ladder(capabilities, min_height=None, max_height=None):
+    sizes = set()
+    for mode in capabilities.supported_live_modes:
+        fs = mode.frame_size
+        if not fs.frame_width or not fs.frame_height:
+            continue
+        if min_height and fs.frame_height < min_height or max_height and fs.frame_height > max_height:
+            continue
+        sizes.add((fs.frame_width, fs.frame_height))
+    return sorted(sizes, key=lambda s: (s[0] * s[1], s))
+
+def current_size(status):
+    fs = status.active_capture_mode.configured_live_mode.video_mode.frame_size
+    return (fs.frame_width, fs.frame_height) if fs.frame_width and fs.frame_height else None
+
+class Governor:
+    def __init__(self, ladder, step=None, down_polls=DOWN_POLLS, up_polls=UP_POLLS,
+            down_cooldown=DOWN_COOLDOWN, up_cooldown=UP_COOLDOWN):
+        if not ladder:
+            raise Exception('no live frame sizes to choose from')
+        self.ladder = ladder
+        self.step = len(ladder) - 1 if step is None else step
+        self.down_polls = down_polls
+        self.up_polls = up_polls
+        self.down_cooldown = down_cooldown
+        self.up_cooldown = up_cooldown
+        self.bad = 0
+        self.good = 0
+        self.dropped = None
+        self.changed_at = None
+
+    def size(self):
+        return self.ladder[self.step]
+
+    # Picks the step for the size the camera reports, or the largest smaller one.
+    def set_size(self, size):
+        smaller = [i for i, s in enumerate(self.ladder) if s[0] * s[1] <= size[0] * size[1]]
+        self.step = smaller[-1] if smaller else 0
+
+    # Feeds one LiveStreamStatus; returns (new step, reason) if the frame size
+    # should change, or None. The step only changes when change() is called,
+    # once the camera has taken the new size.
+    def observe(self, live, now):
+        # dropped_frames counts from the start of the stream, and goes back to
+        # zero when a new one starts
+        if self.dropped is None:
+            dropped = 0
+        elif live.dropped_frames < self.dropped:
+            dropped = live.dropped_frames
+        else:
+            dropped = live.dropped_frames - self.dropped
+        self.dropped = live.dropped_frames
+        target = live.target_bitrate
+        ratio = live.upload_bitrate / target if target else None
+
+        if dropped or ratio is not None and ratio < DOWN_RATIO:
+            self.bad += 1
+            self.good = 0
+        elif ratio is None or ratio >= UP_RATIO:
+            self.good += 1
+            self.bad = 0
+        else:
+            # in between: neither count moves on, which is the hysteresis band
+            return None
+
+        since = now - self.changed_at if self.changed_at is not None else None
+        if self.bad >= self.down_polls and self.step > 0 and (since is None or since >= self.down_cooldown):
+            reason = '%d dropped frames' % (dropped,) if dropped else 'upload at %d%% of target' % (ratio * 100,)
+            return self.step - 1, reason
+        if self.good >= self.up_polls and self.step < len(self.ladder) - 1 and (since is None or since >= self.up_cooldown):
+            return self.step + 1, 'stable for %d polls' % (self.good,)
+        return None
+
+    def change(self, step, now):
+        self.step = step
+        self.changed_at = now
+        self.bad = 0
+        self.good = 0
+
+def live_config_request(size, opts):
+    o = argparse.Namespace(mode='live', width=size[0], height=size[1], projection=getattr(opts, 'projection', None),
+        rtmp_endpoint=getattr(opts, 'rtmp_endpoint', None), stream_name_key=getattr(opts, 'stream_name_key', None), stereo=False)
+    return config_capture_request(o)
+
+def check_ok(resp, what):
+    if resp.response_status.status_code != CameraApiResponse.ResponseStatus.OK:
+        raise Exception('%s failed: %s' % (what, CameraApiResponse.ResponseStatus.StatusCode.Name(resp.response_status.status_code)))
+    return resp
+
+# Reconfigures the live frame size. With restart, the stream is stopped
+# around the change, for cameras that only apply it to a new stream, and
+# started again even if the change failed.
+def apply_size(client, size, opts, restart=False):
+    if not restart:
+        check_ok(client.call(live_config_request(size, opts)), 'config_capture')
+        return
+    check_ok(client.call(stop_capture_request(None)), 'stop_capture')
+    try:
+        check_ok(client.call(live_config_request(size, opts)), 'config_capture')
+    finally:
+        # back on the air, at the old size if the new one was refused
+        check_ok(client.call(start_capture_request(argparse.Namespace(auto_stop=None))), 'start_capture')
+
+# One status poll, and the change it calls for, if any.
+def poll(client, governor, opts, restart, log):
+    status = check_ok(client.call(status_request(None)), 'status').camera_status
+    rs = status.recording_status
+    if rs.recording_state != CameraStatus.RecordingStatus.RECORDING or not rs.HasField('live_stream_status'):
+        return
+    decision = governor.observe(rs.live_stream_status, time.monotonic())
+    if not decision:
+        return
+    step, reason = decision
+    old, new = governor.size(), governor.ladder[step]
+    try:
+        apply_size(client, new, opts, restart)
+    except Exception as e:
+        raise Exception('changing %dx%d to %dx%d: %s' % (old + new + (e,)))
+    governor.change(step, time.monotonic())
+    log(json.dumps({'t': round(time.time(), 3), 'from': '%dx%d' % old, 'to': '%dx%d' % new, 'reason': reason}))
+
+# Runs until interrupted, or count polls. Logs a JSON line for every change,
+# and for every poll or change that failed.
+def govern(client, opts, interval=2.0, count=0, restart=False, log=print, **limits):
+    caps = check_ok(client.call(get_capabilities_request(None)), 'get_capabilities').capabilities
+    min_height = limits.pop('min_height', None)
+    max_height = limits.pop('max_height', None)
+    governor = Governor(live_ladder(caps, min_height, max_height), **limits)
+    status = check_ok(client.call(status_request(None)), 'status').camera_status
+    if current_size(status):
+        governor.set_size(current_size(status))
+    log(json.dumps({'t': round(time.time(), 3), 'ladder': ['%dx%d' % s for s in governor.ladder], 'size': '%dx%d' % governor.size()}))
+
+    polls = 0
+    next_poll = time.monotonic()
+    while not count or polls < count:
+        polls += 1
+        try:
+            poll(client, governor, opts, restart, log)
+        except Exception as e:
+            log(json.dumps({'t': round(time.time(), 3), 'error': str(e)}))
+        if polls == count:
+            break
+        next_poll += interval
+        delay = next_poll - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        else:
+            next_poll = time.monotonic()
@@ -0,0 +1,193 @@
+# Persistent HTTPS client for the camera API over Wi-Fi.
+#
+# CameraClient keeps a small pool of keep-alive connections to the camera, so
+# a scripted session (configure, start, poll status, stop, list, download)
+# doesn't pay a TCP and TLS handshake per command. New connections resume the
+# TLS session of earlier ones, and a pooled connection the camera has closed
+# in the meantime is transparently replaced.
+#
+#   client = CameraClient('192.168.1.44', 8443, skey)
+#   resp = client.call(status_request(opts))
+#   with client.open_media(path) as f:
+#       ...
+
+import base64
+import contextlib
+import hmac
+import http.client
+import socket
+import ssl
+import threading
+import mirage_trace
+from mirage_api import parse_response
+
+API_PATH = '/daydreamcamera'
+
+# The camera uses a self-signed certificate. Since it isn't verified, don't use
+# ssl.create_default_context(), which spends tens of ms loading the system CAs.
+ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+ctx.check_hostname = False
+ctx.verify_mode = ssl.CERT_NONE
+
+# Requests are signed with an HMAC-SHA256 of the method, path and body,
+# keyed by the shared key established by bluetooth pairing.
+def http_signature(skey, method, selector, data=None):
+    h = hmac.new(skey, digestmod='sha256')
+    h.update(method.encode('utf-8'))
+    h.update(selector.encode('utf-8'))
+    if data:
+        h.update(data)
+    return base64.urlsafe_b64encode(h.digest()).decode('ascii')
+
+def media_selector(path):
+    return '/media/%s' % (path,)
+
+class CameraConnection(http.client.HTTPSConnection):
+    def __init__(self, client):
+        super().__init__(client.host, client.port, timeout=client.timeout, context=client.ctx)
+        self.client = client
+
+    def connect(self):
+        with mirage_trace.span('tcp_connect', host=self.host):
+            sock = socket.create_connection((self.host, self.port), self.timeout, self.source_address)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        with mirage_trace.span('tls_handshake') as s:
+            self.sock = self._context.wrap_socket(sock, server_hostname=self.host, session=self.client.tls_session)
+            if mirage_trace.enabled():
+                s.args['resumed'] = self.sock.session_reused
+        self.client.count('connects')
+        if self.sock.session_reused:
+            self.client.count('resumed')
+
+class CameraClient:
+    def __init__(self, host, port, skey, pool_size=4, timeout=30):
+        self.host = host
+        self.port = int(port)
+        self.skey = skey
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.ctx = ctx
+        self.tls_session = None
+        self.idle = []
+        self.lock = threading.Lock()
+        self.stats = {'requests': 0, 'connects': 0, 'resumed': 0, 'reused': 0, 'retries': 0}
+
+    def count(self, name):
+        with self.lock:
+            self.stats[name] += 1
+
+    def acquire(self):
+        with self.lock:
+            if self.idle:
+                return self.idle.pop(), True
+        return CameraConnection(self), False
+
+    def release(self, conn):
+        if conn.sock is None:
+            return
+        # TLS 1.3 session tickets arrive after the handshake, so the session is
+        # picked up once a response has been read rather than on connect.
+        self.tls_session = conn.sock.session
+        with self.lock:
+            if len(self.idle) < self.pool_size:
+                self.idle.append(conn)
+                return
+        conn.close()
+
+    # Makes sure a connection is open and idle, so the next request doesn't
+    # wait for the TCP and TLS handshakes.
+    def warm(self):
+        conn, reused = self.acquire()
+        try:
+            if not reused:
+                conn.connect()
+        except:
+            conn.close()
+            raise
+        self.release(conn)
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for conn in idle:
+            conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def send(self, method, selector, body=None, headers=None):
+        headers = dict(headers or {})
+        with mirage_trace.span('sign'):
+            headers['Authorization'] = 'daydreamcamera ' + http_signature(self.skey, method, selector, body)
+        self.count('requests')
+        # A request on a reused connection is retried on another only when
+        # the error shows the camera can't have acted on it: the connection
+        # was already gone when it was sent, or was closed without a byte of
+        # response, which is how an idle keep-alive connection ends. Anything
+        # else may come after the camera ran the command (a START_CAPTURE, a
+        # delete), so it isn't sent twice.
+        while True:
+            conn, reused = self.acquire()
+            try:
+                # sending includes connecting, if the connection is new
+                with mirage_trace.span('send', method=method, selector=selector, reused=reused):
+                    conn.request(method, selector, body=body, headers=headers)
+            except (ConnectionError, ssl.SSLEOFError):
+                conn.close()
+                if not reused:
+                    raise
+                self.count('retries')
+                continue
+            except:
+                conn.close()
+                raise
+            try:
+                # until the status line and headers are in: the camera's time
+                with mirage_trace.span('first_byte'):
+                    resp = conn.getresponse()
+            except http.client.RemoteDisconnected:
+                conn.close()
+                if not reused:
+                    raise
+                self.count('retries')
+                continue
+            except:
+                conn.close()
+                raise
+            if reused:
+                self.count('reused')
+            return conn, resp
+
+    # Context manager yielding the HTTP response. The connection is returned
+    # to the pool if the body was read to the end, and closed otherwise.
+    @contextlib.contextmanager
+    def open(self, method, selector, body=None, headers=None):
+        conn, resp = self.send(method, selector, body, headers)
+        try:
+            if resp.status // 100 != 2:
+                resp.read()
+                raise Exception('HTTP error %d %s: %s %s' % (resp.status, resp.reason, method, selector))
+            yield resp
+        finally:
+            if resp.isclosed():
+                self.release(conn)
+            else:
+                conn.close()
+
+    def call(self, req):
+        with mirage_trace.span('serialize'):
+            data = req.SerializeToString()
+        with self.open('POST', API_PATH, data, {'Content-Type': 'application/octet-stream'}) as resp:
+            with mirage_trace.span('read'):
+                data = resp.read()
+            return parse_response(data)
+
+    def open_media(self, path, headers=None):
+        return self.open('GET', media_selector(path), headers=headers)
+
+    def delete_media(self, path):
+        with self.open('DELETE', media_selector(path)) as resp:
+            return resp.read()
@@ -0,0 +1,320 @@
+# Bulk media transfers over the camera HTTP API.
+#
+# sync_media() pages through LIST_MEDIA and downloads files concurrently over
+# a pooled CameraClient. Interrupted downloads are kept as <name>.part and
+# resumed with a Range request; files already present with the right size are
+# skipped. A small index in the destination directory remembers completed
+# files, so a re-sync only needs the LIST_MEDIA round trips.
+#
+# Downloads are read into one reusable buffer per transfer, with readinto(),
+# and the disk space for the rest of the file is reserved before writing.
+# Since the connection is TLS, the data has to pass through user space, so
+# this is as close to a zero copy path as we get.
+#
+# Downloads are hashed with SHA1 as they are written and compared with the
+# checksum reported in Media.checksum. With delete=True verified files are
+# then deleted from the camera with checksum-qualified DELETE_MEDIA requests,
+# so the camera refuses the delete unless it has exactly the file we stored.
+# Deletes are batched, many files per request.
+
+import os
+import re
+import json
+import time
+import errno
+import hashlib
+import argparse
+import threading
+from mirage_api import *
+
+INDEX_FILE = '.egarim-sync.json'
+COPY_BUFSIZE = 1024 * 1024
+DELETE_BATCH = 50
+# delete_batch status of a file the camera gave no status for
+UNKNOWN = 'UNKNOWN'
+# fallocate() mode that reserves blocks without changing the file size
+FALLOC_FL_KEEP_SIZE = 1
+
+def check_response(resp, what):
+    if resp.response_status.status_code != CameraApiResponse.ResponseStatus.OK:
+        raise Exception('%s failed: %s' % (what, resp.response_status))
+    return resp
+
+def list_all_media(client, page_size=100):
+    start = 0
+    while True:
+        opts = argparse.Namespace(start=start, count=page_size)
+        resp = check_response(client.call(list_media_request(opts)), 'list_media')
+        items = resp.media.media
+        for item in items:
+            yield item
+        start += len(items)
+        # some cameras leave total_count unset, so a short page is the end too
+        total = resp.media.total_count
+        if len(items) < page_size or total and start >= total:
+            break
+
+# Files keep their path on the camera (e.g. DCIM/100MEDIA/CLIP0001.mp4) under
+# dest, so files of the same name in different directories don't collide.
+def local_path(dest, media):
+    parts = [p for p in media.filename.split('/') if p not in ('', '.')]
+    if media.filename.startswith('/') or not parts or '..' in parts:
+        raise Exception('%s: refusing a media path outside the destination' % (media.filename,))
+    return os.path.join(dest, *parts)
+
+# Returns the first byte offset of a 206 reply's Content-Range, or None if
+# it has none we can read.
+def content_range_start(resp):
+    r = re.match(r'bytes (\d+)-', resp.getheader('Content-Range', ''))
+    return int(r.group(1)) if r else None
+
+def media_sha1(media):
+    for c in media.checksum:
+        if c.checksum_type == FileChecksum.SHA1:
+            return c.checksum
+    return None
+
+def file_sha1(path, limit=None):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        while limit is None or f.tell() < limit:
+            n = COPY_BUFSIZE if limit is None else min(COPY_BUFSIZE, limit - f.tell())
+            buf = f.read(n)
+            if not buf:
+                break
+            h.update(buf)
+    return h
+
+class SyncIndex:
+    def __init__(self, dest):
+        self.path = os.path.join(dest, INDEX_FILE)
+        self.lock = threading.Lock()
+        try:
+            with open(self.path, 'r') as f:
+                self.entries = json.load(f)
+        except (FileNotFoundError, ValueError):
+            self.entries = {}
+
+    def entry(self, media):
+        return {'size': media.size, 'timestamp': media.timestamp}
+
+    def is_done(self, media, dest):
+        entry = self.entries.get(media.filename)
+        if entry is None or {k: entry.get(k) for k in ('size', 'timestamp')} != self.entry(media):
+            return False
+        # the index is only trusted while the file is still there, whole
+        path = local_path(dest, media)
+        return os.path.exists(path) and os.path.getsize(path) == media.size
+
+    def sha1(self, media):
+        sha1 = self.entries.get(media.filename, {}).get('sha1')
+        return bytes.fromhex(sha1) if sha1 else None
+
+    def mark_done(self, media, sha1):
+        with self.lock:
+            self.entries[media.filename] = dict(self.entry(media), sha1=sha1.hex())
+            tmp = self.path + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(self.entries, f)
+            os.replace(tmp, self.path)
+
+# Bytes received and time taken, across downloads (and threads).
+class TransferStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.bytes = 0
+        self.start = time.monotonic()
+
+    def add(self, n):
+        with self.lock:
+            self.bytes += n
+
+    def summary(self):
+        elapsed = max(time.monotonic() - self.start, 1e-9)
+        return 'received %.1f MB in %.1f s, %.1f MB/s' % (self.bytes / 1000000, elapsed, self.bytes / elapsed / 1000000)
+
+fallocate = None
+
+# Reserves length bytes from offset in f, so a large file is laid out in one
+# piece and a full disk fails up front rather than part way through. The file
+# size is left alone, as resuming goes by the size of the .part file. Does
+# nothing where fallocate() isn't available (e.g. macOS) or the filesystem
+# doesn't support it.
+def preallocate(f, offset, length):
+    global fallocate
+    if length <= 0:
+        return
+    if fallocate is None:
+        # loaded on first use, since ctypes is slow to import
+        try:
+            import ctypes
+            fallocate = ctypes.CDLL(None, use_errno=True).fallocate
+            fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+        except (OSError, AttributeError):
+            fallocate = False
+    if not fallocate:
+        return
+    if fallocate(f.fileno(), FALLOC_FL_KEEP_SIZE, offset, length) != 0:
+        import ctypes
+        err = ctypes.get_errno()
+        if err == errno.ENOSPC:
+            raise OSError(err, os.strerror(err), f.name)
+
+# Copies the body of an HTTP response to out, from out's current position,
+# through one buffer of bufsize bytes. size is the expected length, if known,
+# to reserve the space for. h, if given, is updated with the data. Returns the
+# number of bytes copied.
+def copy_body(resp, out, h=None, size=None, bufsize=COPY_BUFSIZE, fsync=False, stats=None):
+    if size is None and resp.getheader('Content-Length'):
+        size = int(resp.getheader('Content-Length'))
+    if size:
+        out.flush()
+        preallocate(out, out.tell(), size)
+    buf = bytearray(bufsize)
+    view = memoryview(buf)
+    copied = 0
+    while True:
+        n = resp.readinto(buf)
+        if not n:
+            break
+        chunk = view[:n]
+        if h is not None:
+            h.update(chunk)
+        out.write(chunk)
+        copied += n
+        if stats is not None:
+            stats.add(n)
+    if fsync:
+        out.flush()
+        os.fsync(out.fileno())
+    return copied
+
+# Download one file into dest, resuming from <name>.part if present, and
+# verify it against the camera's SHA1. Returns the SHA1 digest of the file.
+def download(client, media, dest, bufsize=COPY_BUFSIZE, fsync=False, stats=None):
+    outfile = local_path(dest, media)
+    part = outfile + '.part'
+    offset = os.path.getsize(part) if os.path.exists(part) else 0
+    if media.size and offset > media.size:
+        offset = 0
+    os.makedirs(os.path.dirname(outfile), exist_ok=True)
+    while True:
+        headers = {'Range': 'bytes=%d-' % (offset,)} if offset else None
+        with client.open_media(media.filename, headers) as f:
+            # the server may ignore the Range header and send the whole file
+            if f.status != 206:
+                offset = 0
+            elif offset and content_range_start(f) != offset:
+                # a range starting anywhere else is no use: start from scratch
+                offset = 0
+                continue
+            h = file_sha1(part, offset) if offset else hashlib.sha1()
+            with open(part, 'r+b' if offset else 'wb') as out:
+                out.seek(offset)
+                out.truncate()
+                copy_body(f, out, h, media.size - offset if media.size else None, bufsize, fsync, stats)
+        break
+    size = os.path.getsize(part)
+    if media.size and size != media.size:
+        raise Exception('%s: got %d bytes, expected %d' % (media.filename, size, media.size))
+    expected = media_sha1(media)
+    if expected is not None and h.digest() != expected:
+        os.remove(part)
+        raise Exception('%s: SHA1 mismatch, got %s expected %s' % (media.filename, h.hexdigest(), expected.hex()))
+    os.replace(part, outfile)
+    return h.digest()
+
+# Delete files with as few DELETE_MEDIA requests as possible. items are
+# (filename, sha1 digest or None) pairs. Returns a dict of filename to the
+# name of its status code ('OK' on success), or UNKNOWN if the camera didn't
+# say what became of the file.
+def delete_batch(client, items, batch_size=DELETE_BATCH):
+    statuses = {}
+    for i in range(0, len(items), batch_size):
+        batch = items[i:i + batch_size]
+        resp = client.call(delete_media_request(batch))
+        overall = resp.response_status.status_code
+        codes = [CameraApiResponse.ResponseStatus.StatusCode.Name(s.status_code) for s in resp.delete_media_status]
+        # a file only counts as deleted on its own status; without one per
+        # file, a failed request failed them all, and an OK one says nothing
+        if len(codes) != len(batch):
+            code = UNKNOWN if overall == CameraApiResponse.ResponseStatus.OK else CameraApiResponse.ResponseStatus.StatusCode.Name(overall)
+            codes = [code] * len(batch)
+        for (filename, sha1), code in zip(batch, codes):
+            statuses[filename] = code
+    return statuses
+
+# With verify, the index isn't enough: a file not downloaded in this run is
+# hashed again, as it's about to be deleted from the camera.
+def sync_one(client, media, dest, index, bufsize=COPY_BUFSIZE, fsync=False, stats=None, verify=False):
+    outfile = local_path(dest, media)
+    expected = media_sha1(media)
+    status = None
+    if not verify and index.is_done(media, dest) and (expected is None or index.sha1(media) == expected):
+        status = 'indexed'
+    elif os.path.exists(outfile) and os.path.getsize(outfile) == media.size:
+        # not downloaded by us (or the index was lost): check it before trusting it
+        sha1 = file_sha1(outfile).digest()
+        if expected is None or sha1 == expected:
+            status = 'present'
+            index.mark_done(media, sha1)
+    if status is None:
+        status = 'copied'
+        index.mark_done(media, download(client, media, dest, bufsize, fsync, stats))
+    return status
+
+# Returns a dict of filename -> 'copied'/'present'/'indexed' (with '/deleted'
+# or '/unverified' appended if delete is set), or the exception for files
+# that failed. stats, a TransferStats, counts the bytes downloaded.
+def sync_media(client, dest, jobs=4, page_size=100, delete=False, batch_size=DELETE_BATCH, log=print,
+        bufsize=COPY_BUFSIZE, fsync=False, stats=None):
+    # imported here as it pulls in logging, which every egarim.py run would pay for
+    import concurrent.futures
+    os.makedirs(dest, exist_ok=True)
+    index = SyncIndex(dest)
+    results = {}
+    verified = []
+
+    def flush_deletes():
+        try:
+            codes = delete_batch(client, verified, batch_size)
+        except Exception as e:
+            codes = {name: e for name, sha1 in verified}
+        for name, code in codes.items():
+            if code == 'OK':
+                results[name] += '/deleted'
+            else:
+                results[name] = Exception('%s: delete failed: %s' % (name, code))
+            log(name, results[name])
+        del verified[:]
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        # list everything up front, as deleting while paging would shift the pages
+        items = list(list_all_media(client, page_size))
+        futures = {pool.submit(sync_one, client, media, dest, index, bufsize, fsync, stats, delete): media for media in items}
+        for future in concurrent.futures.as_completed(futures):
+            media = futures[future]
+            name = media.filename
+            try:
+                results[name] = future.result()
+            except Exception as e:
+                results[name] = e
+                log(name, results[name])
+                continue
+            # only delete what the camera's own checksum has vouched for
+            if delete and media_sha1(media) is None:
+                results[name] += '/unverified'
+            elif delete:
+                outfile = local_path(dest, media)
+                if not os.path.exists(outfile) or os.path.getsize(outfile) != media.size:
+                    results[name] = Exception('%s: local copy is missing or incomplete, not deleting' % (name,))
+                    log(name, results[name])
+                    continue
+                verified.append((name, media_sha1(media)))
+                if len(verified) >= batch_size:
+                    flush_deletes()
+                continue
+            log(name, results[name])
+        if verified:
+            flush_deletes()
+    return results
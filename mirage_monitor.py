@@ -0,0 +1,132 @@
+# Polls STATUS over one keep-alive connection and reports what changed.
+#
+# Each CameraStatus is flattened into dotted field paths, e.g.
+#   recording_status.live_stream_status.dropped_frames -> 12
+#   battery_status.battery_percentage -> 80
+# and compared with the previous poll. Changed fields are written as one
+# compact JSON line per poll (the first line has every field), and/or the
+# numeric and enum fields are written to a Prometheus text file, for the node
+# exporter's textfile collector.
+#
+# Fields that change on every poll (the device clock, the gravity vector)
+# would drown out the rest, so they are left out by default.
+
+import os
+import sys
+import json
+import time
+from mirage_api import *
+
+DEFAULT_IGNORE = ['device_timestamp', 'gravity_vector']
+METRIC_PREFIX = 'mirage_'
+
+# Returns a dict of dotted field path -> value for the fields set in msg.
+# Enums are given by name, bytes as hex, and repeated fields get an index.
+# The paths of enum fields are added to enums, if given.
+def flatten(msg, prefix='', out=None, enums=None):
+    if out is None:
+        out = {}
+    for field, value in msg.ListFields():
+        path = prefix + field.name
+        if field.label == field.LABEL_REPEATED:
+            for i, item in enumerate(value):
+                flatten_value(field, item, '%s.%d' % (path, i), out, enums)
+        else:
+            flatten_value(field, value, path, out, enums)
+    return out
+
+def flatten_value(field, value, path, out, enums):
+    if field.type == field.TYPE_MESSAGE:
+        flatten(value, path + '.', out, enums)
+    elif field.type == field.TYPE_ENUM:
+        v = field.enum_type.values_by_number.get(value)
+        out[path] = v.name if v else value
+        if enums is not None:
+            enums.add(path)
+    elif field.type == field.TYPE_BYTES:
+        out[path] = value.hex()
+    else:
+        out[path] = value
+
+def ignored(path, ignore):
+    return any(path == i or path.startswith(i + '.') for i in ignore)
+
+# Fields of cur that differ from prev; fields no longer set map to None.
+def diff(prev, cur):
+    changed = {k: v for k, v in cur.items() if k not in prev or prev[k] != v}
+    changed.update((k, None) for k in prev if k not in cur)
+    return changed
+
+def metric_name(path):
+    return METRIC_PREFIX + ''.join(c if c.isalnum() else '_' for c in path)
+
+def label_value(s):
+    return str(s).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+# Numeric fields become gauges; enum fields become a gauge of 1 with the
+# value as a label. Strings are left out.
+def prometheus_text(fields, labels, enums):
+    base = ','.join('%s="%s"' % (k, label_value(v)) for k, v in sorted(labels.items()))
+    lines = []
+    for path, value in sorted(fields.items()):
+        if path in enums:
+            lines.append('%s{%s} 1' % (metric_name(path), ','.join(filter(None, [base, 'value="%s"' % (label_value(value),)]))))
+        elif isinstance(value, (bool, int)):
+            lines.append('%s{%s} %d' % (metric_name(path), base, value))
+        elif isinstance(value, float):
+            lines.append('%s{%s} %r' % (metric_name(path), base, value))
+    return '\n'.join(lines) + '\n'
+
+# The textfile collector may read the file at any time, so it is replaced
+# rather than rewritten in place.
+def write_atomic(path, text):
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        f.write(text)
+    os.replace(tmp, path)
+
+# Polls every interval seconds, count times (0 for ever). JSON lines go to
+# out unless it is None; prometheus is a file path to rewrite after each poll.
+def monitor(client, interval=1.0, count=0, ignore=DEFAULT_IGNORE, out=sys.stdout, prometheus=None, labels=None):
+    labels = labels or {'camera': client.host}
+    prev = {}
+    polls = 0
+    next_poll = time.monotonic()
+    while not count or polls < count:
+        polls += 1
+        t0 = time.time()
+        try:
+            resp = client.call(status_request(None))
+            if resp.response_status.status_code != CameraApiResponse.ResponseStatus.OK:
+                raise Exception('status failed: %s' % (CameraApiResponse.ResponseStatus.StatusCode.Name(resp.response_status.status_code),))
+        except Exception as e:
+            if out is not None:
+                out.write(json.dumps({'t': round(t0, 3), 'error': str(e)}, separators=(',', ':')) + '\n')
+                out.flush()
+            if prometheus:
+                write_atomic(prometheus, prometheus_text({'up': 0}, labels, set()))
+        else:
+            latency = time.time() - t0
+            status = resp.camera_status
+            enums = set()
+            cur = {k: v for k, v in flatten(status, enums=enums).items() if not ignored(k, ignore)}
+            changed = diff(prev, cur)
+            prev = cur
+            if out is not None and changed:
+                line = {'t': round(t0, 3)}
+                line.update(changed)
+                out.write(json.dumps(line, separators=(',', ':')) + '\n')
+                out.flush()
+            if prometheus:
+                fields = dict(cur, up=1, status_latency_seconds=latency)
+                write_atomic(prometheus, prometheus_text(fields, labels, enums))
+        if polls == count:
+            break
+        next_poll += interval
+        delay = next_poll - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        else:
+            # fell behind (slow camera); don't try to catch up
+            next_poll = time.monotonic()
+    return prev
@@ -0,0 +1,158 @@
+# Thumbnail fetching with an on-disk cache, for browsing the camera roll
+# without downloading the media itself.
+#
+# GET_THUMBNAIL takes a repeated ThumbnailRequest, so thumbnails for many
+# files are requested in one API call. Each response carries at most `length`
+# bytes starting at `start_index`, plus the total size and CRC32 of the whole
+# thumbnail; large thumbnails are fetched in several rounds and checked
+# against the CRC once complete.
+#
+# The cache is keyed by filename, media timestamp and requested size and
+# quality, so a file replaced under the same name gets a new thumbnail. It is trimmed to
+# max_bytes, least recently used first.
+
+import os
+import zlib
+import hashlib
+import threading
+from mirage_api import *
+
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.egarim', 'thumbs')
+CACHE_BYTES = 64 * 1024 * 1024
+THUMB_BATCH = 16
+THUMB_CHUNK = 64 * 1024
+
+class ThumbnailCache:
+    def __init__(self, path=CACHE_DIR, max_bytes=CACHE_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+        self.sizes = {}
+        for entry in os.scandir(path):
+            if entry.name.endswith('.thumb'):
+                self.sizes[entry.name] = entry.stat().st_size
+
+    def key(self, media, width, height, quality):
+        k = '%s\0%d\0%s\0%s\0%s' % (media.filename, media.timestamp, width or '', height or '', quality or '')
+        return hashlib.sha1(k.encode('utf-8')).hexdigest() + '.thumb'
+
+    def get(self, media, width=None, height=None, quality=None):
+        name = self.key(media, width, height, quality)
+        path = os.path.join(self.path, name)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        # mtime is the LRU clock
+        os.utime(path)
+        return data
+
+    def put(self, media, data, width=None, height=None, quality=None):
+        name = self.key(media, width, height, quality)
+        path = os.path.join(self.path, name)
+        tmp = '%s.%d.tmp' % (path, threading.get_ident())
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+        with self.lock:
+            self.sizes[name] = len(data)
+            if sum(self.sizes.values()) > self.max_bytes:
+                self.evict()
+
+    def evict(self):
+        entries = []
+        for name in list(self.sizes):
+            try:
+                entries.append((os.stat(os.path.join(self.path, name)).st_mtime, name))
+            except FileNotFoundError:
+                del self.sizes[name]
+        total = sum(self.sizes.values())
+        for mtime, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.path, name))
+            except FileNotFoundError:
+                pass
+            total -= self.sizes.pop(name)
+
+# A thumbnail being reassembled from chunks
+class Pending:
+    def __init__(self, media):
+        self.media = media
+        self.data = bytearray()
+        self.total = None
+        self.crc = None
+
+    def add(self, t):
+        if self.total is None:
+            if not t.total_size:
+                raise Exception('%s: camera returned no thumbnail (total_size 0)' % (self.media.filename,))
+            self.total = t.total_size
+            self.crc = t.checksum
+        if not t.data and len(self.data) < self.total:
+            raise Exception('%s: empty thumbnail chunk at %d of %d' % (self.media.filename, len(self.data), self.total))
+        self.data += t.data
+        if len(self.data) > self.total:
+            raise Exception('%s: thumbnail longer than its total_size' % (self.media.filename,))
+
+    def done(self):
+        return self.total is not None and len(self.data) >= self.total
+
+    def check(self):
+        if zlib.crc32(self.data) != self.crc:
+            raise Exception('%s: thumbnail CRC32 mismatch' % (self.media.filename,))
+        return bytes(self.data)
+
+# Returns a dict of filename -> thumbnail bytes, or the exception for
+# thumbnails that could not be fetched.
+def fetch_thumbnails(client, medias, cache=None, width=None, height=None, quality=None,
+        batch=THUMB_BATCH, chunk=THUMB_CHUNK):
+    results = {}
+    pending = []
+    for media in medias:
+        data = cache.get(media, width, height, quality) if cache else None
+        if data is not None:
+            results[media.filename] = data
+        else:
+            pending.append(Pending(media))
+
+    while pending:
+        group = pending[:batch]
+        items = [(p.media.filename, len(p.data), chunk) for p in group]
+        try:
+            resp = client.call(thumbnail_request(items, width, height, quality))
+            if resp.response_status.status_code != CameraApiResponse.ResponseStatus.OK:
+                raise Exception('get_thumbnail failed: %s' % (resp.response_status,))
+            if len(resp.thumbnail) != len(group):
+                raise Exception('get_thumbnail returned %d thumbnails for %d requests' % (len(resp.thumbnail), len(group)))
+        except Exception as e:
+            for p in group:
+                results[p.media.filename] = e
+            pending = pending[batch:]
+            continue
+
+        unfinished = []
+        for p, t in zip(group, resp.thumbnail):
+            try:
+                p.add(t)
+                if not p.done():
+                    unfinished.append(p)
+                    continue
+                results[p.media.filename] = data = p.check()
+                if cache:
+                    cache.put(p.media, data, width, height, quality)
+            except Exception as e:
+                results[p.media.filename] = e
+        # chunks still outstanding go first, so partial buffers don't pile up
+        pending = unfinished + pending[batch:]
+    return results
+
+def thumbnail_extension(data):
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return '.webp'
+    if data[:8] == b'\x89PNG\r\n\x1a\n':
+        return '.png'
+    return '.jpg'
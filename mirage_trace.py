@@ -0,0 +1,109 @@
+# Opt-in timing spans, to see where the time of a slow command goes:
+# building and serializing the request, signing, connecting, waiting for the
+# camera, reading and parsing the response, and for Bluetooth, encryption and
+# framing.
+#
+# Tracing is off unless EGARIM_TRACE names an output file, or a command is
+# run with --trace FILE. A file ending in .jsonl gets one JSON object per
+# span; anything else gets Chrome trace-event JSON, which chrome://tracing
+# and https://ui.perfetto.dev display as a timeline per thread.
+#
+#   with mirage_trace.span('connect', host=host):
+#       ...
+#
+#   @mirage_trace.traced('parse_response')
+#   def parse_response(data):
+#       ...
+#
+# Timestamps are from the monotonic perf_counter, in microseconds since the
+# module was imported. While tracing is off, span() returns a shared no-op
+# context manager and traced functions are called directly.
+
+import os
+import json
+import time
+import atexit
+import threading
+import functools
+import contextlib
+
+TRACE_ENV = 'EGARIM_TRACE'
+
+path = None
+events = []
+threads = {}
+registered = False
+t0 = time.perf_counter_ns()
+
+NULL_SPAN = contextlib.nullcontext()
+
+class Span:
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        end = time.perf_counter_ns()
+        thread = threading.current_thread()
+        threads[thread.ident] = thread.name
+        event = {'name': self.name, 'ph': 'X', 'ts': (self.start - t0) / 1000, 'dur': (end - self.start) / 1000,
+            'pid': os.getpid(), 'tid': thread.ident}
+        if exc_type is not None:
+            self.args['error'] = exc_type.__name__
+        if self.args:
+            event['args'] = self.args
+        # list.append is atomic, so spans can end on any thread
+        events.append(event)
+        return False
+
+def span(name, **args):
+    return Span(name, args) if path is not None else NULL_SPAN
+
+def traced(name):
+    def decorator_traced(func):
+        @functools.wraps(func)
+        def wrap_traced(*args, **kwargs):
+            if path is None:
+                return func(*args, **kwargs)
+            with Span(name, {}):
+                return func(*args, **kwargs)
+        return wrap_traced
+    return decorator_traced
+
+# Starts recording spans, to be written to trace_path by finish() or at exit.
+def enable(trace_path):
+    global path, registered
+    path = os.path.abspath(trace_path)
+    del events[:]
+    if not registered:
+        atexit.register(finish)
+        registered = True
+
+def enabled():
+    return path is not None
+
+# Writes the spans recorded since enable() and stops recording.
+def finish():
+    global path
+    if path is None:
+        return
+    out, path = path, None
+    recorded = list(events)
+    del events[:]
+    tmp = out + '.tmp'
+    with open(tmp, 'w') as f:
+        if out.endswith('.jsonl'):
+            for event in recorded:
+                f.write(json.dumps(event, separators=(',', ':')) + '\n')
+        else:
+            meta = [{'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': tid, 'args': {'name': name}}
+                for tid, name in threads.items()]
+            json.dump({'traceEvents': meta + recorded, 'displayTimeUnit': 'ms'}, f)
+    os.replace(tmp, out)
+
+if os.environ.get(TRACE_ENV):
+    enable(os.environ[TRACE_ENV])
@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+
+# Adds vectors made by the Java code to crypto_vectors.json: each plaintext
+# is encrypted with "java MirageCrypto encrypt" (so with a random IV, which is
+# read back out of the frame). Run from the top of the tree after make, with
+# a 32 byte key file, e.g. a throwaway one from head -c 32 /dev/urandom.
+#
+#   ./tests/make_crypto_vectors.py test.skey
+
+import os
+import sys
+import json
+import subprocess
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(TESTS_DIR, '..'))
+from mirage_api import *
+import mirage_crypto
+
+VECTORS = os.path.join(TESTS_DIR, 'crypto_vectors.json')
+
+def plaintexts():
+    # the sizes around a block boundary, and a real request
+    for n in (0, 1, 15, 16, 17, 1000):
+        yield os.urandom(n)
+    yield status_request(None).SerializeToString()
+
+def main(keyfile):
+    with open(keyfile, 'rb') as f:
+        key = f.read()
+    with open(VECTORS) as f:
+        doc = json.load(f)
+    for plaintext in plaintexts():
+        frame = subprocess.run(JMIRAGE.split() + ['encrypt', keyfile], input=plaintext,
+            stdout=subprocess.PIPE, check=True).stdout
+        iv = frame[1:1 + mirage_crypto.IV_BYTES]
+        doc['vectors'].append({'source': 'MirageCrypto %d bytes' % (len(plaintext),), 'key': key.hex(),
+            'iv': iv.hex(), 'plaintext': plaintext.hex(), 'frame': frame.hex()})
+    with open(VECTORS, 'w') as f:
+        json.dump(doc, f, indent=2)
+        f.write('\n')
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        print('usage: make_crypto_vectors.py <shared_key>')
+        sys.exit(1)
+    main(sys.argv[1])
@@ -0,0 +1,148 @@
+import asyncio
+import contextlib
+import pytest
+from mirage_api import *
+from mirage_aio import AsyncCameraClient, AsyncConnection, StaleConnection
+from camera_sim import CameraSim
+
+SKEY = b'k' * 32
+SIZE = 300000
+
+@pytest.fixture(scope='module')
+def sim():
+    with CameraSim(SKEY, media=3, media_size=SIZE) as sim:
+        yield sim
+
+def client_for(sim, **kwargs):
+    return AsyncCameraClient(sim.host, sim.port, SKEY, **kwargs)
+
+# A plain TCP server that answers each request with the given byte strings,
+# pausing delay seconds before each, then closes the connection. Returns the
+# server and a coroutine function opening a connection to it, to put in a
+# client's pool in place of one to the camera.
+async def canned(*replies, delay=0):
+    async def handle(reader, writer):
+        with contextlib.suppress(ConnectionError):
+            await reader.readuntil(b'\r\n\r\n')
+            for reply in replies:
+                await asyncio.sleep(delay)
+                writer.write(reply)
+                await writer.drain()
+        writer.close()
+    server = await asyncio.start_server(handle, '127.0.0.1', 0)
+    port = server.sockets[0].getsockname()[1]
+
+    async def connect():
+        return AsyncConnection(*await asyncio.open_connection('127.0.0.1', port))
+    return server, connect
+
+def test_call_and_media(sim):
+    async def run():
+        async with client_for(sim) as client:
+            statuses = await asyncio.gather(*[client.call(status_request(None), timeout=5) for i in range(6)])
+            assert all(r.response_status.status_code == CameraApiResponse.ResponseStatus.OK for r in statuses)
+            assert client.stats['connects'] <= client.pool_size + 2
+            for name, m in sorted(sim.media.items())[:2]:
+                data = b''.join([chunk async for chunk in client.media_chunks(name, chunk_size=10000)])
+                assert data == b''.join(m.chunks())
+            assert client.stats['reused'] > 0
+    asyncio.run(run())
+
+@pytest.mark.parametrize('reply, keep_alive', [
+    (b'HTTP/1.1 200 OK\r\nContent-Length: 11\r\n\r\nhello world', True),
+    (b'HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n5;x=1\r\nhello\r\n6\r\n world\r\n0\r\nTrailer: x\r\n\r\n', True),
+    (b'HTTP/1.1 200 OK\r\nConnection: close\r\n\r\nhello world', False),
+    (b'HTTP/1.0 200 OK\r\n\r\nhello world', False),
+])
+def test_bodies(reply, keep_alive):
+    async def run():
+        server, connect = await canned(reply)
+        async with server, AsyncCameraClient('127.0.0.1', 1, SKEY) as client:
+            conn = await connect()
+            client.idle.append(conn)
+            async with client.open('GET', '/media/x') as resp:
+                parts = []
+                while True:
+                    data = await resp.read_chunk(4)
+                    if not data:
+                        break
+                    parts.append(data)
+            assert b''.join(parts) == b'hello world'
+            assert (conn in client.idle) == keep_alive
+    asyncio.run(run())
+
+def test_stale_connection_retried(sim):
+    async def run():
+        server, connect = await canned()
+        async with server, client_for(sim) as client:
+            # a pooled connection the camera has since closed
+            client.idle.append(await connect())
+            resp = await client.call(status_request(None), timeout=5)
+            assert resp.response_status.status_code == CameraApiResponse.ResponseStatus.OK
+            assert client.stats['retries'] == 1
+    asyncio.run(run())
+
+def test_started_response_not_retried(sim):
+    async def run():
+        # the camera answered, then the connection dropped: it may have run
+        # the command, so it isn't sent again
+        server, connect = await canned(b'HTTP/1.1 200 OK\r\nContent-Length: 10\r\n\r\nabc')
+        async with server, client_for(sim) as client:
+            client.idle.append(await connect())
+            with pytest.raises(asyncio.IncompleteReadError):
+                await client.call(status_request(None), timeout=5)
+            assert client.stats['retries'] == 0
+            assert client.idle == []
+        # and a new connection that closes at once isn't retried either
+        server, connect = await canned()
+        async with server, client_for(sim) as client:
+            client.connect = connect
+            with pytest.raises(StaleConnection):
+                await client.call(status_request(None), timeout=5)
+    asyncio.run(run())
+
+def test_cancelled_media_chunks(sim):
+    async def run():
+        async with client_for(sim) as client:
+            name = sorted(sim.media)[0]
+            async with contextlib.aclosing(client.media_chunks(name, chunk_size=1000)) as chunks:
+                async for chunk in chunks:
+                    break
+            # the rest of the body was never read, so the connection is gone
+            assert client.idle == []
+
+            task = asyncio.create_task(client.media_chunks(name).__anext__())
+            await asyncio.sleep(0)
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+            assert client.idle == []
+
+            # and the client carries on with a new connection
+            data = b''.join([chunk async for chunk in client.media_chunks(name)])
+            assert len(data) == SIZE
+            assert len(client.idle) == 1
+    asyncio.run(run())
+
+def test_timeout_closes_connection(sim):
+    async def run():
+        async with client_for(sim) as client:
+            await client.call(status_request(None), timeout=5)
+            sim.latency = 0.5
+            try:
+                with pytest.raises(asyncio.TimeoutError):
+                    await client.call(status_request(None), timeout=0.1)
+            finally:
+                sim.latency = 0
+            assert client.idle == []
+    asyncio.run(run())
+
+def test_one_deadline_per_call():
+    async def run():
+        # the headers and the body each come within the timeout, but not both
+        server, connect = await canned(b'HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\n', b'\x08\x01', delay=0.3)
+        async with server, AsyncCameraClient('127.0.0.1', 1, SKEY) as client:
+            client.idle.append(await connect())
+            with pytest.raises(asyncio.TimeoutError):
+                await client.call(status_request(None), timeout=0.45)
+    asyncio.run(run())
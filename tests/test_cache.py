@@ -0,0 +1,72 @@
+import time
+import hashlib
+import pytest
+from mirage_api import *
+import mirage_cache
+
+SKEY = b'k' * 32
+
+def status(host='192.168.1.44', port=8443, signature=b'\x01\x02\x03'):
+    resp = CameraApiResponse()
+    resp.response_status.status_code = CameraApiResponse.ResponseStatus.OK
+    hs = resp.camera_status.http_server_status
+    if host:
+        hs.camera_hostname.append(host)
+    hs.camera_port = port
+    hs.camera_certificate_signature = signature
+    resp.camera_status.battery_status.battery_percentage = 87
+    return resp
+
+def test_round_trip(tmp_path):
+    resp = status()
+    before = time.time()
+    path = mirage_cache.save(SKEY, resp, str(tmp_path))
+    cached = mirage_cache.read(SKEY, str(tmp_path))
+    assert path == mirage_cache.cache_path(SKEY, str(tmp_path))
+    assert (cached.host, cached.port, cached.signature) == ('192.168.1.44', 8443, b'\x01\x02\x03')
+    assert before - 0.001 <= cached.written_at <= time.time()
+    assert cached.response() == resp
+    assert [p.name for p in tmp_path.iterdir()] == [mirage_cache.camera_id(SKEY) + '.status']
+
+def test_address_override(tmp_path):
+    mirage_cache.save(SKEY, status(host=None), str(tmp_path), host='10.0.0.7', port=9443)
+    cached = mirage_cache.read(SKEY, str(tmp_path))
+    assert (cached.host, cached.port) == ('10.0.0.7', 9443)
+    assert cached.response().camera_status.http_server_status.camera_port == 8443
+
+def test_key_derivation(tmp_path):
+    assert mirage_cache.camera_id(SKEY) == hashlib.sha256(SKEY).hexdigest()[:16]
+    mirage_cache.save(SKEY, status(host='10.0.0.1'), str(tmp_path))
+    mirage_cache.save(b'j' * 32, status(host='10.0.0.2'), str(tmp_path))
+    assert mirage_cache.read(SKEY, str(tmp_path)).host == '10.0.0.1'
+    assert mirage_cache.read(b'j' * 32, str(tmp_path)).host == '10.0.0.2'
+    assert mirage_cache.read(b'x' * 32, str(tmp_path)) is None
+
+def corrupt(tmp_path, change):
+    path = mirage_cache.save(SKEY, status(), str(tmp_path))
+    with open(path, 'rb') as f:
+        raw = bytearray(f.read())
+    with open(path, 'wb') as f:
+        f.write(change(raw))
+    return mirage_cache.read(SKEY, str(tmp_path))
+
+@pytest.mark.parametrize('change', [
+    lambda raw: raw[:mirage_cache.HEADER.size - 1],
+    lambda raw: raw[:-1],
+    lambda raw: raw + b'\0',
+    lambda raw: b'EGSX' + raw[4:],
+    lambda raw: raw[:4] + bytes([mirage_cache.VERSION + 1]) + raw[5:],
+    # a host that isn't UTF-8
+    lambda raw: raw[:mirage_cache.HEADER.size] + b'\xff' + raw[mirage_cache.HEADER.size + 1:],
+    lambda raw: b'',
+])
+def test_unreadable(tmp_path, change):
+    assert corrupt(tmp_path, change) is None
+
+def test_fresh(monkeypatch):
+    cached = mirage_cache.CachedStatus('h', 8443, b'', 1000.0, b'')
+    monkeypatch.setattr(mirage_cache.time, 'time', lambda: 1060.0)
+    assert cached.age() == 60
+    assert cached.fresh(0)
+    assert cached.fresh(60)
+    assert not cached.fresh(59)
@@ -0,0 +1,39 @@
+import os
+import json
+import pytest
+import mirage_crypto
+
+pytestmark = pytest.mark.skipif(not mirage_crypto.available(), reason='needs the cryptography package')
+
+with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'crypto_vectors.json')) as f:
+    VECTORS = json.load(f)['vectors']
+
+@pytest.fixture(params=VECTORS, ids=[v['source'] for v in VECTORS])
+def vector(request, tmp_path):
+    v = {k: bytes.fromhex(v) if k != 'source' else v for k, v in request.param.items()}
+    v['keyfile'] = str(tmp_path / 'vector.skey')
+    with open(v['keyfile'], 'wb') as f:
+        f.write(v['key'])
+    return v
+
+def test_decrypt(vector):
+    assert mirage_crypto.decrypt(vector['frame'], vector['keyfile']) == vector['plaintext']
+
+def test_encrypt_with_fixed_iv(vector):
+    assert mirage_crypto.encrypt(vector['plaintext'], vector['keyfile'], vector['iv']) == vector['frame']
+
+def test_frame_layout(vector):
+    frame = mirage_crypto.encrypt(vector['plaintext'], vector['keyfile'])
+    assert frame[0] == mirage_crypto.VERSION
+    assert len(frame) == 1 + mirage_crypto.IV_BYTES + len(vector['plaintext']) + mirage_crypto.TAG_BYTES
+    assert mirage_crypto.decrypt(frame, vector['keyfile']) == vector['plaintext']
+
+def test_tampered_frame(vector):
+    frame = bytearray(vector['frame'])
+    frame[-1] ^= 1
+    with pytest.raises(Exception, match='Failed to decrypt'):
+        mirage_crypto.decrypt(frame, vector['keyfile'])
+
+def test_bad_version(vector):
+    with pytest.raises(Exception, match='Version numbers do not match'):
+        mirage_crypto.decrypt(b'\x02' + vector['frame'][1:], vector['keyfile'])
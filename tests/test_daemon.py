@@ -0,0 +1,104 @@
+import os
+import sys
+import socket
+import threading
+import subprocess
+import pytest
+import mirage_daemon
+
+REPO = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+VALUE_OPTIONS = ['--host', '--port', '--skey', '--status_ttl', '--trace']
+LOCAL_COMMANDS = ['daemon', 'monitor']
+
+@pytest.mark.parametrize('argv, options, command', [
+    ([], [], []),
+    (['status'], [], ['status']),
+    (['--host', 'daemon', 'status'], ['--host', 'daemon'], ['status']),
+    (['--debug', '--trace', 't.json', 'get_media', 'daemon'], ['--debug', '--trace', 't.json'], ['get_media', 'daemon']),
+    (['--no_daemon'], ['--no_daemon'], []),
+    (['--debug', '--', '--odd'], ['--debug'], ['--odd']),
+])
+def test_split_command(argv, options, command):
+    assert mirage_daemon.split_command(argv, VALUE_OPTIONS) == (options, command)
+
+def test_frames():
+    a, b = socket.socketpair()
+    with a, b, b.makefile('rb') as f:
+        mirage_daemon.send_frame(a, mirage_daemon.STDOUT, b'hello\n')
+        mirage_daemon.send_frame(a, mirage_daemon.STDIN)
+        assert mirage_daemon.recv_frame(f) == (mirage_daemon.STDOUT, b'hello\n')
+        assert mirage_daemon.recv_frame(f) == (mirage_daemon.STDIN, b'')
+        a.sendall(mirage_daemon.EXIT + b'\0\0')
+        a.shutdown(socket.SHUT_WR)
+        with pytest.raises(EOFError):
+            mirage_daemon.recv_frame(f)
+
+# The commands of the daemon under test.
+def command(argv):
+    options, (name, *args) = mirage_daemon.split_command(argv, VALUE_OPTIONS)
+    if name == 'echo':
+        print(' '.join(args))
+    elif name == 'cat':
+        sys.stdout.write(sys.stdin.read().upper())
+    elif name == 'env':
+        print(os.environ.get('EGARIM_TRACE'))
+    elif name == 'cwd':
+        print(os.getcwd())
+    elif name == 'exit':
+        sys.exit(int(args[0]))
+    elif name == 'fail':
+        sys.exit('failed: ' + args[0])
+    elif name == 'raise':
+        raise ValueError(args[0])
+    else:
+        print('ran locally')
+
+@pytest.fixture
+def daemon(tmp_path):
+    path = str(tmp_path / 'daemon.sock')
+    server = mirage_daemon.make_server(command, path)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    yield path
+    server.shutdown()
+    server.server_close()
+    thread.join()
+
+# Runs the forwarding client in a process of its own, as egarim.py would.
+def client(path, *argv, env=None, stdin=b'', cwd=REPO):
+    code = ('import sys; import mirage_daemon; '
+        'status = mirage_daemon.forward(sys.argv[1:], %r, %r, %r); '
+        'print("ran locally") if status is None else sys.exit(status)' % (VALUE_OPTIONS, LOCAL_COMMANDS, path))
+    environ = dict(os.environ, PYTHONPATH=REPO)
+    environ.pop('EGARIM_TRACE', None)
+    environ.update(env or {})
+    return subprocess.run([sys.executable, '-c', code] + list(argv), input=stdin, capture_output=True, env=environ, cwd=cwd)
+
+def test_output_and_status(daemon):
+    r = client(daemon, 'echo', 'hello', 'world')
+    assert (r.returncode, r.stdout, r.stderr) == (0, b'hello world\n', b'')
+    r = client(daemon, 'exit', '3')
+    assert (r.returncode, r.stdout) == (3, b'')
+    r = client(daemon, 'fail', 'no camera')
+    assert (r.returncode, r.stderr) == (1, b'failed: no camera\n')
+    r = client(daemon, 'raise', 'broken')
+    assert r.returncode == 1 and b'ValueError: broken' in r.stderr
+
+def test_stdin_and_cwd(daemon, tmp_path):
+    assert client(daemon, 'cat', stdin=b'abc\n').stdout == b'ABC\n'
+    assert client(daemon, 'cwd', cwd=str(tmp_path)).stdout == str(tmp_path).encode() + b'\n'
+    assert os.getcwd() != str(tmp_path)
+
+def test_env(daemon):
+    assert client(daemon, 'env', env={'EGARIM_TRACE': 'trace.json'}).stdout == b'trace.json\n'
+    # and not left behind for the next command
+    assert client(daemon, 'env').stdout == b'None\n'
+    assert 'EGARIM_TRACE' not in os.environ
+
+def test_runs_locally(daemon, tmp_path):
+    assert client(daemon, '--no_daemon', 'echo', 'x').stdout == b'ran locally\n'
+    assert client(daemon, '--host', 'h', 'monitor').stdout == b'ran locally\n'
+    assert client(daemon, 'daemon').stdout == b'ran locally\n'
+    # a name that happens to be a local subcommand is still forwarded
+    assert client(daemon, '--host', 'monitor', 'echo', 'daemon').stdout == b'daemon\n'
+    assert client(str(tmp_path / 'none.sock'), 'echo', 'x').stdout == b'ran locally\n'
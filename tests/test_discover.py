@@ -0,0 +1,60 @@
+import ssl
+import subprocess
+import pytest
+from mirage_api import *
+import mirage_cache
+import mirage_discover
+from camera_sim import CameraSim
+
+SKEY = b'k' * 32
+
+@pytest.fixture(scope='module')
+def sim():
+    with CameraSim(SKEY, media=0) as sim:
+        yield sim
+
+def openssl_certificate(tmp_path, key):
+    cert = str(tmp_path / 'cert.pem')
+    subprocess.check_call(['openssl', 'req', '-x509', '-newkey', key, '-nodes', '-days', '1', '-subj', '/CN=test',
+        '-keyout', str(tmp_path / 'key.pem'), '-out', cert], stderr=subprocess.DEVNULL)
+    with open(cert) as f:
+        return ssl.PEM_cert_to_DER_cert(f.read())
+
+@pytest.mark.parametrize('key', ['rsa:2048', 'ec', 'ed25519'])
+def test_certificate_signature(tmp_path, key):
+    x509 = pytest.importorskip('cryptography.x509')
+    if key == 'ec':
+        key = 'ec:' + str(tmp_path / 'params.pem')
+        subprocess.check_call(['openssl', 'ecparam', '-name', 'prime256v1', '-out', key[3:]])
+    der = openssl_certificate(tmp_path, key)
+    assert mirage_discover.certificate_signature(der) == x509.load_der_x509_certificate(der).signature
+
+def test_served_certificate(sim):
+    x509 = pytest.importorskip('cryptography.x509')
+    der = mirage_discover.peer_certificate(sim.host, sim.port)
+    assert mirage_discover.certificate_signature(der) == x509.load_der_x509_certificate(der).signature == sim.signature
+
+def test_malformed_certificate(sim):
+    der = mirage_discover.peer_certificate(sim.host, sim.port)
+    for bad in (der[:-1], der + b'\0', b'\x30\x00', b'', b'\x31' + der[1:]):
+        with pytest.raises(Exception, match='certificate'):
+            mirage_discover.certificate_signature(bad)
+
+# As if bluetooth had reported a camera with this certificate at the sim.
+def cache_status(sim, tmp_path, signature):
+    resp = sim.handle(status_request(None))
+    resp.camera_status.http_server_status.camera_certificate_signature = signature
+    mirage_cache.save(SKEY, resp, str(tmp_path), host=sim.host, port=sim.port)
+
+def test_discover(sim, tmp_path):
+    cache_status(sim, tmp_path, sim.signature)
+    found = mirage_discover.discover(SKEY, [sim.host + '/32'], cache_dir=str(tmp_path))
+    assert found == (sim.host, sim.port)
+    assert mirage_cache.read(SKEY, str(tmp_path)).host == sim.host
+
+def test_discover_rejects_other_certificate(sim, tmp_path):
+    cache_status(sim, tmp_path, b'\x00' * len(sim.signature))
+    logged = []
+    found = mirage_discover.discover(SKEY, [sim.host + '/32'], cache_dir=str(tmp_path), log=logged.append)
+    assert found is None
+    assert logged == ['%s: certificate does not match the cached camera certificate' % (sim.host,)]
@@ -0,0 +1,82 @@
+import random
+import argparse
+import threading
+import pytest
+from mirage_api import *
+import mirage_fleet
+import bench_sync_capture
+
+# One way latencies far enough apart that releasing the requests together
+# leaves a skew of tens of ms.
+OPTS = argparse.Namespace(latency=[2, 40], jitter=0, samples=4, runs=3)
+
+# Stands in for the time module in mirage_fleet and the simulated cameras.
+# Each thread keeps its own time, starting from the same moment, which only
+# moves when the thread sleeps: as if every thread ran at once and took no
+# time. sleep() always moves on a little, so sleep_until's loop ends.
+class FakeTime:
+    def __init__(self, start=1700000000.0):
+        self.start = start
+        self.local = threading.local()
+
+    def time(self):
+        return getattr(self.local, 'now', self.start)
+
+    def sleep(self, seconds):
+        self.local.now = self.time() + max(seconds, 0.00001)
+
+@pytest.fixture(autouse=True)
+def fake_time(monkeypatch):
+    t = FakeTime()
+    monkeypatch.setattr(mirage_fleet, 'time', t)
+    monkeypatch.setattr(bench_sync_capture, 'time', t)
+    random.seed(1)
+    return t
+
+def keyfile(tmp_path):
+    path = tmp_path / 'fleet.skey'
+    path.write_bytes(b'k' * 32)
+    return str(path)
+
+# Camera whose one way latency is different for each request.
+class VaryingCamera(bench_sync_capture.SimulatedCamera):
+    def __init__(self, latencies, offset):
+        super().__init__(0, offset, 0)
+        self.latencies = iter(latencies)
+        self.latency = None
+
+    def call(self, req):
+        self.latency = next(self.latencies)
+        return super().call(req)
+
+def test_measure_clock_keeps_fastest_sample():
+    cam = VaryingCamera([0.030, 0.005, 0.020, 0.050], offset=-3.25)
+    clock = mirage_fleet.measure_clock(cam, samples=4)
+    assert clock.rtt == pytest.approx(0.010, abs=0.000001)
+    # within the camera clock's millisecond resolution
+    assert abs(clock.offset - -3.25) <= 0.0005
+    assert clock.to_local(1700000000000 - 3250) == pytest.approx(1700000000.0, abs=0.0005)
+
+def test_compensation_reduces_skew(tmp_path):
+    skey = keyfile(tmp_path)
+    barrier, worst, reported = bench_sync_capture.measure(OPTS, skey, False)
+    compensated, worst, reported = bench_sync_capture.measure(OPTS, skey, True)
+    # released together, the requests arrive the difference in latency apart
+    assert barrier == pytest.approx(38, abs=0.1)
+    assert compensated < 0.1
+    # and the reported skew, from recording_start_time, is good to the ms
+    assert reported < 2
+
+def test_refused_start_not_counted(tmp_path, fake_time):
+    skey = keyfile(tmp_path)
+    sims = [bench_sync_capture.SimulatedCamera(0.001, 0, 0) for i in range(3)]
+    # recording for a minute already, so it answers INVALID_REQUEST
+    sims[2].started = fake_time.time() - 60
+    cameras = [mirage_fleet.Camera('cam%d' % (i,), 'sim', i, skey) for i in range(3)]
+    with mirage_fleet.Fleet(cameras, lambda host, port, key: sims[port]) as f:
+        results = f.call({cam.id: start_capture_request(argparse.Namespace(auto_stop=None)) for cam in cameras}, sync=True)
+        f.recording_starts(results, 2)
+    assert not results['cam2'].ok()
+    assert results['cam2'].started is None
+    assert results['cam0'].started is not None and results['cam1'].started is not None
+    assert mirage_fleet.start_skew(results) < 0.002
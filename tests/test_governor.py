@@ -0,0 +1,62 @@
+import json
+import argparse
+from mirage_api import *
+import mirage_governor
+from camera_sim import CameraSim
+
+OPTS = argparse.Namespace(projection=None, rtmp_endpoint='rtmp://127.0.0.1/live', stream_name_key='test')
+
+# Calls a streaming simulator directly, dropping frames between status polls.
+# The simulator refuses CONFIGURE while recording, as some cameras do.
+# lost_polls are the status polls (counting from 1) that fail as if the
+# connection had dropped.
+class SimClient:
+    def __init__(self, lost_polls=()):
+        self.sim = CameraSim(b'k' * 32, media=0)
+        self.sim.capture_mode.active_capture_type = CaptureMode.LIVE
+        self.sim.handle(start_capture_request(argparse.Namespace(auto_stop=None)))
+        self.lost_polls = lost_polls
+        self.polls = 0
+
+    def call(self, req):
+        if req.type == CameraApiRequest.STATUS:
+            self.polls += 1
+            if self.polls in self.lost_polls:
+                raise ConnectionResetError('connection reset by peer')
+            self.sim.dropped_frames += 10
+        return self.sim.handle(req)
+
+def test_failed_apply_keeps_step():
+    client = SimClient()
+    caps = client.call(get_capabilities_request(None)).capabilities
+    governor = mirage_governor.Governor(mirage_governor.live_ladder(caps), down_polls=1, down_cooldown=0)
+    top = governor.step
+    logged = []
+    # the first poll only sets the dropped frame baseline
+    mirage_governor.poll(client, governor, OPTS, False, logged.append)
+    for i in range(3):
+        try:
+            mirage_governor.poll(client, governor, OPTS, False, logged.append)
+        except Exception as e:
+            assert 'config_capture failed' in str(e)
+        else:
+            assert False, 'the change should have failed'
+        assert governor.step == top
+    assert logged == []
+
+    # restarting the stream gets the change through, and only then is it taken
+    mirage_governor.poll(client, governor, OPTS, True, logged.append)
+    assert governor.step == top - 1
+    assert json.loads(logged[-1])['to'] == '%dx%d' % governor.size()
+    assert client.sim.recording_start is not None
+
+def test_govern_survives_failed_polls():
+    # polls 1 and 2 of govern's loop are lost (the first status is its setup)
+    client = SimClient(lost_polls=(2, 3))
+    logged = []
+    mirage_governor.govern(client, OPTS, interval=0, count=6, log=logged.append, down_polls=1, down_cooldown=0)
+    errors = [line['error'] for line in map(json.loads, logged) if 'error' in line]
+    assert sum('connection reset' in e for e in errors) == 2
+    # then every change is refused, and retried on the next bad poll
+    assert sum('config_capture failed' in e for e in errors) == 3
+    assert not any('to' in json.loads(line) for line in logged)
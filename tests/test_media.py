@@ -0,0 +1,95 @@
+import io
+import os
+import contextlib
+import pytest
+from mirage_api import *
+import mirage_media
+from camera_sim import CameraSim
+
+SIZE = 100000
+
+class Response(io.BytesIO):
+    def __init__(self, status, data, headers):
+        super().__init__(data)
+        self.status = status
+        self.headers = headers
+
+    def getheader(self, name, default=None):
+        return self.headers.get(name, default)
+
+# Calls a simulator directly. Without total_count, LIST_MEDIA leaves it
+# unset; range_start, if set, is where every ranged GET starts instead.
+class SimClient:
+    def __init__(self, media=3, total_count=True, range_start=None):
+        self.sim = CameraSim(b'k' * 32, media=media, media_size=SIZE)
+        self.total_count = total_count
+        self.range_start = range_start
+        self.ranges = []
+
+    def call(self, req):
+        resp = self.sim.handle(req)
+        if req.type == CameraApiRequest.LIST_MEDIA and not self.total_count:
+            resp.media.ClearField('total_count')
+        return resp
+
+    @contextlib.contextmanager
+    def open_media(self, path, headers=None):
+        m = self.sim.media[path]
+        r = (headers or {}).get('Range')
+        self.ranges.append(r)
+        if r is None:
+            yield Response(200, b''.join(m.chunks()), {'Content-Length': str(m.size)})
+            return
+        start = int(r[len('bytes='):-1])
+        if self.range_start is not None:
+            start = self.range_start
+        yield Response(206, b''.join(m.chunks(start)),
+            {'Content-Length': str(m.size - start), 'Content-Range': 'bytes %d-%d/%d' % (start, m.size - 1, m.size)})
+
+def test_list_without_total_count():
+    client = SimClient(media=7, total_count=False)
+    names = [m.filename for m in mirage_media.list_all_media(client, page_size=3)]
+    assert names == sorted(client.sim.media)
+
+def test_list_exact_pages():
+    client = SimClient(media=6)
+    assert len(list(mirage_media.list_all_media(client, page_size=3))) == 6
+
+def test_same_name_in_two_directories(tmp_path):
+    client = SimClient(media=0)
+    a = client.sim.add_media(0)
+    b = client.sim.add_media(0)
+    for m, name in ((a, 'DCIM/100/CLIP.mp4'), (b, 'DCIM/101/CLIP.mp4')):
+        del client.sim.media[m.filename]
+        m.filename = name
+        client.sim.media[name] = m
+    results = mirage_media.sync_media(client, str(tmp_path), jobs=1, log=lambda *args: None)
+    assert results == {'DCIM/100/CLIP.mp4': 'copied', 'DCIM/101/CLIP.mp4': 'copied'}
+    assert (tmp_path / 'DCIM/100/CLIP.mp4').read_bytes() == b''.join(a.chunks())
+    assert (tmp_path / 'DCIM/101/CLIP.mp4').read_bytes() == b''.join(b.chunks())
+
+@pytest.mark.parametrize('filename', ['/etc/passwd', '../CLIP.mp4', 'DCIM/../../CLIP.mp4', ''])
+def test_path_outside_dest(tmp_path, filename):
+    with pytest.raises(Exception, match='outside the destination'):
+        mirage_media.local_path(str(tmp_path), Media(filename=filename))
+
+def test_resume(tmp_path):
+    client = SimClient(media=1)
+    m, = client.sim.media.values()
+    part = tmp_path / (m.filename + '.part')
+    part.parent.mkdir(parents=True)
+    part.write_bytes(b''.join(m.chunks(0, 1000)))
+    mirage_media.sync_media(client, str(tmp_path), log=lambda *args: None)
+    assert client.ranges == ['bytes=1000-']
+    assert (tmp_path / m.filename).read_bytes() == b''.join(m.chunks())
+
+def test_resume_wrong_range(tmp_path):
+    client = SimClient(media=1, range_start=500)
+    m, = client.sim.media.values()
+    part = tmp_path / (m.filename + '.part')
+    part.parent.mkdir(parents=True)
+    part.write_bytes(b''.join(m.chunks(0, 1000)))
+    results = mirage_media.sync_media(client, str(tmp_path), log=lambda *args: None)
+    assert results == {m.filename: 'copied'}
+    assert client.ranges == ['bytes=1000-', None]
+    assert (tmp_path / m.filename).read_bytes() == b''.join(m.chunks())
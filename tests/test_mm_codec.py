@@ -0,0 +1,58 @@
+import random
+from mirage_api import mm_encode, mm_decode, MMDecoder
+
+# Messages around the escapes: ending in \x00, with \x00\x00 and \x00\x01
+# runs, and the EOM bytes on their own.
+MESSAGES = [
+    b'A',
+    b'A\x00',
+    b'\x01\x00\x00',
+    b'B\x00\x01\x00\x00\x01',
+    b'C\x00\x00\x00\x00',
+    b'\x01\x00\x01\x01\x00\x00\x00\x01\x00',
+    bytes(range(256)) * 3 + b'\x00',
+]
+
+def stream(messages):
+    return b''.join(mm_encode(m) for m in messages)
+
+def decode(chunks, size=8):
+    d = MMDecoder(size)
+    out = []
+    for chunk in chunks:
+        out += d.feed(chunk)
+    return out + d.flush()
+
+def test_every_split_point():
+    encoded = stream(MESSAGES)
+    expected = [mm_decode(mm_encode(m)) for m in MESSAGES]
+    assert expected == MESSAGES
+    for i in range(len(encoded) + 1):
+        assert decode([encoded[:i], encoded[i:]]) == expected, 'split at %d' % (i,)
+
+def test_byte_at_a_time():
+    encoded = stream(MESSAGES)
+    assert decode([encoded[i:i + 1] for i in range(len(encoded))]) == MESSAGES
+
+def test_random_chunks():
+    rng = random.Random(0)
+    messages = [bytes([rng.randrange(1, 256)]) + bytes(rng.choice((0, 1, 2)) for i in range(rng.randrange(50)))
+        for j in range(50)]
+    encoded = stream(messages)
+    for trial in range(20):
+        cuts = sorted(rng.sample(range(len(encoded)), 30))
+        chunks = [encoded[a:b] for a, b in zip([0] + cuts, cuts + [len(encoded)])]
+        assert decode(chunks) == messages
+
+def test_trailing_zero_held_until_settled():
+    d = MMDecoder()
+    # b'A\x00' is encoded as A\x00\x00\x00; stopping one byte short is
+    # also how b'A' is encoded
+    assert d.feed(b'A\x00\x00') == []
+    assert d.pending()
+    assert d.feed(b'\x00') == [b'A\x00']
+    assert not d.pending()
+    assert d.feed(b'A\x00\x00') == []
+    assert d.feed(b'B\x00\x00') == [b'A']
+    assert d.flush() == [b'B']
+    assert d.flush() == []
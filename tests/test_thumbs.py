@@ -0,0 +1,31 @@
+import argparse
+from mirage_api import *
+import mirage_thumbs
+from camera_sim import CameraSim
+
+# Calls a simulator directly, counting GET_THUMBNAIL requests.
+class SimClient:
+    def __init__(self):
+        self.sim = CameraSim(b'k' * 32, media=3, media_size=1024)
+        self.thumbnail_calls = 0
+
+    def call(self, req):
+        if req.type == CameraApiRequest.GET_THUMBNAIL:
+            self.thumbnail_calls += 1
+        return self.sim.handle(req)
+
+def test_cache_keyed_by_size_and_quality(tmp_path):
+    client = SimClient()
+    medias = list(client.sim.handle(list_media_request(argparse.Namespace(start=0, count=0))).media.media)
+    cache = mirage_thumbs.ThumbnailCache(str(tmp_path))
+
+    first = mirage_thumbs.fetch_thumbnails(client, medias, cache, 512, 512, 80)
+    assert client.thumbnail_calls == 1
+    assert first == {m.filename: client.sim.media[m.filename].thumb for m in medias}
+
+    assert mirage_thumbs.fetch_thumbnails(client, medias, cache, 512, 512, 80) == first
+    assert client.thumbnail_calls == 1
+    for width, height, quality in ((512, 512, 50), (512, 512, None), (256, 256, 80)):
+        mirage_thumbs.fetch_thumbnails(client, medias, cache, width, height, quality)
+    assert client.thumbnail_calls == 4
+    assert len(list(tmp_path.glob('*.thumb'))) == 4 * len(medias)